@@ -0,0 +1,166 @@
+"""
+Module: approximate_clusters
+
+An approximate dbscan for very large catalogs, which works on grid cells
+instead of points, and a report on how far its labels are from those of
+the exact dbscan.
+"""
+
+import itertools
+import math
+import time
+
+import numpy as np
+
+from earthquake_clusters import (NOISE, check_metric, chord_length,
+                                 dbscan_array, sphere_coords, _components)
+
+
+def _approximate_cells(space, side, reach):
+    """
+    Buckets the points of space, an (n, d) array, into cells of width side
+    and returns (keys, inverse, counts, strides): the int64 key of every
+    non-empty cell in increasing order, the cell of each point, the number
+    of points in each cell, and the strides that turn a cell offset into
+    a key offset. The grid is padded by reach cells on every side, so the
+    keys of offsets up to reach never wrap around.
+    """
+    n, dims = space.shape
+    cells = np.floor(space / side).astype(np.int64)
+    if n:
+        cells -= cells.min(axis=0) - reach
+    widths = cells.max(axis=0, initial=0) + reach + 1
+    if math.prod(int(width) for width in widths) >= 2**62:
+        raise ValueError("epsilon is too small for the extent of the points; "
+                         "use a larger rho")
+    strides = np.ones(dims, dtype=np.int64)
+    for k in range(dims - 2, -1, -1):
+        strides[k] = strides[k + 1] * widths[k + 1]
+    keys, inverse, counts = np.unique(cells @ strides, return_inverse=True,
+                                      return_counts=True)
+    return keys, inverse.ravel(), counts, strides
+
+def approximate_dbscan(coords, epsilon, min_pts, rho=0.5, metric='euclidean'):
+    """
+    Clusters the (n, 2) array of (lon, lat) rows in coords like
+    dbscan_array(coords, epsilon, min_pts, metric=metric, standard=True),
+    but on a grid of cells rho * epsilon across instead of on the points,
+    and returns the int32 label of each row.
+    The neighbors of a point are taken to be the points of every cell
+    whose center is within epsilon of the center of its own cell. Every
+    point counted is then within (1 + rho) * epsilon of it, and every point
+    within (1 - rho) * epsilon of it is counted, so each neighbor count is
+    bounded by the exact counts at those two radii (straight-line
+    distances through the Earth with metric 'haversine'). Clusters join
+    the same way. The work grows with the number of non-empty cells, not
+    with the number of pairs of close points, which is what makes dense
+    catalogs fast; a smaller rho is more exact and slower.
+    """
+    check_metric(metric)
+    if not 0 < rho < 1:
+        raise ValueError("rho must be between 0 and 1")
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if metric == 'haversine':
+        space, radius = sphere_coords(coords), chord_length(epsilon)
+    else:
+        space, radius = coords, epsilon
+    n, dims = space.shape
+    if not n:
+        return np.empty(0, dtype=np.int32)
+    side = rho * radius / math.sqrt(dims)
+    reach = int(math.floor(radius / side))
+    keys, inverse, counts, strides = _approximate_cells(space, side, reach)
+    offsets = np.array([offset for offset in
+                        itertools.product(range(-reach, reach + 1), repeat=dims)
+                        if math.hypot(*offset) * side <= radius])
+
+    # Pairs of non-empty cells whose centers are within radius.
+    rows, cols = [], []
+    everyone = np.arange(len(keys))
+    for step in offsets @ strides:
+        target = keys + step
+        found = np.searchsorted(keys, target)
+        found[found == len(keys)] = 0
+        hit = keys[found] == target
+        rows.append(everyone[hit])
+        cols.append(found[hit])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+    density = np.bincount(rows, counts[cols], minlength=len(keys))
+    core = density >= min_pts
+    linked = core[rows] & core[cols]
+    roots = _components(len(keys), rows[linked], cols[linked])
+    # Number the clusters in the order of their first core point, like
+    # _standard_labels.
+    first = np.full(len(keys), n)
+    np.minimum.at(first, inverse, np.arange(n))
+    cluster_first = np.full(len(keys), n)
+    np.minimum.at(cluster_first, roots[core], first[core])
+    order = np.unique(cluster_first[roots[core]])
+    cell_labels = np.full(len(keys), NOISE, dtype=np.int32)
+    cell_labels[core] = np.searchsorted(order, cluster_first[roots[core]])
+    # Other cells join the cluster of the core cell that holds the
+    # earliest point among those within reach.
+    border = ~core[rows] & core[cols]
+    best = np.full(len(keys), n)
+    np.minimum.at(best, rows[border], first[cols[border]])
+    near = ~core & (best < n)
+    cell_labels[near] = cell_labels[inverse[best[near]]]
+    return cell_labels[inverse]
+
+def adjusted_rand_index(labels1, labels2):
+    """
+    Returns the adjusted Rand index of two labelings of the same points:
+    1 when they group the points the same way, whatever the cluster
+    numbers, and about 0 for unrelated labelings. Noise is treated as one
+    more group.
+    """
+    labels1 = np.asarray(labels1).ravel()
+    labels2 = np.asarray(labels2).ravel()
+    if len(labels1) != len(labels2):
+        raise ValueError("the labelings must have the same length")
+    n = len(labels1)
+    pairs = np.unique(np.column_stack((labels1, labels2)), axis=0,
+                      return_counts=True)[1] if n else np.empty(0)
+
+    def combinations(counts):
+        counts = np.asarray(counts, dtype=np.float64)
+        return float((counts * (counts - 1) / 2).sum())
+
+    together = combinations(pairs)
+    first = combinations(np.unique(labels1, return_counts=True)[1])
+    second = combinations(np.unique(labels2, return_counts=True)[1])
+    expected = first * second / (n * (n - 1) / 2) if n > 1 else 0.0
+    maximum = (first + second) / 2
+    if maximum == expected:
+        return 1.0
+    return (together - expected) / (maximum - expected)
+
+def quality_report(coords, epsilon, min_pts, rhos=(0.25, 0.5, 0.75),
+                   metric='euclidean'):
+    """
+    Runs approximate_dbscan with each rho in rhos and the exact
+    dbscan_array(..., standard=True) on coords, and returns a list of
+    dictionaries, one per rho, with the adjusted Rand index between the
+    two labelings, the fraction of points whose noise or non-noise status
+    differs, the number of clusters of each, and the seconds each took.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    start = time.perf_counter()
+    exact = dbscan_array(coords, epsilon, min_pts, metric=metric, standard=True)
+    exact_seconds = time.perf_counter() - start
+    report = []
+    for rho in rhos:
+        start = time.perf_counter()
+        labels = approximate_dbscan(coords, epsilon, min_pts, rho, metric)
+        seconds = time.perf_counter() - start
+        report.append({
+            'rho': rho,
+            'adjusted_rand_index': adjusted_rand_index(exact, labels),
+            'noise_mismatch': float(np.mean((exact == NOISE) != (labels == NOISE)))
+                              if len(exact) else 0.0,
+            'clusters': int(labels.max(initial=-1)) + 1,
+            'exact_clusters': int(exact.max(initial=-1)) + 1,
+            'seconds': seconds,
+            'exact_seconds': exact_seconds})
+    return report
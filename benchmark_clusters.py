@@ -0,0 +1,427 @@
+"""
+Module: benchmark_clusters
+
+Benchmarks for the earthquake_clusters module.
+
+Run
+python3 benchmark_clusters.py --rows 10000000
+from the command line to time load_catalog against the csv.reader loader
+it replaced on a synthetic catalog with the given number of rows, or
+python3 benchmark_clusters.py --scaling --rows 4000000
+to time dbscan_parallel with 1, 2, 4, 8 and 16 workers, or
+python3 benchmark_clusters.py --suite --sizes 10000 100000 --json out.json
+to time each stage of the pipeline, and its peak memory, on the bundled
+catalogs and synthetic ones, along with the import time and resident
+memory of a process that only clusters, optionally with --compare baseline.json to
+flag the stages that got slower or bigger than in an earlier run, or
+python3 benchmark_clusters.py --approximate --rows 10000000
+to compare approximate_dbscan with the exact dbscan on eq_week.csv and on
+a synthetic catalog, for speed and adjusted Rand index, or
+python3 benchmark_clusters.py --ingest
+to time polling eq_day.csv and eq_week.csv from a local FeedServer into
+an IncrementalClusterer, cold and then unchanged, or
+python3 benchmark_clusters.py --queries
+to time the lookups of a ClusterResults built over eq_week.csv.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import approximate_clusters
+import cluster_queries
+import earthquake_clusters
+import feed_ingest
+import incremental_clusters
+import parallel_clusters
+
+HEADER = ("time,latitude,longitude,depth,mag,magType,nst,gap,dmin,rms,net,id,"
+          "updated,place,type,horizontalError,depthError,magError,magNst,"
+          "status,locationSource,magSource")
+
+
+def write_synthetic_catalog(filename, rows, seed=0):
+    """
+    Writes a catalog of rows earthquakes at synthetic_locations(rows, seed)
+    to filename, using the same columns as the USGS feeds in eq_day.csv
+    and eq_week.csv.
+    """
+    coords = synthetic_locations(rows, seed)
+    rng = np.random.default_rng(seed)
+    depths = rng.uniform(0, 700, rows)
+    mags = rng.uniform(-1, 8, rows)
+    places = rng.integers(1, 99, rows)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(HEADER + '\n')
+        for start in range(0, rows, 100000):
+            lines = []
+            for i in range(start, min(start + 100000, rows)):
+                seconds = 1541635200 + i * 0.5
+                lines.append(
+                    '%s.%03dZ,%.7f,%.7f,%.2f,%.2f,ml,12,90,0.05,0.1,ci,ci%d,'
+                    '2018-11-09T00:00:00.000Z,"%dkm NE of Somewhere, CA",'
+                    'earthquake,0.3,0.5,0.1,9,reviewed,ci,ci'
+                    % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)),
+                       int(seconds * 1000) % 1000, coords[i, 1], coords[i, 0],
+                       depths[i], mags[i], i, places[i]))
+            f.write('\n'.join(lines) + '\n')
+
+def synthetic_locations(rows, seed=0, swarms=None, background=0.1,
+                        antimeridian=0.05):
+    """
+    Returns an (rows, 2) array of (lon, lat) points that looks like a real
+    catalog, in shuffled order: most events belong to aftershock swarms
+    (one per 500 rows unless swarms is given) whose sizes follow a
+    heavy-tailed distribution and whose spreads range from 5 to 50 km or
+    so, a background fraction is spread evenly over the globe, and an
+    antimeridian fraction of the swarms sit on the 180th meridian, so
+    their events wrap around from 180 to -180 longitude.
+    The same seed always gives the same points.
+    """
+    rng = np.random.default_rng(seed)
+    swarms = swarms or max(1, rows // 500)
+    centers = np.column_stack((rng.uniform(-180, 180, swarms),
+                               rng.uniform(-60, 60, swarms)))
+    wrapped = rng.random(swarms) < antimeridian
+    centers[wrapped, 0] = rng.uniform(179, 181, np.count_nonzero(wrapped))
+    sizes = rng.pareto(1.2, swarms) + 1
+    spreads = rng.uniform(0.05, 0.5, swarms)
+    scattered = int(round(rows * background))
+    swarm = rng.choice(swarms, rows - scattered, p=sizes / sizes.sum())
+    points = centers[swarm] + rng.normal(0, 1, (len(swarm), 2)) * spreads[swarm, None]
+    noise = np.column_stack((rng.uniform(-180, 180, scattered),
+                             np.degrees(np.arcsin(rng.uniform(-1, 1, scattered)))))
+    points = np.concatenate((points, noise))[rng.permutation(rows)]
+    points[:, 0] = (points[:, 0] + 180) % 360 - 180
+    np.clip(points[:, 1], -90, 90, out=points[:, 1])
+    return points
+
+def csv_reader_locations(filename):
+    """
+    The csv.reader version of get_eq_locations that load_catalog replaced,
+    kept as the baseline for benchmark_loader.
+    """
+    locations = []
+    with open(filename, encoding='utf-8') as f:
+        f.readline()
+        for line in csv.reader(f, delimiter=','):
+            locations.append((float(line[2]), float(line[1])))
+    return locations
+
+def benchmark_loader(filename):
+    """
+    Times csv_reader_locations, get_eq_locations and load_catalog on
+    filename and returns a dictionary of {name: (seconds, rows per second)}.
+    """
+    loaders = {
+        'csv_reader_locations': lambda: len(csv_reader_locations(filename)),
+        'get_eq_locations': lambda: len(earthquake_clusters.get_eq_locations(filename)),
+        'load_catalog': lambda: len(earthquake_clusters.load_catalog(filename)[0]['latitude']),
+    }
+    results = {}
+    for name, loader in loaders.items():
+        start = time.perf_counter()
+        rows = loader()
+        seconds = time.perf_counter() - start
+        results[name] = (seconds, rows / seconds if seconds else float('inf'))
+    return results
+
+def benchmark_parallel(coords, epsilon, min_pts, workers=(1, 2, 4, 8, 16)):
+    """
+    Times dbscan_parallel on coords with each number of workers and
+    returns a dictionary of {workers: (seconds, speedup over one worker)}.
+    """
+    results = {}
+    for count in workers:
+        start = time.perf_counter()
+        parallel_clusters.dbscan_parallel(coords, epsilon, min_pts, workers=count)
+        seconds = time.perf_counter() - start
+        base = results[workers[0]][0] if results else seconds
+        results[count] = (seconds, base / seconds if seconds else float('inf'))
+    return results
+
+STAGES = ('get_eq_locations', 'initialize_database', 'dbscan', 'get_clusters',
+          'plot_clusters', 'render_clusters')
+
+def run_pipeline(filename, epsilon, min_pts, measure):
+    """
+    Runs the plot_earthquakes pipeline on filename one stage at a time,
+    calling measure(stage name, function) for each stage, which must run
+    the function and return its result.
+    """
+    locations = measure('get_eq_locations',
+                        lambda: earthquake_clusters.get_eq_locations(filename))
+    data = measure('initialize_database',
+                   lambda: earthquake_clusters.initialize_database(locations))
+    num_clusters = measure('dbscan',
+                           lambda: earthquake_clusters.dbscan(data, epsilon, min_pts))
+    clusters = measure('get_clusters',
+                       lambda: earthquake_clusters.get_clusters(data, num_clusters))
+
+    def plot():
+        import matplotlib.pyplot as pp
+        earthquake_clusters.plot_clusters(clusters)
+        pp.close('all')
+    measure('plot_clusters', plot)
+    with tempfile.TemporaryDirectory() as directory:
+        measure('render_clusters', lambda: earthquake_clusters.render_clusters(
+            clusters, os.path.join(directory, 'map.png'), background=None))
+
+def benchmark_pipeline(filename, epsilon, min_pts):
+    """
+    Runs the pipeline on filename twice, once to time each stage and once
+    under tracemalloc to find the peak memory each stage allocates, and
+    returns a dictionary of {stage: {'seconds': s, 'peak_bytes': b}}.
+    """
+    results = {}
+
+    def timed(stage, function):
+        start = time.perf_counter()
+        value = function()
+        results[stage] = {'seconds': time.perf_counter() - start}
+        return value
+
+    def traced(stage, function):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        value = function()
+        results[stage]['peak_bytes'] = tracemalloc.get_traced_memory()[1] - before
+        return value
+
+    run_pipeline(filename, epsilon, min_pts, timed)
+    tracemalloc.start()
+    try:
+        run_pipeline(filename, epsilon, min_pts, traced)
+    finally:
+        tracemalloc.stop()
+    return results
+
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+scale = 1 if sys.platform == 'darwin' else 1024
+start = time.perf_counter()
+import earthquake_clusters
+imported = time.perf_counter()
+import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+coords = earthquake_clusters.catalog_locations(sys.argv[1])
+earthquake_clusters.dbscan_array(coords, 2.0, 4)
+done = time.perf_counter()
+print(json.dumps({
+    'import': {'seconds': imported - start, 'rss_bytes': import_rss},
+    'cluster': {'seconds': done - imported,
+                'rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+                'plotting_loaded': sum(name in sys.modules
+                                       for name in ('matplotlib', 'imageio'))}}))
+"""
+
+def benchmark_startup(filename, runs=5):
+    """
+    Imports earthquake_clusters and clusters filename with dbscan_array in
+    a fresh interpreter, the way a worker process does, runs times, and
+    returns the fastest run as {'import': {...}, 'cluster': {...}}, each
+    with the seconds taken and the peak resident memory in rss_bytes.
+    plotting_loaded counts how many of matplotlib and imageio got
+    imported, which should be none.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(runs):
+        result = json.loads(subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, filename], cwd=here,
+            check=True, capture_output=True, text=True).stdout)
+        if best is None or result['import']['seconds'] < best['import']['seconds']:
+            best = result
+    return best
+
+def benchmark_suite(sizes, epsilon=0.1, min_pts=10, seed=0):
+    """
+    Runs benchmark_pipeline on eq_day.csv and eq_week.csv, with the
+    settings plot_earthquakes uses, and on a synthetic catalog of each
+    size in sizes with epsilon and min_pts, and benchmark_startup on
+    eq_week.csv as the 'startup' dataset. The 'suite' dataset holds the
+    seconds the whole run took and its peak resident memory, which is
+    what runs out when a stage grows faster than the catalog. Returns a
+    dictionary ready to be saved as JSON, with the results under
+    'datasets'.
+    """
+    import resource
+    start = time.perf_counter()
+    report = {'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'datasets': {}}
+    here = os.path.dirname(os.path.abspath(__file__))
+    report['datasets']['startup'] = benchmark_startup(
+        os.path.join(here, 'eq_week.csv'))
+    for name in ('eq_day', 'eq_week'):
+        report['datasets'][name] = benchmark_pipeline(
+            os.path.join(here, name + '.csv'), 2.0, 4)
+    for rows in sizes:
+        handle, filename = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            write_synthetic_catalog(filename, rows, seed)
+            report['datasets']['synthetic-%d' % rows] = benchmark_pipeline(
+                filename, epsilon, min_pts)
+        finally:
+            os.remove(filename)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    report['datasets']['suite'] = {'total': {
+        'seconds': time.perf_counter() - start,
+        'rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale}}
+    return report
+
+def compare_reports(report, baseline, threshold=0.2):
+    """
+    Returns a list of (dataset, stage, measure, baseline value, new value)
+    for every time, peak memory or resident memory in report that is more than threshold
+    (a fraction) above the same one in baseline. Datasets and stages that
+    are missing from either report are skipped.
+    """
+    regressions = []
+    for name, stages in report['datasets'].items():
+        for stage, values in stages.items():
+            old = baseline.get('datasets', {}).get(name, {}).get(stage, {})
+            for measure in ('seconds', 'peak_bytes', 'rss_bytes'):
+                if measure in old and measure in values and \
+                        values[measure] > old[measure] * (1 + threshold):
+                    regressions.append((name, stage, measure, old[measure],
+                                        values[measure]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument('--rows', type=int, default=10000000,
+                        help="rows in the synthetic catalog (default 10M)")
+    parser.add_argument('--file', help="catalog to use instead of a synthetic one")
+    parser.add_argument('--scaling', action='store_true',
+                        help="time dbscan_parallel over 1 to 16 workers instead")
+    parser.add_argument('--ingest', action='store_true',
+                        help="time feed ingestion from a local server instead")
+    parser.add_argument('--queries', action='store_true',
+                        help="time cluster lookups on eq_week.csv instead")
+    parser.add_argument('--approximate', action='store_true',
+                        help="compare approximate_dbscan with dbscan instead")
+    parser.add_argument('--suite', action='store_true',
+                        help="time every stage of the pipeline instead")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help="synthetic catalog sizes for --suite")
+    parser.add_argument('--json', help="file to save the --suite results to")
+    parser.add_argument('--compare',
+                        help="--suite results to check the new ones against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="slowdown counted as a regression (default 0.2)")
+    parser.add_argument('--epsilon', type=float, default=0.1)
+    parser.add_argument('--min-pts', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.suite:
+        import matplotlib
+        matplotlib.use('Agg')
+        report = benchmark_suite(args.sizes, args.epsilon, args.min_pts)
+        for name, stages in report['datasets'].items():
+            for stage, values in stages.items():
+                memory = values.get('peak_bytes', values.get('rss_bytes', 0))
+                print("%-18s %-20s %9.3f s %10.1f MB"
+                      % (name, stage, values['seconds'], memory / 1e6))
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                regressions = compare_reports(report, json.load(f), args.threshold)
+            for name, stage, measure, old, new in regressions:
+                print("REGRESSION %s %s %s: %.4g -> %.4g (%+.0f%%)"
+                      % (name, stage, measure, old, new, 100 * (new / old - 1)))
+            sys.exit(1 if regressions else 0)
+        sys.exit()
+
+    if args.ingest:
+        with feed_ingest.FeedServer() as server:
+            poller = feed_ingest.FeedPoller(
+                [server.url('eq_week.csv'), server.url('eq_day.geojson')],
+                incremental_clusters.IncrementalClusterer(2.0, 4))
+            try:
+                for name in ('cold', 'unchanged'):
+                    new = asyncio.run(poller.poll_once())
+                    print("%-10s %6d new events %8.1f ms"
+                          % (name, len(new), poller.latencies[-1] * 1000))
+            finally:
+                poller.close()
+        sys.exit()
+
+    if args.queries:
+        here = os.path.dirname(os.path.abspath(__file__))
+        coords = earthquake_clusters.catalog_locations(os.path.join(here, 'eq_week.csv'))
+        labels = earthquake_clusters.dbscan_array(coords, 2.0, 4, standard=True)
+        results = cluster_queries.ClusterResults(
+            coords, labels, 2.0,
+            core=earthquake_clusters.core_points(coords, 2.0, 4))
+        rng = np.random.default_rng(0)
+        points = np.column_stack((rng.uniform(-180, 180, 10000),
+                                  rng.uniform(-90, 90, 10000))).tolist()
+        queries = [('label_of', lambda p: results.label_of(p)),
+                   ('nearest', lambda p: results.nearest(p)),
+                   ('within 5', lambda p: results.within(p, 5.0)),
+                   ('intersecting 10x10', lambda p: results.intersecting(
+                       (p[0] - 5, p[1] - 5, p[0] + 5, p[1] + 5)))]
+        print("%d clusters over %d points" % (len(results), len(coords)))
+        for name, query in queries:
+            start = time.perf_counter()
+            for point in points:
+                query(point)
+            seconds = time.perf_counter() - start
+            print("%-20s %10.0f lookups/s" % (name, len(points) / seconds))
+        sys.exit()
+
+    if args.approximate:
+        here = os.path.dirname(os.path.abspath(__file__))
+        datasets = [('eq_week', earthquake_clusters.get_eq_locations(
+                         os.path.join(here, 'eq_week.csv')), 2.0, 4),
+                    ('synthetic-%d' % args.rows, synthetic_locations(args.rows),
+                     args.epsilon, args.min_pts)]
+        for name, coords, epsilon, min_pts in datasets:
+            for row in approximate_clusters.quality_report(coords, epsilon, min_pts):
+                print("%-18s rho %.2f  ARI %.4f  noise mismatch %.4f  "
+                      "%5d/%5d clusters  %8.2f s vs %8.2f s (%.1fx)"
+                      % (name, row['rho'], row['adjusted_rand_index'],
+                         row['noise_mismatch'], row['clusters'],
+                         row['exact_clusters'], row['seconds'],
+                         row['exact_seconds'],
+                         row['exact_seconds'] / max(row['seconds'], 1e-9)))
+        sys.exit()
+
+    if args.scaling:
+        if args.file is None:
+            coords = synthetic_locations(args.rows)
+        else:
+            coords = earthquake_clusters.get_eq_locations(args.file)
+        print("Clustering %d points (cpu count %s)" % (len(coords), os.cpu_count()))
+        results = benchmark_parallel(coords, args.epsilon, args.min_pts)
+        for count, (seconds, speedup) in results.items():
+            print("%2d workers %8.2f s %6.2fx" % (count, seconds, speedup))
+        sys.exit()
+
+    filename = args.file
+    if filename is None:
+        handle, filename = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        print("Writing %d synthetic rows to %s" % (args.rows, filename))
+        write_synthetic_catalog(filename, args.rows)
+    try:
+        for name, (seconds, rate) in benchmark_loader(filename).items():
+            print("%-22s %8.2f s %12.0f rows/s" % (name, seconds, rate))
+    finally:
+        if args.file is None:
+            os.remove(filename)
@@ -0,0 +1,176 @@
+"""
+Module: catalog_cache
+
+Keeps the parsed coordinates of catalogs, their epsilon-neighbor graphs
+and their dbscan labels in a directory on disk, so that clustering the
+same file with the same settings again only has to map arrays back in.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from earthquake_clusters import (UNVISITED, catalog_locations, check_metric,
+                                 neighbor_graph, _label_points,
+                                 _standard_labels)
+
+
+class CatalogCache:
+    """
+    A cache directory of numpy arrays saved as .npy files, which are read
+    back with mmap instead of being loaded. Every entry is a subdirectory
+    named after the sha256 of the catalog's contents, so a file that is
+    renamed still hits and a file that is edited misses, plus the
+    settings that produced it:
+
+        <hash>.coords/          the (n, 2) longitude, latitude array
+        <hash>.graph-<key>/     the CSR neighbor graph (indptr, indices)
+        <hash>.labels-<key>/    the int32 labels of a dbscan run
+
+    Entries are written to a temporary directory and renamed into place,
+    so several processes can share one cache. Reading an entry marks it
+    as used; once the entries add up to more than max_bytes, the least
+    recently used ones are deleted. Arrays computed on a miss are returned
+    as they are, so an entry too big to keep still works.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hashes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def file_hash(self, filename):
+        """
+        Returns the sha256 of the contents of filename as a hex string.
+        It is only computed again when the file's size or mtime changes.
+        """
+        info = os.stat(filename)
+        stamp = (os.path.realpath(filename), info.st_size, info.st_mtime_ns)
+        if stamp not in self.hashes:
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self.hashes[stamp] = digest.hexdigest()
+        return self.hashes[stamp]
+
+    def _read(self, name, arrays):
+        """
+        Returns the arrays (a tuple of names) of the entry name, mapped
+        read-only, or None if the entry is not in the cache.
+        """
+        path = os.path.join(self.directory, name)
+        try:
+            result = tuple(np.load(os.path.join(path, array + '.npy'),
+                                   mmap_mode='r') for array in arrays)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def _write(self, name, **arrays):
+        """
+        Saves arrays as the entry name, then evicts old entries if the
+        cache has grown past max_bytes.
+        """
+        path = os.path.join(self.directory, name)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            for array, values in arrays.items():
+                np.save(os.path.join(staging, array + '.npy'), values)
+            os.replace(staging, path)
+        except OSError:
+            # Another process saved the same entry first.
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """
+        Returns a list of (last used, bytes, name) for every entry.
+        """
+        result = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                result.append((os.stat(path).st_mtime_ns, size, name))
+            except OSError:
+                continue
+        return result
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the rest fit in
+        max_bytes. Returns the names of the entries deleted.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for used, size, name in entries)
+        evicted = []
+        for used, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
+            evicted.append(name)
+        return evicted
+
+    def locations(self, filename):
+        """
+        Returns the (n, 2) float64 array of (lon, lat) rows that
+        catalog_locations reads from filename, parsing the file only if it
+        is not cached yet.
+        """
+        name = self.file_hash(filename) + '.coords'
+        cached = self._read(name, ('coords',))
+        if cached is None:
+            cached = (catalog_locations(filename),)
+            self._write(name, coords=cached[0])
+        return cached[0]
+
+    def neighbor_graph(self, filename, epsilon, metric='euclidean'):
+        """
+        Returns the (indptr, indices) neighbor_graph of the locations in
+        filename, computing it only if it is not cached yet.
+        """
+        check_metric(metric)
+        name = '%s.graph-%s' % (self.file_hash(filename),
+                                _settings_key(metric, epsilon))
+        cached = self._read(name, ('indptr', 'indices'))
+        if cached is None:
+            cached = neighbor_graph(self.locations(filename), epsilon,
+                                    metric=metric)
+            self._write(name, indptr=cached[0], indices=cached[1])
+        return cached
+
+    def dbscan(self, filename, epsilon, min_pts, metric='euclidean',
+               standard=False):
+        """
+        Returns (coords, labels) for the catalog filename, the labels being
+        those of dbscan_array(coords, epsilon, min_pts, metric=metric,
+        standard=standard). A warm call only maps the arrays in; a call
+        with a new min_pts reuses the cached neighbor graph.
+        """
+        coords = self.locations(filename)
+        name = '%s.labels-%s' % (self.file_hash(filename),
+                                 _settings_key(metric, epsilon, min_pts, standard))
+        cached = self._read(name, ('labels',))
+        if cached is None:
+            indptr, indices = self.neighbor_graph(filename, epsilon, metric)
+            labels = np.full(len(coords), UNVISITED, dtype=np.int32)
+            label_points = _standard_labels if standard else _label_points
+            label_points(labels, indptr, indices, min_pts)
+            cached = (labels,)
+            self._write(name, labels=labels)
+        return coords, cached[0]
+
+def _settings_key(*settings):
+    """
+    Returns a short hex key that identifies settings in an entry name.
+    """
+    return hashlib.sha256(repr(settings).encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,348 @@
+"""
+Module: cluster_queries
+
+Answers questions about the clusters of a finished dbscan run, such as
+which cluster is nearest a station or which clusters touch a region,
+from per-cluster summaries and grids over the clustered events instead of
+scanning every point.
+"""
+
+import collections
+import itertools
+import math
+
+import numpy as np
+
+from earthquake_clusters import (NOISE, ROW_DISTANCES, LabelStore, check_metric,
+                                 chord_length, sphere_coords)
+
+
+class ClusterSummary(collections.namedtuple(
+        'ClusterSummary', 'label count centroid bbox hull mag_min mag_max mag_mean')):
+    """
+    The summary of one cluster: its label, its number of events, its
+    centroid and bounding box (min_lon, min_lat, max_lon, max_lat), the
+    (lon, lat) corners of its convex hull in counterclockwise order, and
+    the smallest, largest and mean magnitude of its events (None when no
+    magnitudes were given).
+    With 'haversine', a box that crosses the antimeridian has min_lon >
+    max_lon, and the hull is drawn around the longitudes unwrapped around
+    the centroid, so its corners can lie beyond -180 or 180.
+    """
+    __slots__ = ()
+
+def convex_hull(points):
+    """
+    Returns the corners of the convex hull of points, an (n, 2) array, as
+    a list of (x, y) tuples in counterclockwise order, using Andrew's
+    monotone chain. Fewer than three distinct points are returned as they
+    are.
+    """
+    points = sorted(set(map(tuple, np.asarray(points).tolist())))
+    if len(points) < 3:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    def chain(points):
+        result = []
+        for point in points:
+            while len(result) >= 2 and cross(result[-2], result[-1], point) <= 0:
+                result.pop()
+            result.append(point)
+        return result
+
+    lower, upper = chain(points), chain(reversed(points))
+    return lower[:-1] + upper[:-1]
+
+def _unwrapped(points, lon):
+    """
+    Returns a copy of points, an (n, 2) array of (lon, lat) rows, with
+    each longitude moved by whole turns to within 180 degrees of lon.
+    """
+    points = points.copy()
+    points[:, 0] += 360 * np.round((lon - points[:, 0]) / 360)
+    return points
+
+class ClusterResults:
+    """
+    The clusters of a dbscan run over the (lon, lat) rows of coords with
+    the given labels, as dbscan_array returns them, with a summary of each
+    cluster (see ClusterSummary) and two grids for fast queries: one over
+    the clustered events, with cells epsilon wide, and one over the
+    bounding boxes of the clusters. results[label] is the summary of a
+    cluster and len(results) the number of clusters.
+    Distances follow metric; with 'haversine' they are kilometers and the
+    event grid is laid over the globe like GridIndex, while bounding boxes
+    and hulls stay in degrees, measured around the centroid of each
+    cluster so that a cluster across the antimeridian stays small.
+    core, a boolean array telling which rows are core points (such as
+    core_points returns), is needed by label_of, which only lets core
+    events pull a new event into their cluster.
+    """
+
+    def __init__(self, coords, labels, epsilon, mags=None, metric='euclidean',
+                 core=None):
+        check_metric(metric)
+        if not epsilon > 0:
+            raise ValueError("epsilon must be positive")
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.labels = np.asarray(labels).astype(np.int64)
+        self.epsilon = epsilon
+        self.metric = metric
+        self.distance = ROW_DISTANCES[metric]
+        num_clusters = int(self.labels.max(initial=-1)) + 1
+        clustered = np.flatnonzero(self.labels >= 0)
+        order = clustered[np.argsort(self.labels[clustered], kind='stable')]
+        bounds = np.searchsorted(self.labels[order], np.arange(num_clusters + 1))
+        if mags is not None:
+            mags = np.asarray(mags, dtype=np.float64)
+        self.summaries = []
+        for label in range(num_clusters):
+            rows = order[bounds[label]:bounds[label + 1]]
+            points = self.coords[rows]
+            if metric == 'haversine':
+                x, y, z = sphere_coords(points).mean(axis=0)
+                centroid = (math.degrees(math.atan2(y, x)),
+                            math.degrees(math.atan2(z, math.hypot(x, y))))
+                # The box and hull are found around the centroid, and the
+                # box keeps the longitudes of its westmost and eastmost
+                # events, so min_lon > max_lon across the antimeridian.
+                unwrapped = _unwrapped(points, centroid[0])
+                west = int(np.argmin(unwrapped[:, 0]))
+                east = int(np.argmax(unwrapped[:, 0]))
+                lons = (points[west, 0], points[east, 0])
+                if unwrapped[east, 0] - unwrapped[west, 0] >= 360:
+                    lons = (-180.0, 180.0)
+                bbox = (float(lons[0]), float(points[:, 1].min()),
+                        float(lons[1]), float(points[:, 1].max()))
+                points = unwrapped
+            else:
+                centroid = tuple(points.mean(axis=0).tolist())
+                bbox = tuple(points.min(axis=0).tolist()
+                             + points.max(axis=0).tolist())
+            stats = (None, None, None)
+            if mags is not None:
+                known = mags[rows][~np.isnan(mags[rows])]
+                if len(known):
+                    stats = (float(known.min()), float(known.max()),
+                             float(known.mean()))
+            self.summaries.append(ClusterSummary(
+                label, len(rows), centroid, bbox, convex_hull(points), *stats))
+
+        if metric == 'haversine':
+            self.space, self.cell_size = sphere_coords(self.coords), chord_length(epsilon)
+        else:
+            self.space, self.cell_size = self.coords, epsilon
+        self.clustered = clustered
+        self.cells = self._bucket(clustered, self.space[clustered], self.cell_size)
+        self.core = None
+        if core is not None:
+            core = np.asarray(core, dtype=bool)
+            if core.shape != self.labels.shape:
+                raise ValueError("core must have one flag per row")
+            self.core = clustered[core[clustered]]
+            self.core_cells = self._bucket(self.core, self.space[self.core],
+                                           self.cell_size)
+
+        self.boxes = np.array([summary.bbox for summary in self.summaries],
+                              dtype=np.float64).reshape(-1, 4)
+        extent = self.boxes[:, 2:] - self.boxes[:, :2]
+        extent[:, 0] += 360 * (extent[:, 0] < 0)
+        self.box_size = max(float(np.median(extent)) if len(extent) else 0.0,
+                            epsilon if metric == 'euclidean' else 1.0)
+        self.box_cells = {}
+        for label, box in enumerate(self.boxes.tolist()):
+            for cell in set(self._box_cells(box)):
+                self.box_cells.setdefault(cell, []).append(label)
+
+    @classmethod
+    def from_store(cls, store, epsilon, mags=None, metric='euclidean',
+                   core=None):
+        """
+        Returns the results for a LabelStore clustered by dbscan.
+        """
+        if not isinstance(store, LabelStore):
+            raise TypeError("expected a LabelStore, not %s" % type(store).__name__)
+        return cls(store.coords, store.labels, epsilon, mags, metric, core)
+
+    @classmethod
+    def from_clusters(cls, clusters, epsilon, metric='euclidean'):
+        """
+        Returns the results for the clusters get_clusters returns with
+        output 'points' or 'arrays', cluster k getting label k.
+        """
+        arrays = [np.asarray(cluster, dtype=np.float64).reshape(-1, 2)
+                  for cluster in clusters]
+        coords = np.concatenate(arrays) if arrays else np.empty((0, 2))
+        labels = np.repeat(np.arange(len(arrays)), [len(a) for a in arrays])
+        return cls(coords, labels, epsilon, metric=metric)
+
+    @staticmethod
+    def _bucket(rows, space, cell_size):
+        """
+        Returns a dictionary mapping each grid cell (a tuple of ints) to the
+        array of rows whose points in space fall in it.
+        """
+        cells = np.floor(space / cell_size).astype(np.int64)
+        if not len(rows):
+            return {}
+        unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        splits = np.searchsorted(inverse[order], np.arange(1, len(unique)))
+        return {tuple(cell): rows[group] for cell, group in
+                zip(unique.tolist(), np.split(order, splits))}
+
+    def __len__(self):
+        return len(self.summaries)
+
+    def __getitem__(self, label):
+        return self.summaries[label]
+
+    def _position(self, point):
+        """
+        Returns point as a (1, 2) array and its position in the event grid's
+        space.
+        """
+        point = np.asarray(point, dtype=np.float64).reshape(1, 2)
+        return point, (sphere_coords(point) if self.metric == 'haversine'
+                       else point)[0]
+
+    def _rows_near(self, position, radius, cells=None):
+        """
+        Returns the rows in the cells of an event grid (the grid over every
+        clustered event unless cells is given) that overlap the box of
+        half-width radius (in grid space) around position, or every row in
+        the grid if that box covers more cells than there are.
+        """
+        if cells is None:
+            cells = self.cells
+        ranges = [range(math.floor((c - radius) / self.cell_size),
+                        math.floor((c + radius) / self.cell_size) + 1)
+                  for c in position]
+        if math.prod(len(r) for r in ranges) > len(cells):
+            found = list(cells.values())
+        else:
+            found = [cells[cell] for cell in itertools.product(*ranges)
+                     if cell in cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.intp)
+
+    def _grid_radius(self, radius):
+        """ Returns radius in the units of the event grid. """
+        return chord_length(radius) if self.metric == 'haversine' else radius
+
+    def within(self, point, radius):
+        """
+        Returns the sorted labels of the clusters with at least one event
+        within radius of point.
+        """
+        point, position = self._position(point)
+        rows = self._rows_near(position, self._grid_radius(radius))
+        close = self.distance(self.coords[rows], np.repeat(point, len(rows), 0)) <= radius
+        return np.unique(self.labels[rows[close]]).tolist()
+
+    def nearest(self, point, max_distance=math.inf):
+        """
+        Returns (label, distance) for the cluster with the event nearest to
+        point, or (NOISE, inf) if there is none within max_distance. The
+        search starts with the cells within epsilon and doubles the radius
+        until an event turns up within it, so a query near a cluster only
+        looks at a few cells.
+        """
+        return self._nearest(point, max_distance, self.clustered, self.cells)
+
+    def _nearest(self, point, max_distance, events, cells):
+        """
+        nearest, among the rows events only, which cells buckets in the
+        event grid.
+        """
+        point, position = self._position(point)
+        radius = self.epsilon
+        while len(events):
+            limit = min(radius, max_distance)
+            rows = self._rows_near(position, self._grid_radius(limit), cells)
+            if len(rows):
+                distances = self.distance(self.coords[rows],
+                                          np.repeat(point, len(rows), 0))
+                best = int(np.argmin(distances))
+                # Every event within limit is among rows, and so is every
+                # event at all once the search has spread over the grid.
+                if distances[best] <= limit or (len(rows) == len(events)
+                                                and distances[best] <= max_distance):
+                    return int(self.labels[rows[best]]), float(distances[best])
+                if len(rows) == len(events):
+                    break
+            if limit >= max_distance:
+                break
+            radius *= 2
+        return NOISE, math.inf
+
+    def label_of(self, point):
+        """
+        Returns the label a new event at point would join: the cluster of
+        the nearest core event within epsilon, or NOISE. Border events are
+        left out, as they do not grow their clusters. Raises ValueError if
+        the results were made without core.
+        """
+        if self.core is None:
+            raise ValueError("label_of needs the core flags of the events")
+        return self._nearest(point, self.epsilon, self.core, self.core_cells)[0]
+
+    def _lon_ranges(self, box):
+        """
+        Returns the (low, high) longitude ranges box covers. With
+        'haversine' they lie between -180 and 180, and there are two of
+        them when box crosses the antimeridian, either with min_lon >
+        max_lon or with longitudes beyond -180 or 180.
+        """
+        if self.metric != 'haversine':
+            return [(box[0], box[2])]
+        width = box[2] - box[0] + 360 * (box[2] < box[0])
+        if width >= 360:
+            return [(-180.0, 180.0)]
+        low = (box[0] + 180) % 360 - 180
+        high = low + width
+        if high <= 180:
+            return [(low, high)]
+        return [(low, 180.0), (-180.0, high - 360)]
+
+    def _box_cells(self, box):
+        """
+        Returns the cells of the bounding box grid that box, a (min_lon,
+        min_lat, max_lon, max_lat) tuple, overlaps.
+        """
+        size = self.box_size
+        lats = range(math.floor(box[1] / size), math.floor(box[3] / size) + 1)
+        return itertools.chain.from_iterable(
+            itertools.product(range(math.floor(low / size),
+                                    math.floor(high / size) + 1), lats)
+            for low, high in self._lon_ranges(box))
+
+    def intersecting(self, box):
+        """
+        Returns the sorted labels of the clusters whose bounding boxes
+        intersect box, a (min_lon, min_lat, max_lon, max_lat) tuple, which
+        with 'haversine' crosses the antimeridian if min_lon > max_lon.
+        """
+        size = self.box_size
+        cells = (sum(math.floor(high / size) - math.floor(low / size) + 1
+                     for low, high in self._lon_ranges(box))
+                 * (math.floor(box[3] / size) - math.floor(box[1] / size) + 1))
+        if cells > len(self.box_cells):
+            candidates = np.arange(len(self.boxes))
+        else:
+            candidates = np.array(sorted({label for cell in self._box_cells(box)
+                                          for label in self.box_cells.get(cell, ())}),
+                                  dtype=np.intp)
+        boxes = self.boxes[candidates]
+        # A box across the antimeridian covers [min_lon, 180] and
+        # [-180, max_lon], so it meets a range reaching either part.
+        wrapped = boxes[:, 0] > boxes[:, 2]
+        lon_hit = np.zeros(len(boxes), dtype=bool)
+        for low, high in self._lon_ranges(box):
+            west, east = boxes[:, 0] <= high, boxes[:, 2] >= low
+            lon_hit |= np.where(wrapped, west | east, west & east)
+        hit = lon_hit & (boxes[:, 1] <= box[3]) & (boxes[:, 3] >= box[1])
+        return candidates[hit].tolist()
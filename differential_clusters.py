@@ -0,0 +1,353 @@
+"""
+Module: differential_clusters
+
+Checks that other dbscan engines give the same clusters as the reference
+one, dbscan_array(..., standard=True), on the bundled catalogs and on
+random synthetic ones. The numbers an engine gives its clusters, and
+which of several touching clusters a border point joins, are allowed to
+differ; core points, noise and the grouping of core points are not.
+The engines that follow the serial order of the original dbscan are
+checked row for row against a plain Python copy of it instead.
+
+Run
+python3 differential_clusters.py --seeds 20
+from the command line to check every engine in ENGINES and
+SERIAL_ENGINES, or
+python3 differential_clusters.py --engines dbscan_parallel dbscan
+to check only some of them.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from earthquake_clusters import (DISTANCES, NOISE, UNVISITED, LabelStore,
+                                 catalog_locations, dbscan, dbscan_array,
+                                 neighbor_graph)
+from hierarchical_clusters import ClusterHierarchy
+from incremental_clusters import IncrementalClusterer
+from parallel_clusters import dbscan_parallel
+
+
+def _reference(coords, epsilon, min_pts, metric):
+    return dbscan_array(coords, epsilon, min_pts, metric=metric, standard=True)
+
+def _pure_python(coords, epsilon, min_pts, metric):
+    """
+    The dbscan of the original module, get_close_points and add_to_cluster
+    included, written out again over the rows of coords (so repeated
+    points stay apart) with the recursion on an explicit stack. Every
+    query checks every unlabeled row with the plain distance function, so
+    it shares no code with the engines it checks. Like the original, it
+    leaves a seed UNVISITED when none of its close points turns out to be
+    a core point.
+    """
+    distance_between = DISTANCES[metric]
+    points = [tuple(point) for point in coords.tolist()]
+    data = dict.fromkeys(range(len(points)))
+
+    def get_close_points(p):
+        close = []
+        for point in data:
+            if data[point] == None and point != p:
+                if distance_between(points[p], points[point]) <= epsilon:
+                    close.append(point)
+        return close
+
+    def add_to_cluster(close_points, cluster_num):
+        stack = [iter(close_points)]
+        while stack:
+            for point in stack[-1]:
+                if data[point] == None or data[point] == NOISE:
+                    data[point] = cluster_num
+                    close_points = get_close_points(point)
+                    if len(close_points) + 1 >= min_pts:
+                        stack.append(iter(close_points))
+                        break
+            else:
+                stack.pop()
+
+    cluster_num = 0
+    for point in data:
+        if data[point] == None:
+            close_points = get_close_points(point)
+            if len(close_points) + 1 >= min_pts:
+                add_to_cluster(close_points, cluster_num)
+                cluster_num += 1
+            else:
+                data[point] = NOISE
+    return np.array([UNVISITED if label == None else label
+                     for label in data.values()], dtype=np.int64)
+
+def _dbscan(coords, epsilon, min_pts, metric):
+    store = LabelStore(coords)
+    dbscan(store, epsilon, min_pts, metric)
+    return store.labels
+
+def _serial(coords, epsilon, min_pts, metric):
+    return dbscan_array(coords, epsilon, min_pts, metric=metric)
+
+def _parallel(coords, epsilon, min_pts, metric):
+    # Many small tiles, so most clusters cross a tile edge.
+    return dbscan_parallel(coords, epsilon, min_pts, workers=2, tiles=13,
+                           metric=metric)
+
+def _hierarchy(coords, epsilon, min_pts, metric):
+    hierarchy = ClusterHierarchy(coords, min_pts, epsilon, metric=metric)
+    return hierarchy.cut(epsilon), hierarchy.core_distances <= epsilon
+
+def _incremental(coords, epsilon, min_pts, metric):
+    clusterer = IncrementalClusterer(epsilon, min_pts, metric)
+    events = clusterer.insert([tuple(point) for point in coords.tolist()])
+    core = np.array([clusterer.is_core(event) for event in events], dtype=bool)
+    return clusterer.to_store().labels, core
+
+# Every engine takes (coords, epsilon, min_pts, metric) and returns the
+# labels of the rows of coords, or (labels, core) if it can tell which
+# points it took for core points.
+ENGINES = {
+    'dbscan_array': _reference,
+    'dbscan_parallel': _parallel,
+    'hierarchy': _hierarchy,
+    'incremental': _incremental,
+}
+
+# The serial engines only count unvisited neighbors, so their core points
+# are not the textbook ones; they must give exactly the labels of
+# _pure_python instead.
+SERIAL_ENGINES = {
+    'dbscan': _dbscan,
+    'dbscan_array_serial': _serial,
+}
+
+class LabelComparison:
+    """
+    How the labels of an engine (candidate) differ from the reference
+    labels of the same points, given the textbook core points (core, a
+    boolean array) and the neighbor graph (indptr, indices) they come
+    from. Each field is a sorted array of row numbers, or a list of
+    labels for the cluster fields:
+
+        core_mismatch   rows the engine says are core and the reference
+                        says are not, or the other way around (only when
+                        the engine reports its core points), plus core
+                        rows the engine labels NOISE
+        noise_mismatch  rows that are NOISE in one labeling only, or
+                        left unlabeled in one labeling only
+        split           reference clusters whose core points are spread
+                        over several candidate clusters
+        merged          candidate clusters whose core points come from
+                        several reference clusters
+        border          border rows in another cluster than in the
+                        reference, which is allowed when they touch both
+        invalid_border  the rows of border whose candidate cluster has no
+                        core point within epsilon of them
+
+    equivalent is True when only border rows differ, and only in allowed
+    ways; identical is True when nothing differs at all.
+    """
+
+    def __init__(self, reference, candidate, core, indptr, indices,
+                 candidate_core=None):
+        reference = np.asarray(reference).astype(np.int64)
+        candidate = np.asarray(candidate).astype(np.int64)
+        if reference.shape != candidate.shape:
+            raise ValueError("the labelings must have the same length")
+        n = len(reference)
+        if candidate_core is None:
+            wrong_core = np.zeros(n, dtype=bool)
+        else:
+            wrong_core = np.asarray(candidate_core, dtype=bool) != core
+        self.core_mismatch = np.flatnonzero(wrong_core | (core & (candidate < 0)))
+        self.noise_mismatch = np.flatnonzero(
+            ((reference == NOISE) != (candidate == NOISE))
+            | ((reference < NOISE) != (candidate < NOISE)))
+
+        # Core points pair every reference cluster with candidate clusters.
+        both = core & (reference >= 0) & (candidate >= 0)
+        pairs = np.unique(np.column_stack((reference[both], candidate[both])),
+                          axis=0).reshape(-1, 2)
+        ref_ids, ref_counts = np.unique(pairs[:, 0], return_counts=True)
+        cand_ids, cand_counts = np.unique(pairs[:, 1], return_counts=True)
+        self.split = ref_ids[ref_counts > 1].tolist()
+        self.merged = cand_ids[cand_counts > 1].tolist()
+        matching = dict(pairs.tolist())
+
+        # Border points only have to agree up to the renumbering.
+        border = np.flatnonzero(~core & (reference >= 0) & (candidate >= 0))
+        expected = np.array([matching.get(label, -3) for label in
+                             reference[border].tolist()], dtype=np.int64)
+        self.border = border[candidate[border] != expected]
+        invalid = []
+        for row in self.border.tolist():
+            neighbors = indices[indptr[row]:indptr[row + 1]]
+            touching = candidate[neighbors[core[neighbors]]]
+            if not (touching == candidate[row]).any():
+                invalid.append(row)
+        self.invalid_border = np.array(invalid, dtype=np.intp)
+
+    @property
+    def equivalent(self):
+        return not (len(self.core_mismatch) or len(self.noise_mismatch)
+                    or self.split or self.merged or len(self.invalid_border))
+
+    @property
+    def identical(self):
+        return self.equivalent and not len(self.border)
+
+    def summary(self):
+        """
+        Returns a dictionary with the number of rows or clusters in each
+        field.
+        """
+        return {'core_mismatch': len(self.core_mismatch),
+                'noise_mismatch': len(self.noise_mismatch),
+                'split': len(self.split), 'merged': len(self.merged),
+                'border': len(self.border),
+                'invalid_border': len(self.invalid_border)}
+
+    def __repr__(self):
+        return "LabelComparison(%s)" % ", ".join(
+            "%s=%d" % item for item in self.summary().items())
+
+def compare_engine(engine, coords, epsilon, min_pts, metric='euclidean',
+                   reference=_reference):
+    """
+    Runs engine and reference (functions like those in ENGINES) on the
+    (n, 2) array coords and returns the LabelComparison of their labels.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    indptr, indices = neighbor_graph(coords, epsilon, metric=metric)
+    core = np.diff(indptr) + 1 >= min_pts
+    expected = reference(coords, epsilon, min_pts, metric)
+    if isinstance(expected, tuple):
+        expected = expected[0]
+    result = engine(coords, epsilon, min_pts, metric)
+    labels, candidate_core = result if isinstance(result, tuple) else (result, None)
+    return LabelComparison(expected, labels, core, indptr, indices,
+                           candidate_core)
+
+def compare_serial(engine, coords, epsilon, min_pts, metric='euclidean',
+                   expected=None):
+    """
+    Runs engine (a function like those in SERIAL_ENGINES) and _pure_python
+    on the (n, 2) array coords, unless expected already holds the labels
+    _pure_python gives, and returns the LabelComparison of their labels
+    with every clustered row taken for a core point, so that it is only
+    identical when the engine puts every row in the same cluster (up to
+    the numbers of the clusters).
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if expected is None:
+        expected = _pure_python(coords, epsilon, min_pts, metric)
+    labels = engine(coords, epsilon, min_pts, metric)
+    return LabelComparison(expected, labels, expected >= 0,
+                           np.zeros(len(coords) + 1, dtype=np.intp),
+                           np.empty(0, dtype=np.intp))
+
+def synthetic_catalog(seed, n=None):
+    """
+    Returns (coords, epsilon, min_pts, metric) for a random catalog of n
+    points (a few hundred to a couple of thousand by default), all drawn
+    from numpy's generator with seed, so a failing seed can be run again.
+    The catalogs are made to hit the awkward cases: tight swarms, thin
+    chains that only just connect, repeated coordinates, points on grid
+    cell edges, and with 'haversine' points next to the poles and on
+    both sides of the antimeridian.
+    """
+    rng = np.random.default_rng(seed)
+    n = n or int(rng.integers(200, 2000))
+    metric = 'haversine' if seed % 3 == 2 else 'euclidean'
+    epsilon = float(rng.choice([0.5, 1.0, 2.0])) * (100 if metric == 'haversine' else 1)
+    step = epsilon / 111.0 if metric == 'haversine' else epsilon
+    min_pts = int(rng.integers(2, 8))
+    parts = [np.column_stack((rng.uniform(-180, 180, n // 4),
+                              rng.uniform(-90, 90, n // 4)))]
+    for _ in range(int(rng.integers(3, 10))):
+        center = rng.uniform((-180, -80), (180, 80))
+        size = int(rng.integers(5, n // 8 + 6))
+        parts.append(center + rng.normal(0, step * rng.uniform(0.3, 3), (size, 2)))
+    start = rng.uniform((-170, -60), (170, 60))
+    angle = rng.uniform(0, 2 * np.pi)
+    along = np.arange(int(rng.integers(5, 30)))[:, None] * 0.999 * step
+    parts.append(start + along * (np.cos(angle), np.sin(angle)))
+    parts.append(np.round(rng.uniform((-180, -90), (180, 90), (n // 20, 2))
+                          / step) * step)
+    coords = np.concatenate(parts)
+    repeats = rng.integers(0, len(coords), n // 20)
+    coords = np.concatenate((coords, coords[repeats]))
+    if metric == 'haversine':
+        coords = np.concatenate((coords, np.column_stack((
+            rng.choice([-179.9, 179.9], 20), rng.uniform(-10, 10, 20))),
+            np.column_stack((rng.uniform(-180, 180, 10), np.full(10, 89.95)))))
+    else:
+        coords[:, 0] = np.clip(coords[:, 0], -180, 180)
+    coords[:, 1] = np.clip(coords[:, 1], -90, 90)
+    return coords[rng.permutation(len(coords))], epsilon, min_pts, metric
+
+def cases(seeds=range(10), catalogs=('eq_day.csv', 'eq_week.csv')):
+    """
+    Yields (name, coords, epsilon, min_pts, metric) for the bundled
+    catalogs (found next to this module), each with a euclidean and a
+    haversine setting, and for synthetic_catalog(seed) for each seed.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    for catalog in catalogs:
+        coords = catalog_locations(os.path.join(here, catalog))
+        yield catalog, coords, 2.0, 4, 'euclidean'
+        yield catalog, coords, 200.0, 4, 'haversine'
+    for seed in seeds:
+        yield ('synthetic-%d' % seed,) + synthetic_catalog(seed)
+
+def run_differential(engines=None, seeds=range(10),
+                     catalogs=('eq_day.csv', 'eq_week.csv')):
+    """
+    Compares every engine in engines (a dictionary of name to function,
+    by default ENGINES but the reference and SERIAL_ENGINES) with its
+    reference on every case, with compare_serial for the engines in
+    SERIAL_ENGINES and compare_engine for the others, and returns a list
+    of (case name, engine name, LabelComparison).
+    """
+    if engines is None:
+        engines = {name: engine for name, engine in ENGINES.items()
+                   if engine is not _reference}
+        engines.update(SERIAL_ENGINES)
+    serial = set(SERIAL_ENGINES.values())
+    results = []
+    for name, coords, epsilon, min_pts, metric in cases(seeds, catalogs):
+        expected = None
+        for engine_name, engine in engines.items():
+            if engine in serial:
+                if expected is None:
+                    expected = _pure_python(coords, epsilon, min_pts, metric)
+                comparison = compare_serial(engine, coords, epsilon, min_pts,
+                                            metric, expected)
+            else:
+                comparison = compare_engine(engine, coords, epsilon, min_pts,
+                                            metric)
+            results.append((name, engine_name, comparison))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument('--engines', nargs='+',
+                        choices=sorted(ENGINES) + sorted(SERIAL_ENGINES),
+                        help="engines to check (default all)")
+    parser.add_argument('--seeds', type=int, default=10,
+                        help="number of synthetic catalogs (default 10)")
+    args = parser.parse_args()
+
+    engines = None
+    if args.engines:
+        engines = {name: ENGINES.get(name, SERIAL_ENGINES.get(name))
+                   for name in args.engines}
+    failed = 0
+    for name, engine, comparison in run_differential(engines, range(args.seeds)):
+        status = ('identical' if comparison.identical else
+                  'equivalent' if comparison.equivalent else 'DIFFERENT')
+        failed += not comparison.equivalent
+        print("%-16s %-16s %-10s %r" % (name, engine, status, comparison))
+    sys.exit(1 if failed else 0)
@@ -9,11 +9,21 @@ Authors:
 3) Josue Bautista - josuebautista@sandiego.edu
 """
 
+import os
 import sys
+import glob
+import time
+import argparse
 import math
-import matplotlib.pyplot as pp
-import imageio
+import itertools
+import functools
+import collections.abc
+import contextlib
+import mmap
+import struct
+import numpy as np
 import csv
+from concurrent.futures import ProcessPoolExecutor
 
 
 def euclidean_distance(point1, point2):
@@ -23,58 +33,1256 @@ def euclidean_distance(point1, point2):
     """
     return math.sqrt(((point2[0]-point1[0])**2) + (point2[1]-point1[1])**2)
 
-def get_close_points(p, epsilon, data):
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_distance(point1, point2):
+    """
+    Returns the great-circle distance in kilometers between point1 and point2.
+    point1 and point2 are (longitude, latitude) tuples in degrees.
+    """
+    lon1, lat1 = math.radians(point1[0]), math.radians(point1[1])
+    lon2, lat2 = math.radians(point2[0]), math.radians(point2[1])
+    a = (math.sin((lat2-lat1)/2)**2
+         + math.cos(lat1)*math.cos(lat2)*math.sin((lon2-lon1)/2)**2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+DISTANCES = {'euclidean': euclidean_distance, 'haversine': haversine_distance}
+
+def sphere_point(point):
+    """
+    Returns the (x, y, z) position in kilometers of the (longitude, latitude)
+    point on a sphere the size of the Earth. Points that are close on the
+    globe are close in this space too, including across the antimeridian.
+    """
+    lon, lat = math.radians(point[0]), math.radians(point[1])
+    return (EARTH_RADIUS_KM * math.cos(lat) * math.cos(lon),
+            EARTH_RADIUS_KM * math.cos(lat) * math.sin(lon),
+            EARTH_RADIUS_KM * math.sin(lat))
+
+def chord_length(distance):
+    """
+    Returns the straight-line distance through the Earth between two points
+    that are distance kilometers apart along its surface.
+    """
+    angle = min(max(distance, 0.0) / EARTH_RADIUS_KM, math.pi)
+    return 2 * EARTH_RADIUS_KM * math.sin(angle / 2)
+
+def check_metric(metric):
+    """
+    Raises a ValueError if metric is not one of the supported distances.
+    """
+    if metric not in DISTANCES:
+        raise ValueError("unknown metric %r, expected one of %s"
+                         % (metric, ", ".join(sorted(DISTANCES))))
+
+class GridIndex:
+    """
+    A uniform grid over the points of a dataset, used to answer the range
+    queries made by get_close_points without scanning every point.
+    Each point is bucketed into a cell of width cell_size along every axis,
+    so a query only has to look at the cells that overlap its search box.
+    Points are also remembered by their position in data so that queries
+    can return them in the same order as a full scan would.
+    With metric 'haversine' the grid is laid over the points' positions on
+    the globe (see sphere_point) and cell_size and epsilon are kilometers.
+    """
+
+    def __init__(self, data, cell_size, metric='euclidean'):
+        if cell_size <= 0:
+            raise ValueError("cell_size must be positive")
+        check_metric(metric)
+        self.cell_size = cell_size
+        self.metric = metric
+        self.cells = {}
+        self.order = {}
+        for point in data:
+            self.order[point] = len(self.order)
+            self.cells.setdefault(self.cell_of(point), []).append(point)
+
+    def cell_of(self, point):
+        """
+        Returns the grid cell (a tuple of ints) that contains point.
+        """
+        if self.metric == 'haversine':
+            point = sphere_point(point)
+        return tuple(math.floor(c / self.cell_size) for c in point)
+
+    def cell_range(self, value, epsilon):
+        """
+        Returns the range of cell numbers along one axis that may hold a
+        coordinate within epsilon of value. The bounds are padded a little
+        so that floating point rounding never drops a point on the boundary.
+        """
+        low = (value - epsilon) / self.cell_size
+        high = (value + epsilon) / self.cell_size
+        low = math.floor(low - 1e-9 * (1 + abs(low)))
+        high = math.floor(high + 1e-9 * (1 + abs(high)))
+        return range(low, high + 1)
+
+    def cells_near(self, p, epsilon):
+        """
+        Returns an iterator over the grid cells that overlap the box of
+        half-width epsilon around p, whether or not they hold any points.
+        """
+        if self.metric == 'haversine':
+            p, epsilon = sphere_point(p), chord_length(epsilon)
+        return itertools.product(*(self.cell_range(c, epsilon) for c in p))
+
+    def candidates(self, p, epsilon):
+        """
+        Returns every indexed point in a cell that overlaps the box of
+        half-width epsilon around p, in the order they appear in data.
+        """
+        found = []
+        for cell in self.cells_near(p, epsilon):
+            found.extend(self.cells.get(cell, ()))
+        found.sort(key=self.order.__getitem__)
+        return found
+
+
+class DbscanStats:
+    """
+    Counters and timings collected by a dbscan run when one of these is
+    passed as its stats argument; runs without one do none of this work.
+    seconds maps each stage (see STAGES) to the wall time spent in it.
+    range_queries counts neighborhood searches and distance_evaluations
+    the distances computed to answer them. core_points, border_points and
+    noise_points count the points of each kind once labeling is done, and
+    max_queue_depth is the deepest the stack of pending lists grew while a
+    cluster was expanded (0 for standard=True, which has no such stack).
+    In the order-dependent mode a core point is one that had enough
+    unvisited neighbors when it was reached.
+    If callback is given, it is called with the stats when a run ends.
+    The counts are only meaningful for one run, so use a new one for each.
+    """
+
+    STAGES = ('parse', 'convert', 'neighbor_graph', 'labeling', 'write_back')
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.seconds = {}
+        self.range_queries = 0
+        self.distance_evaluations = 0
+        self.core_points = 0
+        self.border_points = 0
+        self.noise_points = 0
+        self.max_queue_depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Adds the time spent in the body of a with statement to seconds[name].
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.seconds[name] = (self.seconds.get(name, 0.0)
+                                  + time.perf_counter() - start)
+
+    def count_labels(self, labels):
+        """
+        Sets border_points and noise_points from an array of final labels,
+        once core_points has been counted.
+        """
+        labels = np.asarray(labels)
+        self.border_points = int(np.count_nonzero(labels >= 0)) - self.core_points
+        self.noise_points = int(np.count_nonzero(labels == NOISE))
+
+    def emit(self):
+        """
+        Calls the callback, if there is one, with these stats.
+        """
+        if self.callback is not None:
+            self.callback(self)
+
+    def as_dict(self):
+        """
+        Returns the stats as a dictionary that can be saved as JSON.
+        """
+        return {'seconds': dict(self.seconds),
+                'range_queries': self.range_queries,
+                'distance_evaluations': self.distance_evaluations,
+                'core_points': self.core_points,
+                'border_points': self.border_points,
+                'noise_points': self.noise_points,
+                'max_queue_depth': self.max_queue_depth}
+
+    def __repr__(self):
+        return "DbscanStats(%s)" % ", ".join(
+            "%s=%r" % item for item in self.as_dict().items())
+
+def _stage(stats, name):
+    """
+    Returns stats.stage(name), or a context that does nothing when stats
+    is None.
+    """
+    return contextlib.nullcontext() if stats is None else stats.stage(name)
+
+
+def get_close_points(p, epsilon, data, index=None, metric='euclidean',
+                     stats=None):
     """
     Returns a list of all the points in the dataset data 
     that are the within epsilon of p.
+    If index (a GridIndex built over data) is given, only the points in
+    the grid cells around p are checked instead of the whole dataset.
+    metric is a key of DISTANCES; for 'haversine', epsilon is in kilometers.
+    The query and the distances it computes are counted in stats, a
+    DbscanStats, if one is given.
 	"""
+    check_metric(metric)
+    distance_between = DISTANCES[metric]
+    candidates = [point for point in
+                  (data if index is None else index.candidates(p, epsilon))
+                  if data[point] == None and point != p]
     points = []
-    for point in data:
-        if data[point] == None and point != p:
-            distance = euclidean_distance(p,point)
-            if distance <= epsilon:
-                points.append(point)
+    for point in candidates:
+        distance = distance_between(p,point)
+        if distance <= epsilon:
+            points.append(point)
+    if stats is not None:
+        stats.range_queries += 1
+        stats.distance_evaluations += len(candidates)
     return points
 
-def add_to_cluster(points, cluster_num, data, epsilon, min_pts):
+def add_to_cluster(points, cluster_num, data, epsilon, min_pts, index=None,
+                   metric='euclidean', stats=None):
     """
     This function loops through all of the given points and sees if they can be added 
     to the cluster with number cluster_num.
     If a point in points is  labeled as an outlier/noise (value is -1), it is ignored
+    Instead of recursing, the lists of close points still to be visited are
+    kept on an explicit stack, so a cluster can grow to any size without
+    hitting the recursion limit. A point is only expanded the first time it
+    is reached; once labeled it is skipped wherever else it was queued.
+    The queries, core points and stack depth are counted in stats, a
+    DbscanStats, if one is given.
     """
-    for point in points:
-        if data[point] == None or data[point] == -1:
-            data[point] = cluster_num
-            close_points = get_close_points(point,epsilon,data)
-            if len(close_points) + 1 >= min_pts:
-                add_to_cluster(close_points,cluster_num,data,epsilon,min_pts)
+    stack = [iter(points)]
+    while stack:
+        for point in stack[-1]:
+            if data[point] == None or data[point] == -1:
+                data[point] = cluster_num
+                close_points = get_close_points(point,epsilon,data,index,metric,
+                                                stats)
+                if len(close_points) + 1 >= min_pts:
+                    stack.append(iter(close_points))
+                    if stats is not None:
+                        stats.core_points += 1
+                        stats.max_queue_depth = max(stats.max_queue_depth,
+                                                    len(stack))
+                    break
+        else:
+            stack.pop()
+
+UNVISITED = -2
+NOISE = -1
 
-def dbscan(data, epsilon, min_pts):
+def sphere_coords(coords):
     """
-    As we loop through all points in our data, if the point hasn't been assigned a cluster, 
-    we use close_points and add_to_cluster to find nearby points and to assign them to a cluster.
-    Afterwards, we find a new set of points to assign. Outliers are ignored. 
+    The array version of sphere_point: returns the (n, 3) positions in
+    kilometers of the (n, 2) array of (longitude, latitude) rows in coords.
+    """
+    lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    return EARTH_RADIUS_KM * np.column_stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+def _euclidean_rows(points1, points2):
+    """
+    Returns the euclidean distance between each row of points1 and the
+    matching row of points2, summed in the same order as euclidean_distance.
     """
+    return np.sqrt(sum((points2[:, k] - points1[:, k])**2
+                       for k in range(points1.shape[1])))
+
+def _haversine_rows(points1, points2):
+    """
+    Returns the great-circle distance in kilometers between each row of
+    points1 and the matching row of points2, like haversine_distance.
+    """
+    lon1, lat1 = np.radians(points1[:, 0]), np.radians(points1[:, 1])
+    lon2, lat2 = np.radians(points2[:, 0]), np.radians(points2[:, 1])
+    a = (np.sin((lat2-lat1)/2)**2
+         + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+ROW_DISTANCES = {'euclidean': _euclidean_rows, 'haversine': _haversine_rows}
+
+def _candidate_pairs(points, radius, block_size):
+    """
+    Yields batches (i, j) of row numbers of the pairs of points, an (n, d)
+    float array, that share a grid cell or sit in adjacent cells, when the
+    cells are at least radius wide. Every pair closer than radius is in
+    some batch, and no batch holds more than block_size**2 pairs.
+    """
+    n, dims = points.shape
+    span = float(np.ptp(points, axis=0).max()) if n else 0.0
+    # Cells are never smaller than radius, and never so small that the
+    # cell numbers could overflow an int64 key.
+    cell_size = max(radius * (1 + 1e-9), span / 2**(60 // dims - 2)) or 1.0
+    cells = np.floor(points / cell_size).astype(np.int64)
+    if n:
+        cells -= cells.min(axis=0) - 1
+    widths = cells.max(axis=0, initial=0) + 2
+    strides = np.ones(dims, dtype=np.int64)
+    for k in range(dims - 2, -1, -1):
+        strides[k] = strides[k + 1] * widths[k + 1]
+    keys = cells @ strides
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    offsets = np.array([np.dot(offset, strides) for offset in
+                        itertools.product((-1, 0, 1), repeat=dims)])
+    max_pairs = block_size * block_size
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        targets = keys[start:stop, None] + offsets
+        low = np.searchsorted(keys, targets, 'left').ravel()
+        counts = np.searchsorted(keys, targets, 'right').ravel() - low
+        owner = np.repeat(np.arange(start, stop), len(offsets))
+        total = np.cumsum(counts)
+        begin = 0
+        while begin < len(counts):
+            done = total[begin - 1] if begin else 0
+            end = max(np.searchsorted(total, done + max_pairs, 'right'), begin + 1)
+            batch = counts[begin:end]
+            i = np.repeat(owner[begin:end], batch)
+            j = (np.repeat(low[begin:end] - (np.cumsum(batch) - batch), batch)
+                 + np.arange(batch.sum()))
+            yield order[i], order[j]
+            begin = end
+
+def neighbor_graph(coords, epsilon, block_size=1024, metric='euclidean',
+                   distances=False, stats=None):
+    """
+    Returns the epsilon-neighborhoods of the points in coords, an (n, d)
+    float array, as a CSR pair (indptr, indices): the neighbors of point i
+    are indices[indptr[i]:indptr[i+1]], in increasing row order and not
+    including i itself.
+    This is the array version of GridIndex: the points are sorted by grid
+    cell, and every point is compared, with numpy, only against the points
+    in its own and the adjacent cells. Candidate pairs are produced in
+    batches of at most block_size**2, which bounds the memory used.
+    With metric 'haversine', coords are (longitude, latitude) rows, epsilon
+    is in kilometers and the grid is laid over sphere_coords(coords).
+    With distances=True a third array is returned with the distance to
+    each neighbor in indices, for use with restrict_graph.
+    Every point counts as one range query in stats, a DbscanStats, and
+    every candidate pair as one distance evaluation.
+    """
+    check_metric(metric)
+    coords = np.asarray(coords, dtype=np.float64)
+    n = len(coords)
+    if metric == 'haversine':
+        space, radius = sphere_coords(coords), chord_length(epsilon)
+    else:
+        space, radius = coords, epsilon
+    distance = ROW_DISTANCES[metric]
+    rows, cols, lengths = [], [], []
+    for i, j in _candidate_pairs(space, radius, block_size):
+        length = distance(coords[i], coords[j])
+        if stats is not None:
+            stats.distance_evaluations += len(i)
+        close = (length <= epsilon) & (i != j)
+        rows.append(i[close])
+        cols.append(j[close])
+        lengths.append(length[close])
+    if stats is not None:
+        stats.range_queries += n
+    return _to_csr(n, rows, cols, lengths if distances else None)
+
+def _to_csr(n, rows, cols, lengths=None):
+    """
+    Joins lists of arrays of edges (rows[k][m], cols[k][m]) between n
+    points into a CSR pair (indptr, indices) sorted by row and column, as
+    neighbor_graph returns it. With lengths, a list of arrays of the same
+    shapes, a third array holds the length of each edge.
+    """
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.intp)
+    sort = np.lexsort((cols, rows))
+    indices = cols[sort]
+    indptr = np.zeros(n + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    if lengths is not None:
+        lengths = np.concatenate(lengths) if lengths else np.empty(0)
+        return indptr, indices, lengths[sort]
+    return indptr, indices
+
+def spatiotemporal_graph(coords, times, epsilon, window, block_size=1024,
+                         metric='euclidean', stats=None):
+    """
+    Returns the neighbor graph, as a CSR pair like neighbor_graph, in which
+    two points are neighbors when they are within epsilon of each other
+    and their times, an array of n numbers, are at most window apart.
+    The points are sorted by time and cut into slabs window long, so a
+    point can only have neighbors in its own slab and the two next to it.
+    The grid search of neighbor_graph is then run on each slab together
+    with the following one, which only ever compares points that are close
+    in time; the longer the catalog is compared with window, the fewer
+    pairs are looked at.
+    """
+    check_metric(metric)
+    if not window > 0:
+        raise ValueError("window must be positive")
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    times = np.asarray(times, dtype=np.float64)
+    n = len(coords)
+    if len(times) != n:
+        raise ValueError("there must be one time for every point")
+    if metric == 'haversine':
+        space, radius = sphere_coords(coords), chord_length(epsilon)
+    else:
+        space, radius = coords, epsilon
+    distance = ROW_DISTANCES[metric]
+    order = np.argsort(times, kind='stable')
+    slabs = np.floor((times[order] - (times[order[0]] if n else 0)) / window)
+    starts = np.flatnonzero(np.diff(slabs, prepend=-2) != 0)
+    stops = np.append(starts[1:], n)
+    rows, cols = [], []
+    for k, (start, stop) in enumerate(zip(starts, stops)):
+        # Pair this slab with the next one only if the two are adjacent.
+        if k + 1 < len(starts) and slabs[starts[k + 1]] == slabs[start] + 1:
+            end = stops[k + 1]
+        else:
+            end = stop
+        members = order[start:end]
+        for i, j in _candidate_pairs(space[members], radius, block_size):
+            # Pairs inside the next slab are found when it has its turn.
+            keep = ((i < stop - start) | (j < stop - start)) & (i != j)
+            i, j = members[i[keep]], members[j[keep]]
+            if stats is not None:
+                stats.distance_evaluations += len(i)
+            close = np.abs(times[i] - times[j]) <= window
+            i, j = i[close], j[close]
+            close = distance(coords[i], coords[j]) <= epsilon
+            rows.append(i[close])
+            cols.append(j[close])
+    if stats is not None:
+        stats.range_queries += n
+    return _to_csr(n, rows, cols)
+
+def st_dbscan_array(coords, times, epsilon, window, min_pts, block_size=1024,
+                    metric='euclidean', standard=False, stats=None):
+    """
+    Spatio-temporal dbscan (ST-DBSCAN): clusters the (lon, lat) rows in
+    coords like dbscan_array, except that two events are only neighbors
+    when their times are also within window of each other (in the units of
+    times, seconds for the time column of load_catalog). Aftershocks of
+    one swarm are then kept apart from a later swarm on the same fault.
+    Returns the int32 label of each row.
+    """
+    label_points = _standard_labels if standard else _label_points
+    with _stage(stats, 'convert'):
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        labels = np.full(len(coords), UNVISITED, dtype=np.int32)
+    with _stage(stats, 'neighbor_graph'):
+        indptr, indices = spatiotemporal_graph(coords, times, epsilon, window,
+                                               block_size, metric, stats)
+    with _stage(stats, 'labeling'):
+        label_points(labels, indptr, indices, min_pts, stats)
+    if stats is not None:
+        stats.emit()
+    return labels
+
+def restrict_graph(indptr, indices, lengths, epsilon):
+    """
+    Cuts a neighbor graph built by neighbor_graph(..., distances=True)
+    down to the neighbors within epsilon, which must not be more than the
+    epsilon it was built with. The (indptr, indices) returned are the same
+    as neighbor_graph would give for epsilon, without searching again.
+    """
+    n = len(indptr) - 1
+    keep = lengths <= epsilon
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    new_indptr = np.zeros(n + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows[keep], minlength=n), out=new_indptr[1:])
+    return new_indptr, indices[keep]
+
+def _gather(low, counts):
+    """
+    Returns the positions low[k], low[k] + 1, ... low[k] + counts[k] - 1
+    for every k, one range after the other, as one array.
+    """
+    return (np.repeat(low - (np.cumsum(counts) - counts), counts)
+            + np.arange(int(np.sum(counts))))
+
+class _CellGrid:
+    """
+    A grid over the points of space, an (n, d) array, with cells narrow
+    enough that any two points in the same cell are within radius of each
+    other, so dbscan can search the neighborhoods it needs one at a time
+    from the sorted rows instead of building the whole neighbor graph.
+    The rows of cell c are order[start[c]:stop[c]], in increasing order,
+    cell[i] is the cell of row i, and near(c) lists the cells that may
+    hold points within radius of those in c, c itself first.
+    Distances are measured between the rows of coords with distance (a
+    ROW_DISTANCES function) and compared with epsilon, which radius is in
+    the units of space. exact is False when the cells had to be made wider
+    than that, or are so small that rounding could matter; points in the
+    same cell are then compared like any others.
+    """
+
+    def __init__(self, space, radius, coords, epsilon, distance):
+        n, dims = space.shape
+        self.n = n
+        self.coords = coords
+        self.epsilon = epsilon
+        self.distance = distance
+        span = float(np.ptp(space, axis=0).max()) if n else 0.0
+        scale = float(np.abs(space).max()) if n else 0.0
+        narrow = radius / math.sqrt(dims) * (1 - 1e-4)
+        # As in _candidate_pairs, the cell numbers must fit an int64 key.
+        side = max(narrow, span / 2**(60 // dims - 2)) or 1.0
+        self.exact = side == narrow and radius * 1e-4 > 1e-9 * (1 + scale)
+        reach = math.ceil(radius * (1 + 1e-9) / side)
+        cells = np.floor(space / side).astype(np.int64)
+        if n:
+            cells -= cells.min(axis=0) - reach
+        widths = cells.max(axis=0, initial=0) + reach + 1
+        strides = np.ones(dims, dtype=np.int64)
+        for k in range(dims - 2, -1, -1):
+            strides[k] = strides[k + 1] * widths[k + 1]
+        # The cells whose nearest corner is within radius, own cell first.
+        offsets = [offset for offset in
+                   itertools.product(range(-reach, reach + 1), repeat=dims)
+                   if sum(max(abs(o) - 1, 0)**2 for o in offset) * side**2
+                   <= (radius * (1 + 1e-9))**2]
+        offsets.sort(key=any)
+        self.offsets = np.array([np.dot(offset, strides) for offset in offsets],
+                                dtype=np.int64)
+        keys = cells @ strides
+        self.order = np.argsort(keys, kind='stable')
+        keys = keys[self.order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        self.start = np.concatenate(([0], bounds)) if n else bounds
+        self.stop = np.concatenate((bounds, [n])) if n else bounds
+        self.keys = keys[self.start]
+        self.cell = np.empty(n, dtype=np.intp)
+        self.cell[self.order] = np.repeat(np.arange(len(self.start)),
+                                          self.stop - self.start)
+        self._near = {}
+
+    def near(self, cell):
+        """
+        Returns the array of the cells around cell, itself first, that
+        hold points. The last few thousand answers are kept.
+        """
+        found = self._near.get(cell)
+        if found is None:
+            targets = self.keys[cell] + self.offsets
+            found = np.searchsorted(self.keys, targets)
+            found = found[self.keys[np.minimum(found, len(self.keys) - 1)]
+                          == targets]
+            if len(self._near) >= 4096:
+                self._near.clear()
+            self._near[cell] = found
+        return found
+
+    def within(self, rows, others, stats=None):
+        """
+        Returns which rows are within epsilon of the matching others, two
+        arrays of row numbers (or one of them a single row), counting the
+        distances in stats, a DbscanStats, if one is given.
+        """
+        if stats is not None:
+            stats.distance_evaluations += len(rows)
+        return self.distance(self.coords[rows],
+                             self.coords[np.atleast_1d(others)]) <= self.epsilon
+
+    def pairs(self, rows, block_size, keep=None):
+        """
+        Yields batches (i, j) of the pairs of a row i in rows and a row j in
+        one of the cells near i's, i's own included, no more than
+        block_size**2 of them at a time. keep, if given, is called with the
+        arrays (i, cell) of the pairs of a row and a near cell before each
+        batch, and returns which of them to go on with.
+        """
+        max_pairs = block_size * block_size
+        sizes = self.stop - self.start
+        for begin in range(0, len(rows), block_size):
+            owner = rows[begin:begin + block_size]
+            targets = self.keys[self.cell[owner]][:, None] + self.offsets
+            found = np.searchsorted(self.keys, targets)
+            hit = self.keys[np.minimum(found, len(self.keys) - 1)] == targets
+            owner = np.broadcast_to(owner[:, None], hit.shape)[hit]
+            near = found[hit]
+            while len(near):
+                if keep is not None:
+                    kept = keep(owner, near)
+                    owner, near = owner[kept], near[kept]
+                counts = sizes[near]
+                end = max(int(np.searchsorted(np.cumsum(counts), max_pairs,
+                                              'right')), 1)
+                yield (np.repeat(owner[:end], counts[:end]),
+                       self.order[_gather(self.start[near[:end]], counts[:end])])
+                owner, near = owner[end:], near[end:]
+
+def _cell_grid(coords, epsilon, metric='euclidean'):
+    """
+    Returns the _CellGrid for a dbscan run over the (lon, lat) rows of
+    coords with metric; with 'haversine' the grid is laid over
+    sphere_coords(coords), like neighbor_graph's.
+    """
+    check_metric(metric)
+    if metric == 'haversine':
+        return _CellGrid(sphere_coords(coords), chord_length(epsilon), coords,
+                         epsilon, _haversine_rows)
+    return _CellGrid(coords, epsilon, coords, epsilon, _euclidean_rows)
+
+class _GraphNeighborhoods:
+    """
+    The neighborhoods the dbscan loop of _label_points asks for, taken
+    from a precomputed neighbor graph (indptr, indices). See
+    _CellNeighborhoods for the methods.
+    """
+
+    def __init__(self, labels, indptr, indices, min_pts, weights=None):
+        self.labels = labels
+        self.indptr = indptr
+        self.indices = indices
+        self.min_pts = min_pts
+        self.weights = weights
+
+    def close_points(self, point):
+        neighbors = self.indices[self.indptr[point]:self.indptr[point + 1]]
+        close_points = neighbors[self.labels[neighbors] == UNVISITED]
+        if self.weights is None:
+            size = len(close_points) + 1
+        else:
+            size = self.weights[close_points].sum() + self.weights[point]
+        return close_points.tolist() if size >= self.min_pts else None
+
+    def labeled(self, point):
+        pass
+
+class _CellNeighborhoods:
+    """
+    The neighborhoods the dbscan loop of _label_points asks for, searched
+    in a _CellGrid only when they are asked for, so memory stays linear
+    in the number of points however dense they are. Only unvisited points
+    count, so the number left in each cell is kept, and the visited rows
+    of a cell are dropped from it once they are the most of it.
+    A neighborhood of at most SMALL candidates is searched in one go.
+    For a larger one the count stops as soon as it reaches min_pts, which
+    in exact grids a point's own cell often settles without a distance,
+    and the close points are then found in increasing order a window of
+    rows at a time (see window and _CellWalk), as the loop takes them.
+    With weights, whole neighborhoods are searched, so their weights are
+    added up in the same order as _GraphNeighborhoods does.
+    """
+
+    SMALL = 256
+    CHUNK = 4096
+    WINDOW = 32
+
+    def __init__(self, grid, labels, min_pts, stats=None, weights=None):
+        self.grid = grid
+        self.min_pts = min_pts
+        self.stats = stats
+        self.weights = weights
+        self.unvisited = labels == UNVISITED
+        self.left = np.bincount(grid.cell[self.unvisited],
+                                minlength=len(grid.start))
+        self.order = grid.order.copy()
+        self.stop = grid.stop.copy()
+        # Every row of cell c before order[head[c]] has been visited.
+        self.head = grid.start.copy()
+        # The rows of every cell ranked as cell * (n + 1) + row, so one
+        # searchsorted finds a range of rows in many cells at once; rows
+        # dropped from a cell leave rank cell * (n + 1) + n behind.
+        self.ranked = grid.cell[self.order] * (grid.n + 1) + self.order
+
+    def labeled(self, point):
+        """
+        Tells the neighborhoods that point has been given a label.
+        """
+        if not self.unvisited[point]:
+            return
+        self.unvisited[point] = False
+        cell = self.grid.cell[point]
+        self.left[cell] -= 1
+        start, stop = self.grid.start[cell], self.stop[cell]
+        if stop - start > 2 * self.left[cell] + 16:
+            rows = self.order[start:stop]
+            rows = rows[self.unvisited[rows]]
+            end = start + len(rows)
+            self.order[start:end] = rows
+            self.ranked[start:end] = cell * (self.grid.n + 1) + rows
+            self.ranked[end:stop] = cell * (self.grid.n + 1) + self.grid.n
+            self.stop[cell] = end
+            self.head[cell] = start
+
+    def _rows(self, cells, point):
+        """
+        Returns the unvisited rows of cells other than point.
+        """
+        rows = self.order[_gather(self.grid.start[cells],
+                                  self.stop[cells] - self.grid.start[cells])]
+        return rows[self.unvisited[rows] & (rows != point)]
+
+    def close_points(self, point):
+        """
+        Returns the unvisited points within epsilon of point, in increasing
+        order, when there are enough of them (or their weights are enough)
+        for point to be a core point, and None otherwise. Large
+        neighborhoods are returned as a _CellWalk.
+        """
+        grid = self.grid
+        near = grid.near(grid.cell[point])
+        if self.stats is not None:
+            self.stats.range_queries += 1
+        if (self.weights is not None or
+                np.sum(self.stop[near] - grid.start[near]) <= self.SMALL):
+            rows = self._rows(near, point)
+            close_points = np.sort(rows[grid.within(rows, point, self.stats)])
+            if self.weights is None:
+                size = len(close_points) + 1
+            else:
+                size = self.weights[close_points].sum() + self.weights[point]
+            return close_points.tolist() if size >= self.min_pts else None
+        if self._count(point, near) + 1 < self.min_pts:
+            return None
+        return _CellWalk(self, point, near)
+
+    def _count(self, point, near):
+        """
+        Counts the unvisited points within epsilon of point in the near
+        cells, stopping once there are min_pts - 1.
+        """
+        need = self.min_pts - 1
+        count = 0
+        if self.grid.exact:
+            count = self.left[near[0]] - self.unvisited[point]
+            near = near[1:]
+        near = near[self.left[near] > 0]
+        sizes = np.cumsum(self.stop[near] - self.grid.start[near])
+        begin = 0
+        while count < need and begin < len(near):
+            done = sizes[begin - 1] if begin else 0
+            end = max(int(np.searchsorted(sizes, done + self.CHUNK, 'right')),
+                      begin + 1)
+            rows = self._rows(near[begin:end], point)
+            count += int(np.count_nonzero(self.grid.within(rows, point,
+                                                           self.stats)))
+            begin = end
+        return count
+
+    def window(self, point, near, cursor, keep):
+        """
+        Returns (rows, cursor): the first keep unvisited points within
+        epsilon of point that come after row cursor, in decreasing order,
+        and the last row searched. The search takes the next WINDOW rows
+        after cursor from every near cell and goes up to the smallest row
+        at which a cell still had more; when it finds more than keep
+        points, it stops at the last one kept. The visited rows it finds
+        at the head of a cell are skipped from then on, as the loop visits
+        the rows of a dense cluster roughly in order.
+        """
+        grid = self.grid
+        n = grid.n
+        if not self.left[near].any():
+            return [], n - 1
+        head = self.head[near]
+        low = np.maximum(np.searchsorted(self.ranked, near * (n + 1) + cursor,
+                                         'right'), head)
+        counts = np.minimum(self.stop[near] - low, self.WINDOW)
+        more = low + counts < self.stop[near]
+        limit = n - 1
+        if more.any():
+            limit = int(self.order[(low + counts - 1)[more]].min())
+        taken = _gather(low, counts)
+        rows = self.order[taken]
+        unvisited = self.unvisited[rows]
+        moved = low == head
+        if moved.any():
+            # Move each head past the visited rows that lead its cell.
+            first = counts.copy()
+            np.minimum.at(first, np.repeat(np.arange(len(near)), counts)[unvisited],
+                          (taken - np.repeat(low, counts))[unvisited])
+            self.head[near[moved]] = (low + first)[moved]
+        close = unvisited & (rows != point) & (rows <= limit)
+        # Rows of the point's own cell need no distance in exact grids.
+        check = close.copy()
+        if grid.exact:
+            check[:counts[0]] = False
+        close[check] = grid.within(rows[check], point, self.stats)
+        found = np.sort(rows[close])
+        if len(found) > keep:
+            found = found[:keep]
+            limit = int(found[-1])
+        return found[::-1].tolist(), limit
+
+class _CellWalk:
+    """
+    Iterates, for _CellNeighborhoods, over the unvisited points within
+    epsilon of point in the near cells, in increasing order. Only the
+    next few points found are held, and the rest are searched for again
+    from the last one, so the deep stacks of a large cluster stay small.
+    """
+
+    __slots__ = ('neighborhoods', 'point', 'near', 'cursor', 'pending')
+
+    KEEP = 8
+
+    def __init__(self, neighborhoods, point, near):
+        self.neighborhoods = neighborhoods
+        self.point = point
+        self.near = near
+        self.cursor = -1
+        self.pending = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.pending:
+            if self.cursor >= self.neighborhoods.grid.n - 1:
+                raise StopIteration
+            self.pending, self.cursor = self.neighborhoods.window(
+                self.point, self.near, self.cursor, self.KEEP)
+        return self.pending.pop()
+
+def _expand_cluster(points, cluster_num, labels, neighborhoods, stats=None,
+                    core=None):
+    """
+    The array version of add_to_cluster: labels every unvisited or noise
+    point in points with cluster_num and goes on to the close points of
+    those that have enough unvisited neighbors, using the same explicit
+    stack of pending lists. The close points come from neighborhoods (a
+    _GraphNeighborhoods or _CellNeighborhoods), which is told of every
+    label given. The points that had enough are flagged in core, a
+    boolean array, if one is given.
+    """
+    stack = [iter(points)]
+    while stack:
+        for point in stack[-1]:
+            if labels[point] == UNVISITED or labels[point] == NOISE:
+                labels[point] = cluster_num
+                neighborhoods.labeled(point)
+                close_points = neighborhoods.close_points(point)
+                if close_points is not None:
+                    stack.append(iter(close_points))
+                    if core is not None:
+                        core[point] = True
+                    if stats is not None:
+                        stats.max_queue_depth = max(stats.max_queue_depth,
+                                                    len(stack))
+                    break
+        else:
+            stack.pop()
+
+def _label_neighborhoods(labels, neighborhoods, stats=None):
+    """
+    Runs the dbscan loop, updating labels in place, with the close points
+    of each point taken from neighborhoods (see _expand_cluster). Only
+    points that are still UNVISITED count as neighbors, just like
+    get_close_points. Returns the number of clusters created.
+    The first point of a cluster is searched again when the cluster
+    reaches it, so with stats the core points are flagged rather than
+    counted, and only the clustered ones count in the end.
+    """
+    core = None if stats is None else np.zeros(len(labels), dtype=bool)
     cluster_num = 0
-    for point in data:
-        if data[point] == None:
-            close_points = get_close_points(point, epsilon, data)
-            if len(close_points) + 1 >= min_pts:
-                add_to_cluster(close_points,cluster_num,data,epsilon,min_pts)
+    for point in range(len(labels)):
+        if labels[point] == UNVISITED:
+            close_points = neighborhoods.close_points(point)
+            if close_points is not None:
+                if stats is not None:
+                    core[point] = True
+                    stats.max_queue_depth = max(stats.max_queue_depth, 1)
+                _expand_cluster(close_points, cluster_num, labels,
+                                neighborhoods, stats, core)
                 cluster_num += 1
             else:
-                data[point] = -1
+                labels[point] = NOISE
+                neighborhoods.labeled(point)
+    if stats is not None:
+        stats.core_points += int(np.count_nonzero(core & (labels >= 0)))
+        stats.count_labels(labels)
+    return cluster_num
+
+def _label_points(labels, indptr, indices, min_pts, stats=None, weights=None):
+    """
+    Runs the dbscan loop of _label_neighborhoods over a precomputed
+    neighbor graph, updating labels in place. Returns the number of
+    clusters created.
+    With weights, min_pts is compared with the sum of the weights of a
+    point and its neighbors rather than their number.
+    """
+    return _label_neighborhoods(
+        labels, _GraphNeighborhoods(labels, indptr, indices, min_pts, weights),
+        stats)
+
+def _components(n, rows, cols):
+    """
+    Returns, for each of n nodes, the smallest node in its connected
+    component of the graph with edges (rows[k], cols[k]). Roots are hooked
+    onto smaller roots and paths are halved with numpy until nothing moves,
+    which takes a few rounds even for very long chains.
+    """
+    parent = np.arange(n)
+    while True:
+        low = np.minimum(parent[rows], parent[cols])
+        high = np.maximum(parent[rows], parent[cols])
+        moved = low != high
+        if not moved.any():
+            return parent
+        np.minimum.at(parent, high[moved], low[moved])
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+def _standard_labels(labels, indptr, indices, min_pts, stats=None,
+                     weights=None):
+    """
+    Labels the points of a precomputed neighbor graph in place the
+    textbook way: a point is a core point when it has at least min_pts
+    points (itself included) within epsilon, clusters are the connected
+    groups of core points, and every other point joins the cluster of its
+    first core neighbor or is NOISE. The result does not depend on the
+    order the points are visited in. Returns the number of clusters, which
+    are numbered in the order of their first core point.
+    With weights, a point is a core point when the weights of the points
+    within epsilon, itself included, add up to min_pts.
+    """
+    n = len(labels)
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    if weights is None:
+        core = np.diff(indptr) + 1 >= min_pts
+    else:
+        core = (np.bincount(rows, weights[indices], minlength=n)
+                + weights >= min_pts)
+    linked = core[rows] & core[indices]
+    roots = _components(n, rows[linked], indices[linked])
+    cluster_roots, cluster_ids = np.unique(roots[core], return_inverse=True)
+    labels[:] = NOISE
+    labels[core] = cluster_ids
+    border = ~core[rows] & core[indices]
+    points, first = np.unique(rows[border], return_index=True)
+    labels[points] = labels[indices[border][first]]
+    if stats is not None:
+        stats.core_points += int(np.count_nonzero(core))
+        stats.count_labels(labels)
+    return len(cluster_roots)
+
+def _find(parent, nodes):
+    """
+    Returns the roots of nodes in the forest parent, pointing the nodes
+    straight at them.
+    """
+    roots = parent[nodes]
+    while True:
+        up = parent[roots]
+        if (up == roots).all():
+            break
+        roots = up
+    parent[nodes] = roots
+    return roots
+
+def _union(parent, a, b):
+    """
+    Joins the trees of a[k] and b[k] in the forest parent for every k,
+    always hooking the larger root onto the smaller one, so every tree
+    keeps its smallest node as its root.
+    """
+    while len(a):
+        ra, rb = _find(parent, a), _find(parent, b)
+        moved = ra != rb
+        a, b, ra, rb = a[moved], b[moved], ra[moved], rb[moved]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+
+def _cell_core(grid, min_pts, block_size=1024, stats=None, weights=None):
+    """
+    Returns which points of grid, a _CellGrid, are core points the
+    textbook way (see _standard_labels). The neighbors of each point are
+    counted a batch of candidate pairs at a time, and never kept; in exact
+    grids a cell with min_pts points makes them all core points at once.
+    """
+    n = grid.n
+    if weights is None:
+        sums = np.zeros(n, dtype=np.intp)
+        full = np.zeros(n, dtype=bool)
+        if grid.exact:
+            full = (grid.stop - grid.start)[grid.cell] >= min_pts
+    else:
+        sums = np.zeros(n)
+        full = np.zeros(n, dtype=bool)
+    for i, j in grid.pairs(grid.order[~full[grid.order]], block_size):
+        close = grid.within(i, j, stats) & (i != j)
+        if weights is None:
+            np.add.at(sums, i[close], 1)
+        else:
+            np.add.at(sums, i[close], weights[j[close]])
+    if stats is not None:
+        stats.range_queries += n
+    if weights is None:
+        return full | (sums + 1 >= min_pts)
+    return sums + weights >= min_pts
+
+def _cell_standard_labels(labels, grid, min_pts, block_size=1024, stats=None,
+                          weights=None):
+    """
+    Labels the points of grid, a _CellGrid, in place exactly as
+    _standard_labels labels their neighbor graph, without building it:
+    after _cell_core, the core points are joined a batch of close pairs at
+    a time, skipping the pairs of cells already joined, and then every
+    other point looks for its first core neighbor. Memory stays linear in
+    the number of points, plus a batch of block_size**2 pairs.
+    Returns the number of clusters.
+    """
+    n = grid.n
+    core = _cell_core(grid, min_pts, block_size, stats, weights)
+    parent = np.arange(n)
+    core_rows = grid.order[core[grid.order]]
+    core_cells = grid.cell[core_rows]
+    first = np.flatnonzero(np.diff(core_cells, prepend=-1))
+    first_core = np.full(len(grid.start), -1)
+    first_core[core_cells[first]] = core_rows[first]
+    if grid.exact:
+        # Core points that share a cell are neighbors, and so is any pair
+        # of cells once one pair of their core points is.
+        parent[core_rows] = first_core[core_cells]
+
+        def keep(i, near):
+            linked = (near > grid.cell[i]) & (first_core[near] >= 0)
+            linked[linked] = (_find(parent, i[linked])
+                              != _find(parent, first_core[near[linked]]))
+            return linked
+    else:
+        def keep(i, near):
+            return (near >= grid.cell[i]) & (first_core[near] >= 0)
+    for i, j in grid.pairs(core_rows, block_size, keep):
+        pick = core[j] & ((grid.cell[i] != grid.cell[j]) | (i < j))
+        i, j = i[pick], j[pick]
+        pick = _find(parent, i) != _find(parent, j)
+        i, j = i[pick], j[pick]
+        close = grid.within(i, j, stats)
+        _union(parent, i[close], j[close])
+
+    roots = _find(parent, np.arange(n))
+    cluster_roots, cluster_ids = np.unique(roots[core], return_inverse=True)
+    labels[:] = NOISE
+    labels[core] = cluster_ids.ravel()
+    best = np.full(n, n)
+    for i, j in grid.pairs(grid.order[~core[grid.order]], block_size,
+                           lambda i, near: first_core[near] >= 0):
+        pick = core[j]
+        i, j = i[pick], j[pick]
+        close = grid.within(i, j, stats)
+        np.minimum.at(best, i[close], j[close])
+    border = np.flatnonzero(best < n)
+    labels[border] = labels[best[border]]
+    if stats is not None:
+        stats.core_points += int(np.count_nonzero(core))
+        stats.count_labels(labels)
+    return len(cluster_roots)
+
+def _cell_labels(labels, grid, min_pts, block_size=1024, standard=False,
+                 stats=None, weights=None):
+    """
+    Labels the points of grid, a _CellGrid, in place like _label_points,
+    or like _standard_labels with standard=True, and returns the number of
+    clusters.
+    """
+    if standard:
+        return _cell_standard_labels(labels, grid, min_pts, block_size, stats,
+                                     weights)
+    return _label_neighborhoods(
+        labels, _CellNeighborhoods(grid, labels, min_pts, stats, weights), stats)
+
+def dbscan_array(coords, epsilon, min_pts, block_size=1024, metric='euclidean',
+                 standard=False, stats=None):
+    """
+    Clusters the points in coords, an (n, 2) float64 array of (lon, lat)
+    rows, and returns an int32 array with the label of each row: a cluster
+    number, NOISE for outliers, or UNVISITED for the points dbscan never
+    reaches. Gives the same labels as dbscan on the equivalent dictionary.
+    With standard=True the points are labeled like _standard_labels does
+    instead, which does not depend on the order of the rows.
+    The neighborhoods are searched in a _CellGrid as they are needed, so
+    memory grows with the number of points and not with the number of
+    pairs of neighbors; block_size**2 bounds the batches of candidate
+    pairs with standard=True.
+    If stats, a DbscanStats, is given, the run is timed and counted in it.
+    """
+    with _stage(stats, 'convert'):
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        labels = np.full(len(coords), UNVISITED, dtype=np.int32)
+    with _stage(stats, 'neighbor_graph'):
+        grid = _cell_grid(coords, epsilon, metric)
+    with _stage(stats, 'labeling'):
+        _cell_labels(labels, grid, min_pts, block_size, standard, stats)
+    if stats is not None:
+        stats.emit()
+    return labels
+
+def core_points(coords, epsilon, min_pts, block_size=1024, metric='euclidean'):
+    """
+    Returns a boolean array telling which rows of coords are core points
+    in textbook DBSCAN: those with at least min_pts points, themselves
+    included, within epsilon.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    return _cell_core(_cell_grid(coords, epsilon, metric), min_pts, block_size)
+
+def hypocenter_coords(coords, depths):
+    """
+    Returns the (n, 3) positions in kilometers of the hypocenters of the
+    earthquakes with (longitude, latitude) rows coords and depths in
+    kilometers below the surface, inside a sphere the size of the Earth.
+    Missing (NaN) depths are taken to be at the surface.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    depths = np.nan_to_num(np.asarray(depths, dtype=np.float64))
+    return sphere_coords(coords) * ((EARTH_RADIUS_KM - depths)
+                                    / EARTH_RADIUS_KM)[:, None]
+
+def magnitude_weights(mags, reference=1.0):
+    """
+    Returns the weight of each earthquake with magnitude in mags when
+    clustering with hypocenter_dbscan_array: its magnitude divided by
+    reference, so an M6 counts as six M1 events and microquakes at or below
+    M0 count for nothing. Missing (NaN) magnitudes weigh 1.
+    """
+    mags = np.asarray(mags, dtype=np.float64)
+    return np.where(np.isnan(mags), 1.0, np.maximum(mags, 0.0) / reference)
+
+def hypocenter_dbscan_array(coords, depths, epsilon, min_pts, weights=None,
+                            block_size=1024, standard=False, stats=None):
+    """
+    Clusters earthquakes by the straight-line distance between their
+    hypocenters (see hypocenter_coords), with epsilon in kilometers, so a
+    shallow swarm and deep events right below it are kept apart. The
+    neighborhoods are searched in a _CellGrid in three dimensions, as
+    dbscan_array searches them in two. With weights (see magnitude_weights), a point is dense
+    enough to grow a cluster when the weights of it and its neighbors add
+    up to min_pts, instead of when there are min_pts of them.
+    Returns the int32 label of each row, as dbscan_array does.
+    """
+    with _stage(stats, 'convert'):
+        space = hypocenter_coords(coords, depths)
+        labels = np.full(len(space), UNVISITED, dtype=np.int32)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+    with _stage(stats, 'neighbor_graph'):
+        grid = _CellGrid(space, epsilon, space, epsilon, _euclidean_rows)
+    with _stage(stats, 'labeling'):
+        _cell_labels(labels, grid, min_pts, block_size, standard, stats,
+                     weights)
+    if stats is not None:
+        stats.emit()
+    return labels
+
+def dbscan_sweep(coords, epsilons, min_pts_values, block_size=1024,
+                 metric='euclidean', standard=False):
+    """
+    Runs dbscan_array on coords for every pair of an epsilon in epsilons
+    and a min_pts in min_pts_values, and returns a dictionary of
+    {(epsilon, min_pts): (number of clusters, fraction of points in no
+    cluster, labels)}, the labels being exactly those of dbscan_array.
+    The neighbor search, which is most of the cost of a run, is done only
+    once for the largest epsilon; each smaller epsilon keeps the neighbors
+    within it with restrict_graph, and each min_pts only relabels.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    label_points = _standard_labels if standard else _label_points
+    epsilons = sorted(set(epsilons), reverse=True)
+    min_pts_values = list(min_pts_values)
+    results = {}
+    if not epsilons:
+        return results
+    graph = neighbor_graph(coords, epsilons[0], block_size, metric,
+                           distances=True)
+    for epsilon in epsilons:
+        indptr, indices = restrict_graph(*graph, epsilon)
+        for min_pts in min_pts_values:
+            labels = np.full(len(coords), UNVISITED, dtype=np.int32)
+            num_clusters = label_points(labels, indptr, indices, min_pts)
+            unclustered = np.count_nonzero(labels < 0) / max(len(labels), 1)
+            results[(epsilon, min_pts)] = (num_clusters, unclustered, labels)
+    return results
+
+def dbscan(data, epsilon, min_pts, metric='euclidean', standard=False,
+           stats=None):
+    """
+    As we loop through all points in our data, if the point hasn't been assigned a cluster, 
+    we use close_points and add_to_cluster to find nearby points and to assign them to a cluster.
+    Afterwards, we find a new set of points to assign. Outliers are ignored. 
+    The work is done on arrays by the same engine as dbscan_array; the
+    labels are copied back into data when it finishes.
+    With metric='haversine', distances are great-circle distances and
+    epsilon is in kilometers.
+    A LabelStore is clustered in place row by row, so points that share
+    coordinates are counted separately.
+    standard=True labels the points with _standard_labels, ignoring any
+    labels they already had.
+    If stats, a DbscanStats, is given, the time spent in each stage and
+    the work done are recorded in it.
+    """
+    if isinstance(data, LabelStore):
+        coords, labels = data.coords, data.labels
+    else:
+        with _stage(stats, 'convert'):
+            points = list(data)
+            coords = np.array(points, dtype=np.float64).reshape(-1, 2)
+            labels = np.array([UNVISITED if data[point] == None else data[point]
+                               for point in points], dtype=np.int32)
+    with _stage(stats, 'neighbor_graph'):
+        grid = _cell_grid(coords, epsilon, metric)
+    with _stage(stats, 'labeling'):
+        cluster_num = _cell_labels(labels, grid, min_pts, standard=standard,
+                                   stats=stats)
+    if not isinstance(data, LabelStore):
+        with _stage(stats, 'write_back'):
+            for point, label in zip(points, labels.tolist()):
+                data[point] = None if label == UNVISITED else label
+    if stats is not None:
+        stats.emit()
     return cluster_num
 
-def get_clusters(data, num_clusters):
+CLUSTER_OUTPUTS = ('points', 'indices', 'arrays')
+
+def get_clusters(data, num_clusters, output='points', noise=False):
     """
     As we loop through all points in data, we create a list of clusters, a list of lists.
     Each list within the parent list is a different cluster,
+    All clusters are gathered in one pass: the labels are sorted once
+    (stably, so points keep their order in data) and cut into clusters.
+    output chooses the form of each cluster: 'points' for a list of
+    (lon, lat) tuples, 'indices' for an int array of rows (positions in
+    data), or 'arrays' for a (k, 2) float array of coordinates.
+    With noise=True, returns (clusters, noise), where noise holds the
+    points labeled -1 in the same form.
     """
-    clusters, temp_cluster = [], [] 
-    for i in range(num_clusters):
-        temp_cluster = [point for point in data if data[point] == i]
-        clusters.append(temp_cluster)
+    if output not in CLUSTER_OUTPUTS:
+        raise ValueError("unknown output %r, expected one of %s"
+                         % (output, ", ".join(CLUSTER_OUTPUTS)))
+    if isinstance(data, LabelStore):
+        labels, coords = data.labels, data.coords
+    else:
+        points = list(data)
+        labels = np.array([UNVISITED if data[point] == None else data[point]
+                           for point in points], dtype=np.int64)
+        coords = np.array(points, dtype=np.float64).reshape(-1, 2)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(NOISE, num_clusters + 1))
+
+    def convert(rows):
+        if output == 'indices':
+            return rows
+        if output == 'arrays':
+            return coords[rows]
+        if isinstance(data, LabelStore):
+            return list(map(tuple, coords[rows].tolist()))
+        return [points[row] for row in rows.tolist()]
+
+    clusters = [convert(order[bounds[i]:bounds[i + 1]])
+                for i in range(1, num_clusters + 1)]
+    if noise:
+        return clusters, convert(order[bounds[0]:bounds[1]])
     return clusters
 
 def plot_clusters(clusters):
@@ -83,41 +1291,440 @@ def plot_clusters(clusters):
     on a scatterplot. This is accomplished by storing the x,y values of each 
     cluster then using the pp.scatter method.
     """
+    import matplotlib.pyplot as pp
     lst_x, lst_y = [], []
     for lst in clusters:
         lst_x = [point[0] for point in lst]
         lst_y = [point[1] for point in lst]
         pp.scatter(lst_x, lst_y)
 
-def get_eq_locations(filename):
+WORLD_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "world-map-full.jpg")
+MAP_EXTENT = [-180, 180, -90, 90]
+
+@functools.lru_cache(maxsize=4)
+def world_map(filename=WORLD_MAP):
+    """
+    Returns the decoded image in filename, reading it only the first time
+    it is asked for.
+    """
+    import imageio
+    return imageio.imread(filename)
+
+def render_clusters(clusters, output, noise=(), background=WORLD_MAP,
+                    max_points=250000, size=(12, 6), dpi=150, seed=0):
+    """
+    Draws clusters, a list of clusters of (lon, lat) points in any form
+    get_clusters returns, over the background map and saves the picture
+    to output, whose extension (.png, .svg, .pdf...) picks the format.
+    Nothing is shown on screen, so it works without a display.
+    Every point is drawn by a single scatter call, colored by cluster in
+    the same colors plot_clusters uses, with the noise points in gray.
+    When there are more than max_points points, a random max_points of
+    them are drawn; the points are rasterized in vector formats.
+    Only matplotlib.figure is imported, never pyplot, so no GUI backend is
+    picked.
+    """
+    import matplotlib
+    import matplotlib.colors
+    from matplotlib.figure import Figure
+    groups = [np.asarray(noise, dtype=np.float64).reshape(-1, 2)]
+    groups += [np.asarray(cluster, dtype=np.float64).reshape(-1, 2)
+               for cluster in clusters]
+    coords = np.concatenate(groups)
+    which = np.repeat(np.arange(-1, len(clusters)), [len(g) for g in groups])
+    if max_points and len(coords) > max_points:
+        keep = np.random.default_rng(seed).choice(len(coords), max_points,
+                                                  replace=False)
+        keep.sort()
+        coords, which = coords[keep], which[keep]
+    palette = matplotlib.rcParams['axes.prop_cycle'].by_key()['color'] + ['gray']
+    colors = matplotlib.colors.to_rgba_array(palette)[
+        np.where(which < 0, len(palette) - 1, which % (len(palette) - 1))]
+
+    figure = Figure(figsize=size, dpi=dpi)
+    axes = figure.add_axes([0, 0, 1, 1])
+    if background:
+        axes.imshow(world_map(background), zorder=0, extent=MAP_EXTENT)
+    axes.scatter(coords[:, 0], coords[:, 1], s=4, c=colors, linewidths=0,
+                 rasterized=True)
+    axes.set_xlim(MAP_EXTENT[:2])
+    axes.set_ylim(MAP_EXTENT[2:])
+    axes.axis('off')
+    figure.savefig(output, dpi=dpi)
+
+def get_eq_locations(filename, stats=None):
     """
     We create a list of earthquake locations given a csv file
     containing data of earthquakes.
+    The longitude and latitude columns are found by name in the header and
+    read with load_catalog; rows that cannot be parsed are skipped.
+    filename may also be a binary catalog (see write_binary_catalog).
+    The time taken is added to the 'parse' stage of stats, if given.
+    """
+    with _stage(stats, 'parse'):
+        coords = catalog_locations(filename)
+    return list(map(tuple, coords.tolist()))
+
+def parse_times(values):
+    """
+    Converts a sequence of times in the USGS format
+    (2018-11-08T22:35:24.300Z), as strings or bytes, to a float64 array of
+    seconds since the epoch, raising ValueError if any of them is
+    malformed.
+    """
+    values = np.char.rstrip(np.asarray(values).astype(str), 'Z')
+    return values.astype('datetime64[ms]').astype(np.int64) / 1000.0
+
+def _parse_column(name, values):
+    """
+    Converts a sequence of strings (or bytes) from the column called name
+    to a float64 array, raising ValueError if any of them is malformed.
+    Times become seconds since the epoch (see parse_times).
+    """
+    if name == 'time':
+        return parse_times(values)
+    return np.asarray(values).astype(np.float64)
+
+def _heads(chunk, starts, width):
+    """
+    Returns an (n, width) uint8 array holding the width bytes of chunk that
+    follow each offset in starts, padded with zeros past the end of chunk.
     """
-    locations = []
-    f = open(filename, encoding = 'utf-8')
-    f.readline()
-    csv_reader = csv.reader(f, delimiter = ',')
-    for line in csv_reader:
-        point = float(line[2]),float(line[1])
-        locations.append(point)
-    return locations
+    if len(starts) and starts.max() + width > len(chunk):
+        chunk = np.concatenate((chunk, np.zeros(width, dtype=np.uint8)))
+    return np.lib.stride_tricks.sliding_window_view(chunk, width)[starts]
+
+def _field_bytes(chunk, begin, end):
+    """
+    Returns the byte strings chunk[begin[i]:end[i]] as one fixed-width
+    numpy bytes array, gathered without a Python loop.
+    """
+    width = int((end - begin).max(initial=1)) or 1
+    chars = _heads(chunk, begin, width)
+    chars[np.arange(width) >= (end - begin)[:, None]] = 0
+    return chars.view('S%d' % width).ravel()
+
+def _field_bounds(chunk, starts, lengths, last):
+    """
+    Returns, for every line, the offsets from its start of its first
+    last + 1 commas (the line length where there are fewer), the number of
+    commas found, and whether a quote appears before the last of them.
+    Only the head of each line is scanned; lines whose fields run past it
+    are rescanned with a head four times as long.
+    """
+    bounds = np.empty((len(starts), last + 1), dtype=np.intp)
+    counts = np.empty(len(starts), dtype=np.intp)
+    quoted = np.empty(len(starts), dtype=bool)
+    pending = np.arange(len(starts))
+    width = 64
+    while pending.size:
+        head = _heads(chunk, starts[pending], width)
+        inside = np.arange(width) < lengths[pending, None]
+        comma = (head == ord(',')) & inside
+        seen = np.zeros(len(pending), dtype=np.intp)
+        found = np.empty((len(pending), last + 1), dtype=np.intp)
+        everyone = np.arange(len(pending))
+        for k in range(last + 1):
+            # Take the first comma left in each head, then clear it.
+            at = comma.argmax(axis=1)
+            hit = comma[everyone, at]
+            comma[everyone, at] = False
+            seen += hit
+            found[:, k] = np.where(hit, at, lengths[pending])
+        quote = (head == ord('"')) & inside
+        first_quote = np.where(quote.any(axis=1), quote.argmax(axis=1), width)
+        done = (seen > last) | (lengths[pending] <= width)
+        rows = pending[done]
+        bounds[rows] = found[done]
+        counts[rows] = seen[done]
+        quoted[rows] = first_quote[done] < found[done, last]
+        pending = pending[~done]
+        width *= 4
+    return bounds, counts, quoted
+
+def _parse_chunk(text, columns, positions, optional=()):
+    """
+    Parses the fields at positions of every line in text, a block of whole
+    csv lines, into float64 arrays. Lines and the commas at the head of
+    each line are found with numpy, so plain lines are parsed without a
+    Python loop; only lines with a quote among the fields we need go
+    through the csv module. Returns the parsed columns and the number of
+    malformed rows dropped. A malformed value in one of the optional
+    columns becomes NaN instead of dropping its row.
+    """
+    last = max(positions)
+    if not text.endswith('\n'):
+        text += '\n'
+    chunk = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    ends = np.flatnonzero(chunk == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    bounds, counts, quoted = _field_bounds(chunk, starts, ends - starts, last)
+    plain = (counts >= last) & ~quoted
+    skipped = int(((counts < last) & ~quoted).sum())
+    parsed = []
+    bad = np.zeros(len(starts), dtype=bool)
+    for name, position in zip(columns, positions):
+        column = np.full(len(starts), np.nan)
+        begin = starts[plain] + (bounds[plain, position - 1] + 1 if position else 0)
+        values = _field_bytes(chunk, begin, starts[plain] + bounds[plain, position])
+        try:
+            column[plain] = _parse_column(name, values)
+        except ValueError:
+            for row, value in zip(np.flatnonzero(plain), values):
+                try:
+                    column[row] = _parse_column(name, [value])[0]
+                except ValueError:
+                    bad[row] = name not in optional
+        parsed.append(column)
+    for row in np.flatnonzero(quoted):
+        line = bytes(chunk[starts[row]:ends[row]]).decode('utf-8')
+        fields = next(csv.reader([line]))
+        try:
+            if len(fields) <= last:
+                raise ValueError("too few fields")
+            for column, name, position in zip(parsed, columns, positions):
+                try:
+                    column[row] = _parse_column(name, [fields[position]])[0]
+                except ValueError:
+                    if name not in optional:
+                        raise
+        except ValueError:
+            bad[row] = True
+    good = (plain | quoted) & ~bad
+    return [column[good] for column in parsed], skipped + int(bad.sum())
+
+def load_catalog(filename, columns=('longitude', 'latitude'), chunk_size=1 << 22,
+                 optional=()):
+    """
+    Reads only the named columns (any of the numeric columns such as
+    longitude, latitude, depth and mag, or time) of the csv catalog in
+    filename and returns (arrays, skipped): a dictionary mapping each name
+    to a float64 array, and the number of malformed rows that were skipped.
+    Columns are found by their name in the header row. The file is read
+    about chunk_size characters at a time, only the fields we need are cut
+    out of each chunk (see _parse_chunk), and they are converted straight
+    into arrays preallocated from the size of the file, so memory use stays
+    close to the size of the result.
+    Rows are kept when a value in one of the optional columns is missing
+    or malformed; the value is NaN.
+    """
+    with open(filename, encoding='utf-8') as f:
+        header = [name.strip() for name in next(csv.reader([f.readline()]))]
+        for name in columns:
+            if name not in header:
+                raise ValueError("column %r is not in the header of %s"
+                                 % (name, filename))
+        positions = [header.index(name) for name in columns]
+        try:
+            file_size = os.path.getsize(filename)
+        except (OSError, TypeError):
+            file_size = 0
+        arrays = [np.empty(0, dtype=np.float64) for name in columns]
+        count = skipped = consumed = 0
+        rest = ''
+        while True:
+            chunk = f.read(chunk_size)
+            consumed += len(chunk)
+            text = rest + chunk
+            if chunk:
+                cut = text.rfind('\n') + 1
+                text, rest = text[:cut], text[cut:]
+            if text:
+                parsed, bad = _parse_chunk(text, columns, positions, optional)
+                skipped += bad
+                size = len(parsed[0])
+                if count + size > len(arrays[0]):
+                    # Size the arrays for the whole file from the characters
+                    # per row seen so far, growing by half if that falls short.
+                    estimate = int(file_size / max(consumed, 1) * (count + size) * 1.05)
+                    capacity = max(estimate, (len(arrays[0]) * 3) // 2, count + size)
+                    for k, array in enumerate(arrays):
+                        arrays[k] = np.empty(capacity, dtype=np.float64)
+                        arrays[k][:count] = array[:count]
+                for array, column in zip(arrays, parsed):
+                    array[count:count + size] = column
+                count += size
+            if not chunk:
+                break
+    for array in arrays:
+        array.resize(count, refcheck=False)
+    return dict(zip(columns, arrays)), skipped
+
+BINARY_MAGIC = b'EQCATLG1'
+BINARY_HEADER = struct.Struct('<8sqq40x')
+BINARY_COLUMNS = (('depth', '<f8'), ('mag', '<f8'), ('time', '<i8'))
+
+def write_binary_catalog(filename, output, chunk_size=1 << 22):
+    """
+    Converts the USGS csv catalog in filename (the columns of eq_week.csv)
+    to the binary catalog format and saves it as output. Returns the
+    number of rows written; malformed rows are skipped as in load_catalog,
+    and a missing depth or magnitude is stored as NaN.
+    The file is a 64 byte header (BINARY_MAGIC, the number of rows n and
+    the format version) followed by fixed-width little-endian blocks: an
+    (n, 2) float64 block of (longitude, latitude) rows, then n float64
+    depths, n float64 magnitudes and n int64 times in milliseconds since
+    the epoch.
+    """
+    columns = load_catalog(filename, ('longitude', 'latitude', 'depth', 'mag',
+                                      'time'), chunk_size, ('depth', 'mag'))[0]
+    rows = len(columns['time'])
+    with open(output, 'wb') as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, rows, 1))
+        np.column_stack((columns['longitude'], columns['latitude'])).astype(
+            '<f8').tofile(f)
+        columns['time'] = np.round(columns['time'] * 1000)
+        for name, dtype in BINARY_COLUMNS:
+            columns[name].astype(dtype).tofile(f)
+    return rows
+
+def is_binary_catalog(filename):
+    """
+    Returns True if filename starts like a binary catalog.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+def open_binary_catalog(filename):
+    """
+    Maps the binary catalog in filename (see write_binary_catalog) into
+    memory and returns a dictionary of read-only numpy arrays that share
+    the mapped pages, so nothing is read until it is used: 'coords', the
+    (n, 2) float64 array dbscan_array takes, its 'longitude' and
+    'latitude' columns, and 'depth', 'mag' and 'time' (int64 milliseconds).
+    Raises ValueError if the file is not a binary catalog or is truncated.
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < BINARY_HEADER.size:
+            raise ValueError("%s is not a binary catalog" % filename)
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, rows, version = BINARY_HEADER.unpack_from(buffer)
+    if magic != BINARY_MAGIC or version != 1:
+        raise ValueError("%s is not a binary catalog" % filename)
+    if len(buffer) < BINARY_HEADER.size + rows * 40:
+        raise ValueError("%s is truncated" % filename)
+    offset = BINARY_HEADER.size
+    coords = np.frombuffer(buffer, '<f8', rows * 2, offset).reshape(-1, 2)
+    arrays = {'coords': coords, 'longitude': coords[:, 0],
+              'latitude': coords[:, 1]}
+    offset += coords.nbytes
+    for name, dtype in BINARY_COLUMNS:
+        arrays[name] = np.frombuffer(buffer, dtype, rows, offset)
+        offset += arrays[name].nbytes
+    return arrays
+
+def catalog_locations(filename):
+    """
+    Returns the (n, 2) float64 array of (lon, lat) rows of the catalog in
+    filename, which may be a csv file or a binary catalog. The array of a
+    binary catalog is mapped from the file rather than read.
+    """
+    if is_binary_catalog(filename):
+        return open_binary_catalog(filename)['coords']
+    columns = load_catalog(filename)[0]
+    return np.column_stack((columns['longitude'], columns['latitude']))
+
+def catalog_events(filename):
+    """
+    Returns (coords, times) for the catalog in filename, csv or binary:
+    the (n, 2) array of catalog_locations and the time of each of the same
+    rows in seconds since the epoch.
+    """
+    if is_binary_catalog(filename):
+        columns = open_binary_catalog(filename)
+        return columns['coords'], columns['time'] / 1000.0
+    columns = load_catalog(filename, ('longitude', 'latitude', 'time'))[0]
+    return (np.column_stack((columns['longitude'], columns['latitude'])),
+            columns['time'])
+
+def catalog_hypocenters(filename):
+    """
+    Returns (coords, depths, mags) for the catalog in filename, csv or
+    binary: the (n, 2) array of catalog_locations and the depth and
+    magnitude of each of the same rows, NaN where they are missing.
+    """
+    if is_binary_catalog(filename):
+        columns = open_binary_catalog(filename)
+    else:
+        columns = load_catalog(filename, ('longitude', 'latitude', 'depth',
+                                          'mag'), optional=('depth', 'mag'))[0]
+        columns['coords'] = np.column_stack((columns['longitude'],
+                                             columns['latitude']))
+    return columns['coords'], columns['depth'], columns['mag']
+
+class LabelStore(collections.abc.MutableMapping):
+    """
+    The labels of a list of earthquake locations, kept by row number in an
+    int32 numpy array (labels) next to a float64 array of the (lon, lat)
+    coordinates (coords). Every row keeps its own label, so earthquakes
+    that share coordinates stay separate points, and a row costs 20 bytes
+    instead of a dictionary entry and a tuple.
+    The store can also be used like the dictionary initialize_database used
+    to return: keys are the distinct (lon, lat) tuples in the order they
+    first appear, and values are None for unvisited points, -1 for noise or
+    a cluster number. Reading a key gives the label of its first row and
+    setting a key labels all of its rows.
+    """
+
+    def __init__(self, locations):
+        self.coords = np.array(locations, dtype=np.float64).reshape(-1, 2)
+        self.labels = np.full(len(self.coords), UNVISITED, dtype=np.int32)
+        self._rows = None
+
+    def rows(self):
+        """
+        Returns the dictionary mapping each distinct point to the list of
+        its row numbers. It is only built the first time it is needed.
+        """
+        if self._rows is None:
+            self._rows = {}
+            for row, point in enumerate(map(tuple, self.coords.tolist())):
+                self._rows.setdefault(point, []).append(row)
+        return self._rows
+
+    def __getitem__(self, point):
+        label = int(self.labels[self.rows()[point][0]])
+        return None if label == UNVISITED else label
+
+    def __setitem__(self, point, label):
+        self.labels[self.rows()[point]] = UNVISITED if label == None else label
+
+    def __delitem__(self, point):
+        raise TypeError("points cannot be removed from a LabelStore")
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def __len__(self):
+        return len(self.rows())
+
+    def __repr__(self):
+        return "LabelStore(%d rows)" % len(self.labels)
 
 def initialize_database(locations):
     """
-    We create a dictionary with each point in locations list
-    as a key. 
+    We create a LabelStore holding each point in locations list,
+    which can be used as a dictionary with each point as a key.
     """
-    data = {}
-    for point in locations:
-        data.setdefault(point)
-    return data
+    return LabelStore(locations)
 
-def plot_earthquakes(filename):
+
+def plot_earthquakes(filename, output=None):
     """
     Creates clusters of earthquakes from the data contained in filename and
     displays them on a world map.
+    With output, the map is saved to that file by render_clusters instead
+    of being shown.
     """
+    if output is not None:
+        data = initialize_database(get_eq_locations(filename))
+        num_clusters = dbscan(data, 2.0, 4)
+        render_clusters(get_clusters(data, num_clusters, output='arrays'),
+                        output)
+        return
 
     print("Creating and visualizing clusters from file: %s" % filename)
 
@@ -137,20 +1744,220 @@ def plot_earthquakes(filename):
 
     # Set the image background to be a world-map
     # Don't change anything after this point.
-    img = imageio.imread("world-map-full.jpg")
+    import matplotlib.pyplot as pp
+    img = world_map()
     pp.imshow(img, zorder=0, extent=[-180, 180, -90, 90])
     pp.axis('off')
     pp.show()
 
+LABEL_FORMATS = ('npz', 'csv')
 
-if __name__ == "__main__":
-    # Choose the input file
-    choice = input("Enter 1 (for eq_day.csv) or 2 (for eq_week.csv): ")
-
-    # Create the clusters and plot the data.
-    if choice == '1':
-        plot_earthquakes("eq_day.csv")
-    elif choice == '2':
-        plot_earthquakes("eq_week.csv")
+def cluster_file(filename, epsilon=2.0, min_pts=4, metric='euclidean',
+                 output='.', label_format='npz', plot=True, standard=False,
+                 cache=None, window=None, depth=False, mag_reference=None,
+                 name=None):
+    """
+    Clusters the earthquakes in the catalog filename (csv or binary) with
+    dbscan and writes the longitude, latitude and label of every row to
+    output (a directory) as <name>.labels.npz or <name>.labels.csv, and
+    unless plot is False a map of the clusters as <name>.png. name is the
+    file name of the catalog without its extension unless given.
+    With cache, the name of a directory, the parsed catalog, its neighbor
+    graph and its labels are kept there by a catalog_cache.CatalogCache
+    and reused by later runs on the same file and settings.
+    With window, a number of seconds, events are clustered by
+    st_dbscan_array instead, and only count as neighbors when they are
+    also that close in time; cache is not used then.
+    With depth=True, events are clustered by hypocenter_dbscan_array with
+    epsilon in kilometers, and with mag_reference as well they are
+    weighted by magnitude_weights(mags, mag_reference).
+    Returns (filename, rows, number of clusters, seconds taken).
+    """
+    start = time.perf_counter()
+    if depth:
+        coords, depths, mags = catalog_hypocenters(filename)
+        data = LabelStore(coords)
+        weights = None
+        if mag_reference is not None:
+            weights = magnitude_weights(mags, mag_reference)
+        data.labels[:] = hypocenter_dbscan_array(coords, depths, epsilon,
+                                                 min_pts, weights,
+                                                 standard=standard)
+        num_clusters = int(data.labels.max(initial=-1)) + 1
+    elif window is not None:
+        coords, times = catalog_events(filename)
+        data = LabelStore(coords)
+        label_points = _standard_labels if standard else _label_points
+        indptr, indices = spatiotemporal_graph(data.coords, times, epsilon,
+                                               window, metric=metric)
+        num_clusters = label_points(data.labels, indptr, indices, min_pts)
+    elif cache is None:
+        data = LabelStore(catalog_locations(filename))
+        num_clusters = dbscan(data, epsilon, min_pts, metric, standard)
     else:
-        print("Invalid choice")
\ No newline at end of file
+        from catalog_cache import CatalogCache
+        coords, labels = CatalogCache(cache).dbscan(filename, epsilon, min_pts,
+                                                    metric, standard)
+        data = LabelStore(coords)
+        data.labels[:] = labels
+        num_clusters = int(labels.max(initial=-1)) + 1
+    coords, labels = data.coords, data.labels
+
+    if name is None:
+        name = os.path.splitext(os.path.basename(filename))[0]
+    base = os.path.join(output, name)
+    if label_format == 'npz':
+        np.savez(base + '.labels.npz', longitude=coords[:, 0],
+                 latitude=coords[:, 1], label=labels)
+    else:
+        with open(base + '.labels.csv', 'w', encoding='utf-8') as f:
+            f.write('longitude,latitude,label\n')
+            np.savetxt(f, np.column_stack((coords, labels)),
+                       fmt=['%.7f', '%.7f', '%d'], delimiter=',')
+    if plot:
+        render_clusters(get_clusters(data, num_clusters, output='arrays'),
+                        base + '.png')
+    return filename, len(labels), num_clusters, time.perf_counter() - start
+
+def output_names(filenames):
+    """
+    Returns the names cluster_file should give the outputs of filenames
+    so that none overwrites another: the file name without its extension,
+    or for files whose names clash, their path from the directory all the
+    clashing files are in, with '-' between the parts. Raises ValueError
+    if two outputs would still have the same name.
+    """
+    names = [os.path.splitext(os.path.basename(filename))[0]
+             for filename in filenames]
+    clashing = [i for i, name in enumerate(names) if names.count(name) > 1]
+    if clashing:
+        paths = [os.path.abspath(filenames[i]) for i in clashing]
+        common = os.path.commonpath([os.path.dirname(path) for path in paths])
+        for i, path in zip(clashing, paths):
+            parts = os.path.splitext(os.path.relpath(path, common))[0]
+            names[i] = parts.replace(os.sep, '-')
+    first = {}
+    for filename, name in zip(filenames, names):
+        if name in first:
+            raise ValueError("%s and %s would both be written as %s"
+                             % (first[name], filename, name))
+        first[name] = filename
+    return names
+
+def main(argv=None):
+    """
+    The command line: clusters every catalog named on it, several at a
+    time, and prints how long each took. With no files it asks for one of
+    the two sample catalogs and shows its map, as it always has.
+    """
+    parser = argparse.ArgumentParser(
+        description="Cluster earthquake catalogs with dbscan.")
+    parser.add_argument('files', nargs='*',
+                        help="catalog csv files or glob patterns")
+    parser.add_argument('--epsilon', type=float, default=2.0,
+                        help="neighborhood radius (degrees, or km with "
+                             "--metric haversine; default 2.0)")
+    parser.add_argument('--min-pts', type=int, default=4,
+                        help="points needed to form a cluster (default 4)")
+    parser.add_argument('--metric', choices=sorted(DISTANCES), default=None,
+                        help="distance between epicenters (default euclidean)")
+    parser.add_argument('--standard', action='store_true',
+                        help="use textbook DBSCAN labels")
+    parser.add_argument('--output', default='.',
+                        help="directory for the label files and maps")
+    parser.add_argument('--format', choices=LABEL_FORMATS, default='npz',
+                        help="label file format (default npz)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="files processed at once (default: all cores)")
+    parser.add_argument('--no-plot', action='store_true',
+                        help="do not draw the maps")
+    parser.add_argument('--window', type=float, default=None,
+                        help="also require neighbors to be this many hours "
+                             "apart at most (ST-DBSCAN)")
+    parser.add_argument('--depth', action='store_true',
+                        help="cluster by distance between hypocenters, with "
+                             "epsilon in km")
+    parser.add_argument('--mag-weight', type=float, default=None,
+                        metavar='REFERENCE',
+                        help="with --depth, weigh each event by its "
+                             "magnitude divided by REFERENCE")
+    parser.add_argument('--cache', default=None,
+                        help="directory to cache parsed catalogs and labels in")
+    args = parser.parse_args(argv)
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.depth:
+        for option, value in (('--metric', args.metric), ('--window', args.window),
+                              ('--cache', args.cache)):
+            if value is not None:
+                parser.error("%s cannot be used with --depth" % option)
+    elif args.mag_weight is not None:
+        parser.error("--mag-weight needs --depth")
+    if args.window is not None and args.cache is not None:
+        parser.error("--cache cannot be used with --window")
+
+    if not args.files:
+        # Choose the input file
+        choice = input("Enter 1 (for eq_day.csv) or 2 (for eq_week.csv): ")
+
+        # Create the clusters and plot the data.
+        if choice == '1':
+            plot_earthquakes("eq_day.csv")
+        elif choice == '2':
+            plot_earthquakes("eq_week.csv")
+        else:
+            print("Invalid choice")
+        return 0
+
+    filenames = []
+    for pattern in args.files:
+        filenames.extend(sorted(glob.glob(pattern)) or [pattern])
+    filenames = list(dict.fromkeys(filenames))
+    try:
+        names = output_names(filenames)
+    except ValueError as e:
+        parser.error(str(e))
+    os.makedirs(args.output, exist_ok=True)
+    options = dict(epsilon=args.epsilon, min_pts=args.min_pts,
+                   metric=args.metric or 'euclidean', output=args.output,
+                   label_format=args.format, plot=not args.no_plot,
+                   standard=args.standard, cache=args.cache,
+                   window=None if args.window is None else args.window * 3600,
+                   depth=args.depth, mag_reference=args.mag_weight)
+    start = time.perf_counter()
+    workers = min(args.workers or os.cpu_count() or 1, len(filenames))
+    results, failed = [], 0
+    with (ProcessPoolExecutor(workers) if workers > 1
+          else contextlib.nullcontext()) as pool:
+        if pool is None:
+            jobs = [(filename, functools.partial(cluster_file, filename,
+                                                 name=name, **options))
+                    for filename, name in zip(filenames, names)]
+        else:
+            jobs = [(filename, pool.submit(cluster_file, filename, name=name,
+                                           **options).result)
+                    for filename, name in zip(filenames, names)]
+        # A file that fails for any reason is reported and the others go
+        # on, so the summary still covers them.
+        for filename, job in jobs:
+            try:
+                results.append(job())
+            except Exception as e:
+                print("%s: %s: %s" % (filename, type(e).__name__, e),
+                      file=sys.stderr)
+                failed += 1
+
+    rows = 0
+    for filename, count, num_clusters, seconds in results:
+        rows += count
+        print("%-30s %10d rows %6d clusters %8.2f s %12.0f rows/s"
+              % (filename, count, num_clusters, seconds,
+                 count / seconds if seconds else float('inf')))
+    total = time.perf_counter() - start
+    print("%d files, %d rows in %.2f s (%.0f rows/s)"
+          % (len(results), rows, total, rows / total if total else float('inf')))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,381 @@
+"""
+Module: feed_ingest
+
+Polls USGS-style earthquake feeds (csv or GeoJSON) over HTTP with asyncio
+and feeds only the events it has not seen before into the clustering
+state, plus a local stand-in for the USGS feed server that serves
+eq_day.csv and eq_week.csv, so ingestion can be run and timed offline.
+"""
+
+import asyncio
+import collections
+import csv
+import email.utils
+import hashlib
+import heapq
+import http.client
+import http.server
+import io
+import json
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from earthquake_clusters import parse_times
+
+
+class FeedEvent(collections.namedtuple(
+        'FeedEvent', 'id time longitude latitude depth mag')):
+    """
+    One earthquake from a feed: its USGS id, its time in seconds since the
+    epoch, its position, its depth in kilometers and its magnitude (depth
+    and mag are None when the feed has none).
+    """
+    __slots__ = ()
+
+def _number(value):
+    """
+    Returns value as a float, or None if it is empty.
+    """
+    return None if value in (None, '') else float(value)
+
+def parse_feed(body, content_type=''):
+    """
+    Returns the list of FeedEvents in body, the bytes of a feed in the
+    csv format of eq_week.csv or in the USGS GeoJSON format. GeoJSON is
+    recognised by its content type or by starting with a brace. Rows or
+    features without an id, a time or a position are skipped.
+    """
+    text = body.decode('utf-8')
+    events = []
+    if 'json' in (content_type or '') or text.lstrip().startswith('{'):
+        for feature in json.loads(text).get('features', ()):
+            try:
+                properties = feature['properties']
+                lon, lat = feature['geometry']['coordinates'][:2]
+                depth = feature['geometry']['coordinates'][2:3] or [None]
+                events.append(FeedEvent(
+                    feature['id'], properties['time'] / 1000.0, float(lon),
+                    float(lat), _number(depth[0]), _number(properties.get('mag'))))
+            except (KeyError, TypeError, ValueError, IndexError):
+                continue
+        return events
+    for row in csv.DictReader(io.StringIO(text)):
+        try:
+            events.append(FeedEvent(
+                row['id'], float(parse_times([row['time']])[0]),
+                float(row['longitude']), float(row['latitude']),
+                _number(row.get('depth')), _number(row.get('mag'))))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return events
+
+class ConnectionPool:
+    """
+    A pool of keep-alive HTTP connections, at most size of them, shared
+    by every feed on the same host. http.client is blocking, so requests
+    run on a thread pool of the same size and get() can be awaited.
+    """
+
+    def __init__(self, size=4, timeout=30.0):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(size)
+
+    def _connection(self, scheme, host):
+        """
+        Returns an idle connection to host, or a new one, and whether it
+        was reused.
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def request(self, url, headers=None):
+        """
+        Sends a GET for url and returns (status, headers, body), keeping
+        the connection for the next request to the same host. A reused
+        connection the server has closed in the meantime is retried once
+        on a fresh one.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            connection, reused = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self.lock:
+                    self.idle.setdefault((parts.scheme, parts.netloc),
+                                         []).append(connection)
+            return response.status, response.headers, body
+
+    async def get(self, url, headers=None):
+        """
+        The awaitable version of request.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.request, url,
+                                          headers)
+
+    def close(self):
+        """
+        Closes every idle connection and stops the thread pool.
+        """
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+        self.executor.shutdown()
+
+class FeedPoller:
+    """
+    Polls the feed urls concurrently and hands each new event, once, to
+    clusterer (an incremental_clusters.IncrementalClusterer, if given)
+    and to on_events (a function taking the list of new FeedEvents).
+    Every request carries the ETag and Last-Modified of the last answer
+    from the same url, so a feed that has not changed costs a 304 and no
+    parsing. Events are told apart by their id, so the overlap between a
+    day feed and a week feed, or between two polls, is only added once.
+    With window, a number of seconds, only the events at most that much
+    older than the newest one are kept: older ones are expired from
+    clusterer, their ids are forgotten and the feeds' copies of them are
+    ignored from then on. Without it every id is remembered.
+    """
+
+    def __init__(self, urls, clusterer=None, on_events=None, pool=None,
+                 window=None):
+        self.urls = list(urls)
+        self.clusterer = clusterer
+        self.on_events = on_events
+        self.pool = pool or ConnectionPool()
+        self.window = window
+        self.validators = {}
+        self.seen = set()
+        self.events = {}
+        self.expiry = []
+        self.cutoff = None
+        self.failures = {}
+        self.latencies = []
+
+    async def fetch(self, url):
+        """
+        Returns the FeedEvents now in the feed at url, or an empty list if
+        it has not changed since the last fetch. Raises OSError if the
+        server answers with an error.
+        """
+        headers = {}
+        etag, modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        status, response, body = await self.pool.get(url, headers)
+        if status == 304:
+            return []
+        if status != 200:
+            raise OSError("HTTP %d from %s" % (status, url))
+        self.validators[url] = (response.get('ETag'),
+                                response.get('Last-Modified'))
+        return parse_feed(body, response.get('Content-Type'))
+
+    async def poll_once(self):
+        """
+        Fetches every feed at once and returns the events not seen before,
+        in time order, after adding them to clusterer and expiring the ones
+        that fell out of the window. The failure of one feed is kept in
+        failures and does not stop the others. The time from the first
+        request to the last insert is added to latencies.
+        """
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self.fetch(url) for url in self.urls),
+                                       return_exceptions=True)
+        new = {}
+        for url, result in zip(self.urls, results):
+            if isinstance(result, Exception):
+                self.failures[url] = result
+                continue
+            self.failures.pop(url, None)
+            for event in result:
+                if event.id not in self.seen:
+                    new.setdefault(event.id, event)
+        new = sorted(new.values(), key=lambda event: event.time)
+        if new and self.window is not None:
+            if self.cutoff is None or new[-1].time - self.window > self.cutoff:
+                self.cutoff = new[-1].time - self.window
+            new = [event for event in new if event.time >= self.cutoff]
+            for event in new:
+                heapq.heappush(self.expiry, (event.time, event.id))
+        self.seen.update(event.id for event in new)
+        if new and self.clusterer is not None:
+            numbers = self.clusterer.insert(
+                [(event.longitude, event.latitude) for event in new],
+                times=[event.time for event in new])
+            self.events.update(zip((event.id for event in new), numbers))
+        if self.cutoff is not None:
+            self._forget(self.cutoff)
+        if new and self.on_events is not None:
+            self.on_events(new)
+        self.latencies.append(time.perf_counter() - start)
+        return new
+
+    def _forget(self, older_than):
+        """
+        Expires the events before older_than from clusterer and forgets
+        their ids.
+        """
+        while self.expiry and self.expiry[0][0] < older_than:
+            _, event_id = heapq.heappop(self.expiry)
+            self.seen.discard(event_id)
+            self.events.pop(event_id, None)
+        if self.clusterer is not None:
+            self.clusterer.expire(older_than)
+
+    async def run(self, interval=60.0, polls=None):
+        """
+        Polls every interval seconds, polls times or until cancelled.
+        """
+        count = 0
+        while polls is None or count < polls:
+            await self.poll_once()
+            count += 1
+            if polls is None or count < polls:
+                await asyncio.sleep(interval)
+
+    def close(self):
+        """ Closes the connection pool. """
+        self.pool.close()
+
+def csv_to_geojson(text):
+    """
+    Returns the USGS GeoJSON text of the catalog csv text, for the rows
+    parse_feed can read.
+    """
+    features = [{'type': 'Feature', 'id': event.id,
+                 'properties': {'time': int(round(event.time * 1000)),
+                                'mag': event.mag},
+                 'geometry': {'type': 'Point',
+                              'coordinates': [event.longitude, event.latitude,
+                                              event.depth]}}
+                for event in parse_feed(text.encode('utf-8'))]
+    return json.dumps({'type': 'FeatureCollection', 'features': features})
+
+class FeedServer:
+    """
+    A local stand-in for the USGS feed server, run on a thread. It serves
+    every csv file in directory as /<name>.csv, and the same events as
+    /<name>.geojson, with an ETag and a Last-Modified header, and answers
+    conditional requests that match them with 304 Not Modified. Files are
+    read on every request, so changing one changes the feed. requests
+    counts the requests answered with 200 and with 304.
+
+        with FeedServer() as server:
+            poller = FeedPoller([server.url('eq_week.csv')])
+    """
+
+    def __init__(self, directory=None, host='127.0.0.1', port=0):
+        self.directory = directory or os.path.dirname(os.path.abspath(__file__))
+        self.requests = collections.Counter()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._answer(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def url(self, name):
+        """ Returns the url of the feed name, such as 'eq_day.csv'. """
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d/%s' % (host, port, name)
+
+    def _answer(self, handler):
+        """
+        Answers one request made to handler.
+        """
+        name = os.path.basename(urllib.parse.urlsplit(handler.path).path)
+        stem, extension = os.path.splitext(name)
+        filename = os.path.join(self.directory, stem + '.csv')
+        if extension not in ('.csv', '.geojson') or not os.path.isfile(filename):
+            handler.send_error(404)
+            return
+        with open(filename, encoding='utf-8') as f:
+            text = f.read()
+        modified = os.path.getmtime(filename)
+        etag = '"%s%s"' % (hashlib.sha256(text.encode('utf-8')).hexdigest()[:16],
+                           extension)
+        if 'If-None-Match' in handler.headers:
+            unchanged = handler.headers['If-None-Match'] == etag
+        else:
+            try:
+                since = email.utils.parsedate_to_datetime(
+                    handler.headers.get('If-Modified-Since'))
+                unchanged = since.timestamp() >= int(modified)
+            except (TypeError, ValueError):
+                unchanged = False
+        if unchanged:
+            self.requests[304] += 1
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        if extension == '.geojson':
+            body = csv_to_geojson(text).encode('utf-8')
+            content_type = 'application/geo+json'
+        else:
+            body = text.encode('utf-8')
+            content_type = 'text/csv'
+        self.requests[200] += 1
+        handler.send_response(200)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.send_header('ETag', etag)
+        handler.send_header('Last-Modified',
+                            email.utils.formatdate(modified, usegmt=True))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def start(self):
+        """ Starts serving on a daemon thread. """
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stops serving and closes the socket. """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,277 @@
+"""
+Module: hierarchical_clusters
+
+Builds the whole density hierarchy of a catalog once, in the manner of
+HDBSCAN, so that clusters of different densities can be found in one pass
+and a dbscan clustering at any epsilon can be read off without searching
+for neighbors again.
+"""
+
+import numpy as np
+
+from earthquake_clusters import (NOISE, UNVISITED, neighbor_graph,
+                                 restrict_graph, _components)
+
+
+def core_distances(indptr, lengths, min_pts):
+    """
+    Returns the core distance of every point of a neighbor graph built
+    with distances=True: the smallest epsilon at which the point has
+    min_pts points, itself included, within epsilon. Points that do not
+    have enough neighbors in the graph get infinity.
+    """
+    n = len(indptr) - 1
+    degree = np.diff(indptr)
+    result = np.full(n, np.inf)
+    k = min_pts - 1
+    if k <= 0:
+        result[:] = 0.0
+        return result
+    rows = np.repeat(np.arange(n), degree)
+    ordered = lengths[np.lexsort((lengths, rows))]
+    enough = degree >= k
+    result[enough] = ordered[indptr[:-1][enough] + k - 1]
+    return result
+
+def _minimum_spanning_forest(n, u, v, weights):
+    """
+    Returns the edge numbers of a minimum spanning forest of the graph with
+    n nodes and edges (u[k], v[k]) of the given weights, in increasing
+    order of weight. Boruvka's algorithm is run with numpy: every round,
+    each component picks its lightest outgoing edge, so there are at most
+    log2(n) rounds. Ties are broken by edge number.
+    """
+    by_rank = np.argsort(weights, kind='stable')
+    rank = np.empty(len(weights), dtype=np.intp)
+    rank[by_rank] = np.arange(len(weights))
+    chosen = np.zeros(len(weights), dtype=bool)
+    component = np.arange(n)
+    none = len(weights)
+    while True:
+        cu, cv = component[u], component[v]
+        outgoing = cu != cv
+        if not outgoing.any():
+            break
+        best = np.full(n, none)
+        np.minimum.at(best, cu[outgoing], rank[outgoing])
+        np.minimum.at(best, cv[outgoing], rank[outgoing])
+        chosen[by_rank[best[best < none]]] = True
+        component = _components(n, u[chosen], v[chosen])
+    edges = np.flatnonzero(chosen)
+    return by_rank[np.sort(rank[edges])]
+
+class ClusterHierarchy:
+    """
+    The mutual reachability minimum spanning tree of a set of points and
+    what can be read off it. The mutual reachability distance of two points
+    is the largest of their distance and their two core distances (see
+    core_distances); two points are then in the same dbscan cluster at
+    epsilon exactly when they are joined by a path of tree edges no longer
+    than epsilon.
+
+    Neighbors are searched for only once, within max_epsilon, with
+    neighbor_graph; the hierarchy covers every epsilon up to max_epsilon,
+    and pieces that are only joined beyond it are joined at infinity.
+    cut(epsilon) returns the labels of dbscan_array(coords, epsilon,
+    min_pts, standard=True) in time linear in the size of the graph, and
+    labels() picks the most stable clusters over all densities from the
+    condensed tree, as HDBSCAN does.
+    """
+
+    def __init__(self, coords, min_pts, max_epsilon, block_size=1024,
+                 metric='euclidean'):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.min_pts = min_pts
+        self.max_epsilon = max_epsilon
+        n = len(self.coords)
+        self.graph = neighbor_graph(self.coords, max_epsilon, block_size,
+                                    metric, distances=True)
+        indptr, indices, lengths = self.graph
+        self.core_distances = core_distances(indptr, lengths, min_pts)
+        rows = np.repeat(np.arange(n), np.diff(indptr))
+        once = rows < indices
+        u, v, lengths = rows[once], indices[once], lengths[once]
+        reach = np.maximum(lengths, np.maximum(self.core_distances[u],
+                                               self.core_distances[v]))
+        keep = np.isfinite(reach)
+        u, v, reach = u[keep], v[keep], reach[keep]
+        tree = _minimum_spanning_forest(n, u, v, reach)
+        self.edges = np.column_stack((u[tree], v[tree]))
+        self.weights = reach[tree]
+        self._linkage = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def cut(self, epsilon):
+        """
+        Returns the int32 labels dbscan_array(coords, epsilon, min_pts,
+        standard=True) would give, for any epsilon up to max_epsilon, using
+        only the tree and the stored neighbor graph.
+        """
+        if epsilon > self.max_epsilon:
+            raise ValueError("epsilon %r is above max_epsilon %r"
+                             % (epsilon, self.max_epsilon))
+        n = len(self)
+        count = np.searchsorted(self.weights, epsilon, 'right')
+        roots = _components(n, self.edges[:count, 0], self.edges[:count, 1])
+        core = self.core_distances <= epsilon
+        labels = np.full(n, NOISE, dtype=np.int32)
+        cluster_roots, cluster_ids = np.unique(roots[core], return_inverse=True)
+        labels[core] = cluster_ids
+        indptr, indices = restrict_graph(*self.graph, epsilon)
+        rows = np.repeat(np.arange(n), np.diff(indptr))
+        border = ~core[rows] & core[indices]
+        points, first = np.unique(rows[border], return_index=True)
+        labels[points] = labels[indices[border][first]]
+        return labels
+
+    def linkage(self):
+        """
+        Returns the single linkage tree of the points as an (n - 1, 4)
+        array in the usual form: row k merges the nodes in its first two
+        columns (points are 0 to n - 1, row k makes node n + k) at the
+        distance in the third column into a node of the size in the fourth.
+        Pieces that are not joined within max_epsilon are joined at
+        infinity.
+        """
+        if self._linkage is not None:
+            return self._linkage
+        n = len(self)
+        parent = list(range(2 * n))
+        size = [1] * n
+        rows = []
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        joins = list(zip(self.edges[:, 0].tolist(), self.edges[:, 1].tolist(),
+                         self.weights.tolist()))
+        # Join the trees of the forest one after another at infinity.
+        joins += [(0, point, float('inf')) for point in range(1, n)]
+        for a, b, weight in joins:
+            a, b = find(a), find(b)
+            if a == b:
+                continue
+            node = n + len(rows)
+            parent[a] = parent[b] = node
+            size.append(size[a] + size[b])
+            rows.append((a, b, weight, size[node]))
+            if len(rows) == n - 1:
+                break
+        self._linkage = np.array(rows, dtype=np.float64).reshape(-1, 4)
+        return self._linkage
+
+    def condensed_tree(self, min_cluster_size=None):
+        """
+        Returns the condensed tree, with min_cluster_size defaulting to
+        min_pts (and never below 2), as a list of (parent, child, lambda,
+        size) tuples, lambda being 1 / distance. Clusters are numbered from
+        n, n being the root; children below n are points. Walking the
+        single linkage tree from the top, a split where both sides have
+        min_cluster_size points makes two new clusters; otherwise the
+        cluster goes on as the larger side and the points of the smaller
+        side fall out of it.
+        """
+        min_cluster_size = max(min_cluster_size or self.min_pts, 2)
+        n = len(self)
+        tree = self.linkage()
+        if n < 2:
+            return [(n, point, 0.0, 1) for point in range(n)]
+        left = tree[:, 0].astype(np.intp).tolist()
+        right = tree[:, 1].astype(np.intp).tolist()
+        lambdas = (1 / np.maximum(tree[:, 2], 1e-12)).tolist()
+        sizes = tree[:, 3].astype(np.intp).tolist()
+
+        def size_of(node):
+            return 1 if node < n else sizes[node - n]
+
+        def points_under(node):
+            found, stack = [], [node]
+            while stack:
+                node = stack.pop()
+                if node < n:
+                    found.append(node)
+                else:
+                    stack += (left[node - n], right[node - n])
+            return found
+
+        result = []
+        label = {2 * n - 2: n}
+        next_label = n + 1
+        stack = [2 * n - 2]
+        while stack:
+            node = stack.pop()
+            if node < n:
+                continue
+            cluster, lam = label[node], lambdas[node - n]
+            children = (left[node - n], right[node - n])
+            big = [child for child in children
+                   if size_of(child) >= min_cluster_size]
+            for child in children:
+                if len(big) == 2:
+                    label[child] = next_label
+                    result.append((cluster, next_label, lam, size_of(child)))
+                    next_label += 1
+                    stack.append(child)
+                elif child in big:
+                    label[child] = cluster
+                    stack.append(child)
+                else:
+                    result += [(cluster, point, lam, 1)
+                               for point in points_under(child)]
+        return result
+
+    def labels(self, min_cluster_size=None):
+        """
+        Returns int32 labels for the most stable clusters of the condensed
+        tree, chosen by excess of mass as in HDBSCAN: a cluster is kept when
+        its stability (the sum over its points of how far lambda grew
+        before they fell out) is at least that of the clusters kept below
+        it. The root is never kept, so there can be no clusters at all.
+        Clusters are numbered from 0 and the rest of the points are NOISE.
+        """
+        n = len(self)
+        tree = self.condensed_tree(min_cluster_size)
+        clusters = n + 1 + max([child - n for parent, child, lam, size in tree
+                                if child >= n], default=0)
+        birth = [0.0] * (clusters - n)
+        parent_of = [None] * (clusters - n)
+        children = [[] for _ in range(clusters - n)]
+        for parent, child, lam, size in tree:
+            if child >= n:
+                birth[child - n] = lam
+                parent_of[child - n] = parent - n
+                children[parent - n].append(child - n)
+        stability = [0.0] * (clusters - n)
+        for parent, child, lam, size in tree:
+            stability[parent - n] += (lam - birth[parent - n]) * size
+
+        selected = [False] * (clusters - n)
+        for cluster in range(clusters - n - 1, 0, -1):
+            below = sum(stability[child] for child in children[cluster])
+            if children[cluster] and below > stability[cluster]:
+                stability[cluster] = below
+                continue
+            selected[cluster] = True
+            stack = list(children[cluster])
+            while stack:
+                child = stack.pop()
+                selected[child] = False
+                stack += children[child]
+
+        assigned = [NOISE] * (clusters - n)
+        numbers = {}
+        for cluster in range(1, clusters - n):
+            if selected[cluster]:
+                assigned[cluster] = numbers.setdefault(cluster, len(numbers))
+            else:
+                assigned[cluster] = assigned[parent_of[cluster]]
+        labels = np.full(n, UNVISITED, dtype=np.int32)
+        for parent, child, lam, size in tree:
+            if child < n:
+                labels[child] = assigned[parent - n]
+        return labels
@@ -0,0 +1,229 @@
+"""
+Module: incremental_clusters
+
+Keeps the clusters of a live earthquake feed up to date as events arrive
+and expire, without rerunning dbscan over the whole window.
+"""
+
+import heapq
+
+from earthquake_clusters import (GridIndex, LabelStore, DISTANCES, NOISE,
+                                 check_metric)
+
+
+class IncrementalClusterer:
+    """
+    Holds the events of a sliding window together with their textbook
+    DBSCAN labels, the ones dbscan_array(..., standard=True) would give:
+    an event is a core event when at least min_pts events (itself
+    included) are within epsilon of it, clusters are the groups of core
+    events within epsilon of each other, and the other events belong to
+    the cluster of a core neighbor or are NOISE.
+
+    insert only looks at the neighborhoods of the new events: it promotes
+    neighbors that become core, turns noise next to them into border
+    events and merges the clusters they connect, so each event costs about
+    as much as the number of events around it. expire and remove undo
+    this, reclustering only the clusters that lost a core event.
+
+    Events are numbered in the order they are inserted. A border event
+    that touches two clusters keeps the one it joined first, so it may be
+    labeled differently from a batch run.
+    """
+
+    def __init__(self, epsilon, min_pts, metric='euclidean'):
+        check_metric(metric)
+        self.epsilon = epsilon
+        self.min_pts = min_pts
+        self.metric = metric
+        self.distance = DISTANCES[metric]
+        self.grid = GridIndex((), epsilon, metric)
+        self.cells = {}
+        self.points = {}
+        self.times = {}
+        self.counts = {}
+        self.labels = {}
+        self.members = {}
+        self.expiry = []
+        self.next_event = 0
+        self.next_cluster = 0
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def num_clusters(self):
+        """ The number of clusters currently in the window. """
+        return len(self.members)
+
+    def is_core(self, event):
+        """ Returns True if event has at least min_pts events around it. """
+        return self.counts[event] >= self.min_pts
+
+    def neighbors(self, point):
+        """
+        Returns the events within epsilon of point, including an event
+        at point itself, by looking only at the grid cells around it.
+        """
+        found = []
+        for cell in self.grid.cells_near(point, self.epsilon):
+            for event in self.cells.get(cell, ()):
+                if self.distance(point, self.points[event]) <= self.epsilon:
+                    found.append(event)
+        return found
+
+    def insert(self, points, times=None):
+        """
+        Adds the (lon, lat) points to the window, updating the clusters
+        around them, and returns the list of their event numbers.
+        times, if given, holds the time of each point for expire.
+        """
+        events = []
+        for k, point in enumerate(points):
+            point = (float(point[0]), float(point[1]))
+            event = self.next_event
+            self.next_event += 1
+            near = self.neighbors(point)
+            self.points[event] = point
+            self.cells.setdefault(self.grid.cell_of(point), set()).add(event)
+            self.counts[event] = len(near) + 1
+            self.labels[event] = NOISE
+            promoted = [event] if self.is_core(event) else []
+            for other in near:
+                self.counts[other] += 1
+                if self.counts[other] == self.min_pts:
+                    promoted.append(other)
+            for core in promoted:
+                self._absorb(core)
+            if self.labels[event] == NOISE:
+                for other in near:
+                    if self.is_core(other):
+                        self._assign(event, self.labels[other])
+                        break
+            if times is not None:
+                self.times[event] = times[k]
+                heapq.heappush(self.expiry, (times[k], event))
+            events.append(event)
+        return events
+
+    def expire(self, older_than):
+        """
+        Removes every event whose time is before older_than and returns
+        the list of their event numbers.
+        """
+        expired = []
+        while self.expiry and self.expiry[0][0] < older_than:
+            time, event = heapq.heappop(self.expiry)
+            if event in self.points:
+                expired.append(event)
+        self.remove(expired)
+        return expired
+
+    def remove(self, events):
+        """
+        Removes events from the window. Events that drop below min_pts
+        neighbors stop being core events, and every cluster that lost a
+        core event is rebuilt from its remaining members, which may split
+        it or turn some of its border events into noise.
+        """
+        affected = set()
+        for event in events:
+            point = self.points[event]
+            cell = self.grid.cell_of(point)
+            self.cells[cell].discard(event)
+            if not self.cells[cell]:
+                del self.cells[cell]
+            if self.is_core(event):
+                affected.add(self.labels[event])
+            self._assign(event, NOISE)
+            for other in self.neighbors(point):
+                self.counts[other] -= 1
+                if self.counts[other] == self.min_pts - 1 and self.labels[other] != NOISE:
+                    affected.add(self.labels[other])
+            del self.points[event], self.counts[event], self.labels[event]
+            self.times.pop(event, None)
+        self._recluster(affected)
+
+    def to_store(self):
+        """
+        Returns a LabelStore with one row per event in the window, in
+        event order, with the clusters renumbered from 0 in the order they
+        first appear. It can be passed to get_clusters and plot_clusters.
+        """
+        events = sorted(self.points)
+        store = LabelStore([self.points[event] for event in events])
+        numbers = {NOISE: NOISE}
+        for row, event in enumerate(events):
+            label = self.labels[event]
+            store.labels[row] = numbers.setdefault(label, len(numbers) - 1)
+        return store
+
+    def _assign(self, event, cluster):
+        """ Moves event into cluster (or to NOISE), keeping members in step. """
+        if self.labels[event] != NOISE:
+            self.members[self.labels[event]].discard(event)
+        self.labels[event] = cluster
+        if cluster != NOISE:
+            self.members[cluster].add(event)
+
+    def _new_cluster(self):
+        """ Returns the number of a new, empty cluster. """
+        cluster = self.next_cluster
+        self.next_cluster += 1
+        self.members[cluster] = set()
+        return cluster
+
+    def _absorb(self, core):
+        """
+        Handles an event that has just become a core event: the clusters
+        of the core events around it are merged into one, which it joins
+        along with the noise around it.
+        """
+        near = self.neighbors(self.points[core])
+        clusters = {self.labels[other] for other in near
+                    if other != core and self.is_core(other)
+                    and self.labels[other] != NOISE}
+        if clusters:
+            target = max(clusters, key=lambda cluster: len(self.members[cluster]))
+            for cluster in clusters - {target}:
+                # Relabel the smaller clusters so merging stays cheap overall.
+                for event in self.members[cluster]:
+                    self.labels[event] = target
+                self.members[target] |= self.members.pop(cluster)
+        else:
+            target = self._new_cluster()
+        self._assign(core, target)
+        for other in near:
+            if self.labels[other] == NOISE and not self.is_core(other):
+                self._assign(other, target)
+
+    def _recluster(self, clusters):
+        """
+        Rebuilds the given clusters from scratch: their core events are
+        regrouped by walking from core to core, and their other events
+        join a neighboring cluster or become noise.
+        """
+        group = []
+        for cluster in clusters:
+            group.extend(self.members.pop(cluster, ()))
+        for event in group:
+            self.labels[event] = NOISE
+        group.sort()
+        for start in group:
+            if not self.is_core(start) or self.labels[start] != NOISE:
+                continue
+            cluster = self._new_cluster()
+            self._assign(start, cluster)
+            stack = [start]
+            while stack:
+                for other in self.neighbors(self.points[stack.pop()]):
+                    if self.labels[other] == NOISE:
+                        self._assign(other, cluster)
+                        if self.is_core(other):
+                            stack.append(other)
+        for event in group:
+            if self.labels[event] == NOISE:
+                for other in self.neighbors(self.points[event]):
+                    if self.is_core(other) and self.labels[other] != NOISE:
+                        self._assign(event, self.labels[other])
+                        break
@@ -0,0 +1,126 @@
+"""
+Module: parallel_clusters
+
+Runs dbscan over many cores by splitting the map into tiles, clustering
+each tile in a separate process and stitching the clusters back together.
+"""
+
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from earthquake_clusters import (NOISE, check_metric, chord_length,
+                                 neighbor_graph, sphere_coords, _components)
+
+
+def _cluster_tile(coords, owned, epsilon, min_pts, metric):
+    """
+    Clusters one tile. coords holds the tile's own points first and then
+    its halo, the points from other tiles within epsilon of it, so the
+    neighborhoods of the first owned points are complete.
+    Returns, in tile row numbers: which owned points are core points, the
+    smallest owned core point connected to each owned point, the edges
+    from owned core points to halo points, and the edges from owned
+    non-core points to all of their neighbors.
+    """
+    indptr, indices = neighbor_graph(coords, epsilon, metric=metric)
+    degree = np.diff(indptr[:owned + 1])
+    core = degree + 1 >= min_pts
+    rows = np.repeat(np.arange(owned), degree)
+    cols = indices[:indptr[owned]]
+    inner = cols < owned
+    linked = inner & core[rows] & core[np.where(inner, cols, 0)]
+    roots = _components(owned, rows[linked], cols[linked])
+    cross = core[rows] & ~inner
+    border = ~core[rows]
+    return core, roots, rows[cross], cols[cross], rows[border], cols[border]
+
+def _tiles(space, radius, tiles):
+    """
+    Splits the points in space into about tiles groups of equal size, in
+    strips along the first axis cut into boxes along the second, and
+    returns a list of (owned rows, halo rows) pairs. The halo of a tile is
+    every other point within radius of the box around its own points.
+    """
+    across = max(1, int(math.sqrt(tiles)))
+    down = max(1, tiles // across)
+    order = np.argsort(space[:, 0], kind='stable')
+    pad = radius + 1e-9 * (1 + abs(radius))
+    result = []
+    for strip in np.array_split(order, across):
+        strip = strip[np.argsort(space[strip, 1], kind='stable')]
+        for owned in np.array_split(strip, down):
+            if not len(owned):
+                continue
+            owned = np.sort(owned)
+            low = space[owned].min(axis=0) - pad
+            high = space[owned].max(axis=0) + pad
+            near = np.all((space >= low) & (space <= high), axis=1)
+            near[owned] = False
+            result.append((owned, np.flatnonzero(near)))
+    return result
+
+def dbscan_parallel(coords, epsilon, min_pts, workers=None, tiles=None,
+                    metric='euclidean'):
+    """
+    Clusters the (n, 2) array of (lon, lat) rows in coords with workers
+    processes (all cores by default) and returns the same int32 labels as
+    dbscan_array(coords, epsilon, min_pts, metric=metric, standard=True).
+
+    The points are split into tiles (four per worker by default), each
+    with an epsilon-wide halo of neighboring points. Every tile works out
+    the core points it owns and how they connect; the main process then
+    joins the pieces with one union-find over the tile results and the
+    edges into the halos, numbering clusters as the serial run does.
+    The serial dbscan, where only unvisited points count as neighbors,
+    depends on the order points are visited in and cannot be split up
+    this way, which is why the textbook (standard) labels are used.
+    """
+    check_metric(metric)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    n = len(coords)
+    if not n:
+        return np.empty(0, dtype=np.int32)
+    workers = workers or os.cpu_count() or 1
+    tiles = tiles or 4 * workers
+    if metric == 'haversine':
+        space, radius = sphere_coords(coords), chord_length(epsilon)
+    else:
+        space, radius = coords, epsilon
+    parts = _tiles(space, radius, tiles)
+    jobs = [(coords[np.concatenate((owned, halo))], len(owned), epsilon,
+             min_pts, metric) for owned, halo in parts]
+    if workers == 1:
+        results = [_cluster_tile(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(_cluster_tile, *zip(*jobs)))
+
+    core = np.zeros(n, dtype=bool)
+    rows, cols, border_rows, border_cols = [], [], [], []
+    for (owned, halo), (tile_core, roots, cross_rows, cross_cols,
+                        tile_border_rows, tile_border_cols) in zip(parts, results):
+        ids = np.concatenate((owned, halo))
+        core[owned] = tile_core
+        rows.append(owned[tile_core])
+        cols.append(owned[roots[tile_core]])
+        rows.append(ids[cross_rows])
+        cols.append(ids[cross_cols])
+        border_rows.append(ids[tile_border_rows])
+        border_cols.append(ids[tile_border_cols])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    linked = core[cols]
+    roots = _components(n, rows[linked], cols[linked])
+    labels = np.full(n, NOISE, dtype=np.int32)
+    labels[core] = np.unique(roots[core], return_inverse=True)[1]
+
+    # A border point joins the cluster of its first core neighbor.
+    rows, cols = np.concatenate(border_rows), np.concatenate(border_cols)
+    touching = core[cols]
+    rows, cols = rows[touching], cols[touching]
+    first = np.lexsort((cols, rows))
+    points, start = np.unique(rows[first], return_index=True)
+    labels[points] = labels[cols[first][start]]
+    return labels
@@ -7,7 +7,19 @@ Test cases for earthquake_clusters module.
 import unittest
 from unittest.mock import Mock, MagicMock, mock_open, patch, call
 import earthquake_clusters
+import incremental_clusters
+import parallel_clusters
+import catalog_cache
+import hierarchical_clusters
+import approximate_clusters
+import feed_ingest
+import cluster_queries
+import differential_clusters
+import asyncio
 import io
+import os
+import subprocess
+import tempfile
 
 import sys
 import math
@@ -284,6 +296,213 @@ class PA6Test(unittest.TestCase):
             print(f"Exception: {e}")
             num_incorrect += 1
 
+        # Test GridIndex
+        num_tests += 1
+        try:
+            self.grid_index_test()
+        except Exception as e:
+            print("\nTest of GridIndex failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test dbscan_array
+        num_tests += 1
+        try:
+            self.dbscan_array_test()
+        except Exception as e:
+            print("\nTest of dbscan_array failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test large cluster expansion
+        num_tests += 1
+        try:
+            self.large_cluster_test()
+        except Exception as e:
+            print("\nTest of large cluster expansion failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test haversine metric
+        num_tests += 1
+        try:
+            self.haversine_test()
+        except Exception as e:
+            print("\nTest of haversine metric failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test load_catalog
+        num_tests += 1
+        try:
+            self.load_catalog_test()
+        except Exception as e:
+            print("\nTest of load_catalog failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test LabelStore
+        num_tests += 1
+        try:
+            self.label_store_test()
+        except Exception as e:
+            print("\nTest of LabelStore failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test get_clusters options
+        num_tests += 1
+        try:
+            self.get_clusters_options_test()
+        except Exception as e:
+            print("\nTest of get_clusters options failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test IncrementalClusterer
+        num_tests += 1
+        try:
+            self.incremental_test()
+        except Exception as e:
+            print("\nTest of IncrementalClusterer failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test dbscan_parallel
+        num_tests += 1
+        try:
+            self.parallel_test()
+        except Exception as e:
+            print("\nTest of dbscan_parallel failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test dbscan_sweep
+        num_tests += 1
+        try:
+            self.sweep_test()
+        except Exception as e:
+            print("\nTest of dbscan_sweep failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test DbscanStats
+        num_tests += 1
+        try:
+            self.stats_test()
+        except Exception as e:
+            print("\nTest of DbscanStats failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test CatalogCache
+        num_tests += 1
+        try:
+            self.catalog_cache_test()
+        except Exception as e:
+            print("\nTest of CatalogCache failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test the binary catalog format
+        num_tests += 1
+        try:
+            self.binary_catalog_test()
+        except Exception as e:
+            print("\nTest of the binary catalog format failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test st_dbscan_array
+        num_tests += 1
+        try:
+            self.st_dbscan_test()
+        except Exception as e:
+            print("\nTest of st_dbscan_array failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test hypocenter_dbscan_array
+        num_tests += 1
+        try:
+            self.hypocenter_test()
+        except Exception as e:
+            print("\nTest of hypocenter_dbscan_array failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test ClusterHierarchy
+        num_tests += 1
+        try:
+            self.hierarchy_test()
+        except Exception as e:
+            print("\nTest of ClusterHierarchy failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test approximate_dbscan
+        num_tests += 1
+        try:
+            self.approximate_test()
+        except Exception as e:
+            print("\nTest of approximate_dbscan failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test feed ingestion
+        num_tests += 1
+        try:
+            self.feed_ingest_test()
+        except Exception as e:
+            print("\nTest of feed ingestion failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test cluster queries
+        num_tests += 1
+        try:
+            self.cluster_queries_test()
+        except Exception as e:
+            print("\nTest of cluster queries failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test the differential harness
+        num_tests += 1
+        try:
+            self.differential_test()
+        except Exception as e:
+            print("\nTest of the differential harness failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test lazy plotting imports
+        num_tests += 1
+        try:
+            self.lazy_import_test()
+        except Exception as e:
+            print("\nTest of lazy plotting imports failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test render_clusters
+        num_tests += 1
+        try:
+            self.render_clusters_test()
+        except Exception as e:
+            print("\nTest of render_clusters failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
+        # Test the command line
+        num_tests += 1
+        try:
+            self.cli_test()
+        except Exception as e:
+            print("\nTest of the command line failed")
+            print(f"Exception: {e}")
+            num_incorrect += 1
+
         print(f"Num tests completed = {num_tests}")
         print(f"Num correct = {num_tests - num_incorrect}")
         if num_incorrect == 0:
@@ -450,3 +669,802 @@ class PA6Test(unittest.TestCase):
         plot_clusters_mock.assert_has_calls([call("clusters")])
 
         print("Test of plot_earthquakes correct")
+
+
+    def grid_index_test(self):
+        """ Tests get_close_points with a GridIndex """
+        print("\n**************\nTesting GridIndex.")
+
+        index = earthquake_clusters.GridIndex(self.eq_locations_database,
+                            self.test_distance)
+        p = self.eq_locations[self.index_test_location]
+        close_points = earthquake_clusters.get_close_points(p,
+                            self.test_distance, self.eq_locations_database, index)
+        self.assertEqual(close_points, earthquake_clusters.get_close_points(p,
+                            self.test_distance, self.eq_locations_database))
+        close_points.sort()
+        self.assertEqual(close_points, self.close_points)
+
+        print("Test of GridIndex passed")
+
+
+    def dbscan_array_test(self):
+        """ Tests dbscan_array """
+        print("\n**************\nTesting dbscan_array function.")
+
+        labels = earthquake_clusters.dbscan_array(self.eq_locations,
+                    self.max_distance_2, self.min_pts, block_size=4)
+        expected = [self.eq_locations_database_after[point]
+                    for point in self.eq_locations]
+        self.assertEqual(labels.tolist(), expected)
+
+        print("Test of dbscan_array passed")
+
+
+    def large_cluster_test(self):
+        """ Tests that one very large cluster does not hit the recursion limit """
+        print("\n**************\nTesting expansion of a large cluster.")
+
+        chain = [(float(i), 0.0) for i in range(100000)]
+        labels = earthquake_clusters.dbscan_array(chain, 1.0, 2)
+        self.assertEqual(set(labels.tolist()), {0})
+
+        data = dict.fromkeys(chain[:5000])
+        index = earthquake_clusters.GridIndex(data, 1.0)
+        earthquake_clusters.add_to_cluster([chain[0]], self.cluster_num, data,
+                            1.0, 2, index)
+        self.assertEqual(set(data.values()), {self.cluster_num})
+
+        # A dense swarm where every point is close to every other one: the
+        # full neighbor graph would hold ten billion pairs.
+        np = earthquake_clusters.np
+        rng = np.random.default_rng(3)
+        swarm = rng.normal(0, 0.2, (100000, 2))
+        for standard in (False, True):
+            store = earthquake_clusters.LabelStore(swarm)
+            num_clusters = earthquake_clusters.dbscan(store, 2.0, 4,
+                                standard=standard)
+            self.assertEqual(num_clusters, 1)
+            self.assertEqual(set(store.labels.tolist()), {0})
+
+        print("Test of large cluster expansion passed")
+
+
+    def haversine_test(self):
+        """ Tests the haversine metric """
+        print("\n**************\nTesting haversine metric.")
+
+        distance = earthquake_clusters.haversine_distance((0, 0), (1, 0))
+        self.assertTrue(abs(distance - 111.19492664) <= self.tolerance)
+
+        # Tonga events on both sides of the antimeridian form one cluster.
+        tonga = {(179.9, -17.0): None, (-179.95, -17.1): None,
+                 (-179.9, -16.9): None, (60.0, 60.0): None}
+        num_clusters = earthquake_clusters.dbscan(tonga, 50.0, 3,
+                            metric='haversine')
+        self.assertEqual(num_clusters, 1)
+        self.assertEqual(list(tonga.values()), [0, 0, 0, -1])
+
+        index = earthquake_clusters.GridIndex(self.eq_locations_database, 700.0,
+                            'haversine')
+        p = self.eq_locations[self.index_test_location]
+        self.assertEqual(earthquake_clusters.get_close_points(p, 700.0,
+                            self.eq_locations_database, index, 'haversine'),
+                         earthquake_clusters.get_close_points(p, 700.0,
+                            self.eq_locations_database, metric='haversine'))
+
+        print("Test of haversine metric passed")
+
+
+    def load_catalog_test(self):
+        """ Tests load_catalog function. """
+        print("\n**************\nTesting load_catalog function.")
+
+        contents = (self.file_contents_mock + "\nnot,a,row\n"
+                    + "2018-11-08T18:00:00.000Z,12.5,\n")
+        with patch('builtins.open', new=mock_open(read_data=contents)):
+            columns, skipped = earthquake_clusters.load_catalog('file/path/mock',
+                            ('longitude', 'latitude', 'time', 'mag'), chunk_size=512)
+        self.assertEqual(skipped, 2)
+        self.assertEqual(list(zip(columns['longitude'].tolist(),
+                            columns['latitude'].tolist())), self.eq_locations)
+        self.assertEqual(columns['time'][0], 1541716524.3)
+        self.assertEqual(columns['mag'][-1], 0.37)
+
+        print("Test of load_catalog passed")
+
+
+    def label_store_test(self):
+        """ Tests LabelStore """
+        print("\n**************\nTesting LabelStore.")
+
+        # Three events at one grid location are three points, not one.
+        locations = [(0, 0), (0, 0), (0, 0), (5, 5)]
+        store = earthquake_clusters.initialize_database(locations)
+        self.assertEqual(len(store.labels), 4)
+        self.assertEqual(dict(store), {(0, 0): None, (5, 5): None})
+        num_clusters = earthquake_clusters.dbscan(store, 1.0, 3)
+        self.assertEqual(num_clusters, 1)
+        self.assertEqual(store.labels.tolist(), [0, 0, 0, -1])
+        self.assertEqual(earthquake_clusters.get_clusters(store, num_clusters),
+                         [[(0, 0), (0, 0), (0, 0)]])
+
+        store[(5, 5)] = 2
+        self.assertEqual(store[(5, 5)], 2)
+        self.assertEqual(store.labels[3], 2)
+
+        print("Test of LabelStore passed")
+
+
+    def get_clusters_options_test(self):
+        """ Tests the output and noise options of get_clusters """
+        print("\n**************\nTesting get_clusters options.")
+
+        clusters, noise = earthquake_clusters.get_clusters(
+                    self.eq_locations_database_after, self.num_clusters, noise=True)
+        self.assertEqual(clusters, self.clusters)
+        self.assertEqual(noise, [point for point in self.eq_locations_database_after
+                    if self.eq_locations_database_after[point] == -1])
+
+        indices = earthquake_clusters.get_clusters(
+                    self.eq_locations_database_after, self.num_clusters, 'indices')
+        self.assertEqual([[self.eq_locations[i] for i in rows] for rows in indices],
+                    self.clusters)
+        arrays = earthquake_clusters.get_clusters(
+                    self.eq_locations_database_after, self.num_clusters, 'arrays')
+        self.assertEqual([list(map(tuple, a.tolist())) for a in arrays], self.clusters)
+
+        print("Test of get_clusters options passed")
+
+
+    def incremental_test(self):
+        """ Tests IncrementalClusterer against a batch run """
+        print("\n**************\nTesting IncrementalClusterer.")
+
+        clusterer = incremental_clusters.IncrementalClusterer(
+                    self.max_distance_2, self.min_pts)
+        for start in range(0, len(self.eq_locations), 5):
+            clusterer.insert(self.eq_locations[start:start + 5],
+                    times=range(start, start + 5))
+        store = clusterer.to_store()
+        expected = earthquake_clusters.dbscan_array(self.eq_locations,
+                    self.max_distance_2, self.min_pts, standard=True)
+        self.assertEqual(store.labels.tolist(), expected.tolist())
+
+        self.assertEqual(clusterer.expire(15), list(range(15)))
+        expected = earthquake_clusters.dbscan_array(self.eq_locations[15:],
+                    self.max_distance_2, self.min_pts, standard=True)
+        self.assertEqual(clusterer.to_store().labels.tolist(), expected.tolist())
+
+        print("Test of IncrementalClusterer passed")
+
+    def parallel_test(self):
+        """ Tests dbscan_parallel against a serial run """
+        print("\n**************\nTesting dbscan_parallel.")
+
+        expected = earthquake_clusters.dbscan_array(self.eq_locations,
+                    self.max_distance_2, self.min_pts, standard=True)
+        for workers, tiles in ((1, 1), (1, 7), (2, None)):
+            labels = parallel_clusters.dbscan_parallel(self.eq_locations,
+                        self.max_distance_2, self.min_pts, workers, tiles)
+            self.assertEqual(labels.tolist(), expected.tolist())
+
+        labels = parallel_clusters.dbscan_parallel(self.eq_locations, 300,
+                    self.min_pts, 1, 9, metric='haversine')
+        expected = earthquake_clusters.dbscan_array(self.eq_locations, 300,
+                    self.min_pts, metric='haversine', standard=True)
+        self.assertEqual(labels.tolist(), expected.tolist())
+
+        print("Test of dbscan_parallel passed")
+
+    def sweep_test(self):
+        """ Tests dbscan_sweep against separate dbscan_array runs """
+        print("\n**************\nTesting dbscan_sweep.")
+
+        epsilons = [self.max_distance_2, 2.0, 1.0]
+        results = earthquake_clusters.dbscan_sweep(self.eq_locations,
+                    epsilons, [self.min_pts, 2])
+        self.assertEqual(len(results), 6)
+        for (epsilon, min_pts), (num_clusters, unclustered, labels) in results.items():
+            expected = earthquake_clusters.dbscan_array(self.eq_locations,
+                        epsilon, min_pts)
+            self.assertEqual(labels.tolist(), expected.tolist())
+            self.assertEqual(num_clusters, expected.max() + 1)
+            self.assertAlmostEqual(unclustered, (expected < 0).mean())
+
+        # min_pts_values is gone through once per epsilon, so it may be a
+        # generator.
+        generated = earthquake_clusters.dbscan_sweep(self.eq_locations,
+                    epsilons, (min_pts for min_pts in [self.min_pts, 2]))
+        self.assertEqual(sorted(generated), sorted(results))
+
+        print("Test of dbscan_sweep passed")
+
+    def stats_test(self):
+        """ Tests the counters DbscanStats collects for a dbscan run """
+        print("\n**************\nTesting DbscanStats.")
+
+        emitted = []
+        stats = earthquake_clusters.DbscanStats(emitted.append)
+        num_clusters = earthquake_clusters.dbscan(self.eq_locations_database,
+                    self.max_distance_2, self.min_pts, stats=stats)
+        self.assertEqual(num_clusters, self.num_clusters)
+        self.assertEqual(self.eq_locations_database,
+                    self.eq_locations_database_after)
+        self.assertEqual(emitted, [stats])
+        # Every point is searched once, and the first point of each
+        # cluster once more when it is reached from its neighbors, as in
+        # get_close_points and add_to_cluster.
+        self.assertEqual(stats.range_queries,
+                    len(self.eq_locations) + self.num_clusters)
+        self.assertEqual(stats.distance_evaluations, 140)
+        self.assertEqual(stats.core_points, 12)
+        self.assertEqual(stats.border_points, 6)
+        self.assertEqual(stats.noise_points, 11)
+        self.assertEqual(stats.max_queue_depth, 9)
+        self.assertTrue({'convert', 'neighbor_graph', 'labeling',
+                    'write_back'} <= set(stats.seconds))
+
+        stats = earthquake_clusters.DbscanStats()
+        labels = earthquake_clusters.dbscan_array(self.eq_locations,
+                    self.max_distance_2, self.min_pts, standard=True, stats=stats)
+        self.assertEqual(stats.max_queue_depth, 0)
+        self.assertEqual(stats.core_points, 18)
+        self.assertEqual(stats.border_points, 0)
+        self.assertEqual(stats.core_points + stats.border_points,
+                    (labels >= 0).sum())
+        self.assertEqual(stats.as_dict()['noise_points'], (labels == -1).sum())
+
+        # The first point of a cluster is searched twice but is only one
+        # core point.
+        for standard in (False, True):
+            stats = earthquake_clusters.DbscanStats()
+            labels = earthquake_clusters.dbscan_array([(0, 0), (0.1, 0), (0.2, 0)],
+                        1.0, 1, standard=standard, stats=stats)
+            self.assertEqual(labels.tolist(), [0, 0, 0])
+            self.assertEqual((stats.core_points, stats.border_points,
+                              stats.noise_points), (3, 0, 0))
+            self.assertEqual(stats.range_queries, 3 if standard else 4)
+
+        stats = earthquake_clusters.DbscanStats()
+        data = dict.fromkeys(self.p1)
+        earthquake_clusters.add_to_cluster([self.p1[3]], 0, data,
+                    self.max_distance, self.min_pts, stats=stats)
+        self.assertEqual(stats.range_queries, 11)
+        self.assertEqual(stats.core_points, 4)
+        self.assertEqual(stats.max_queue_depth, 5)
+
+        print("Test of DbscanStats passed")
+
+    def catalog_cache_test(self):
+        """ Tests CatalogCache reuses parsed catalogs and labels """
+        print("\n**************\nTesting CatalogCache.")
+
+        expected = earthquake_clusters.dbscan_array(
+                    earthquake_clusters.get_eq_locations('eq_day.csv'), 2.0, 4)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = catalog_cache.CatalogCache(directory)
+            coords, labels = cache.dbscan('eq_day.csv', 2.0, 4)
+            self.assertEqual(labels.tolist(), expected.tolist())
+            self.assertEqual(len(cache.entries()), 3)
+
+            with patch('catalog_cache.catalog_locations') as load_mock, \
+                 patch('catalog_cache.neighbor_graph') as graph_mock:
+                coords, labels = catalog_cache.CatalogCache(directory).dbscan(
+                            'eq_day.csv', 2.0, 4)
+                load_mock.assert_not_called()
+                graph_mock.assert_not_called()
+            self.assertIsInstance(labels, earthquake_clusters.np.memmap)
+            self.assertEqual(labels.tolist(), expected.tolist())
+            self.assertEqual(len(coords), len(expected))
+
+            cache.max_bytes = 0
+            self.assertEqual(len(cache.evict()), 3)
+            self.assertEqual(cache.entries(), [])
+            coords, labels = cache.dbscan('eq_day.csv', 2.0, 4)
+            self.assertEqual(labels.tolist(), expected.tolist())
+
+        print("Test of CatalogCache passed")
+
+    def binary_catalog_test(self):
+        """ Tests converting a catalog to the binary format and mapping it """
+        print("\n**************\nTesting the binary catalog format.")
+
+        locations = earthquake_clusters.get_eq_locations('eq_week.csv')
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'eq_week.eqcat')
+            rows = earthquake_clusters.write_binary_catalog('eq_week.csv',
+                        filename)
+            self.assertEqual(rows, len(locations))
+            self.assertEqual(os.path.getsize(filename), 64 + 40 * rows)
+            self.assertTrue(earthquake_clusters.is_binary_catalog(filename))
+            self.assertFalse(earthquake_clusters.is_binary_catalog('eq_week.csv'))
+
+            columns = earthquake_clusters.open_binary_catalog(filename)
+            self.assertFalse(columns['coords'].flags.writeable)
+            self.assertEqual(columns['time'][0], 1541715924100)
+            self.assertEqual(columns['mag'][0], 1.8)
+            self.assertEqual(columns['longitude'][0], -141.4784)
+            self.assertEqual(earthquake_clusters.get_eq_locations(filename),
+                        locations)
+            self.assertEqual(earthquake_clusters.dbscan_array(
+                        columns['coords'], 2.0, 4).tolist(),
+                        earthquake_clusters.dbscan_array(locations, 2.0, 4).tolist())
+            del columns
+
+            with open(filename, 'r+b') as f:
+                f.truncate(100)
+            with self.assertRaises(ValueError):
+                earthquake_clusters.open_binary_catalog(filename)
+
+        contents = self.file_contents_mock.replace(',0.89,ml,', ',,ml,')
+        with patch('builtins.open', new=mock_open(read_data=contents)):
+            columns, skipped = earthquake_clusters.load_catalog('file/path/mock',
+                        ('longitude', 'mag'), optional=('mag',))
+        self.assertEqual(skipped, 0)
+        self.assertEqual(len(columns['mag']), len(self.eq_locations))
+        self.assertTrue(math.isnan(columns['mag'][0]))
+
+        print("Test of the binary catalog format passed")
+
+    def st_dbscan_test(self):
+        """ Tests st_dbscan_array and spatiotemporal_graph """
+        print("\n**************\nTesting st_dbscan_array.")
+
+        np = earthquake_clusters.np
+        # Two swarms in the same place a day apart are two clusters.
+        coords = [(0.0, 0.0)] * 10
+        times = [0, 60, 120, 180, 240, 86400, 86460, 86520, 86580, 86640]
+        labels = earthquake_clusters.st_dbscan_array(coords, times, 1.0, 3600, 3)
+        self.assertEqual(labels.tolist(), [0] * 5 + [1] * 5)
+        self.assertEqual(earthquake_clusters.dbscan_array(coords, 1.0, 3).tolist(),
+                    [0] * 10)
+
+        rng = np.random.default_rng(1)
+        coords = rng.uniform(0, 10, (300, 2))
+        times = rng.uniform(0, 100, 300)
+        indptr, indices = earthquake_clusters.spatiotemporal_graph(coords, times,
+                    1.5, 7.0, block_size=16)
+        for i in range(len(coords)):
+            close = ((np.hypot(*(coords - coords[i]).T) <= 1.5)
+                     & (np.abs(times - times[i]) <= 7.0))
+            close[i] = False
+            self.assertEqual(indices[indptr[i]:indptr[i + 1]].tolist(),
+                        np.flatnonzero(close).tolist())
+
+        coords, times = earthquake_clusters.catalog_events('eq_week.csv')
+        self.assertEqual(earthquake_clusters.st_dbscan_array(coords, times, 2.0,
+                    1e9, 4).tolist(),
+                    earthquake_clusters.dbscan_array(coords, 2.0, 4).tolist())
+
+        print("Test of st_dbscan_array passed")
+
+    def hypocenter_test(self):
+        """ Tests depth-aware and magnitude-weighted clustering """
+        print("\n**************\nTesting hypocenter_dbscan_array.")
+
+        space = earthquake_clusters.hypocenter_coords([(0, 0), (0, 0)], [0, 600])
+        self.assertTrue(abs(space[0, 0] - 6371.0) <= self.tolerance)
+        self.assertTrue(abs(space[1, 0] - 5771.0) <= self.tolerance)
+
+        # A shallow swarm above deep events under Fiji is two clusters.
+        coords = [(178.0, -18.0), (178.01, -18.0), (178.0, -18.01),
+                  (178.01, -18.01)] * 2
+        depths = [2, 3, 2, 4, 600, 601, 598, 600]
+        labels = earthquake_clusters.hypocenter_dbscan_array(coords, depths,
+                    50.0, 3)
+        self.assertEqual(labels.tolist(), [0] * 4 + [1] * 4)
+        labels = earthquake_clusters.dbscan_array(coords, 1.0, 3)
+        self.assertEqual(labels.tolist(), [0] * 8)
+
+        weights = earthquake_clusters.magnitude_weights([6.0, 0.2, float('nan')])
+        self.assertEqual(weights.tolist(), [6.0, 0.2, 1.0])
+        for standard in (False, True):
+            labels = earthquake_clusters.hypocenter_dbscan_array(coords[:2],
+                        [10, 10], 5.0, 5, weights[:2], standard=standard)
+            self.assertEqual(labels.tolist(), [0, 0])
+            labels = earthquake_clusters.hypocenter_dbscan_array(coords[:2],
+                        [10, 10], 5.0, 5, standard=standard)
+            self.assertEqual(labels.tolist(), [-1, -1])
+
+        coords, depths, mags = earthquake_clusters.catalog_hypocenters(
+                    'eq_week.csv')
+        self.assertEqual(len(depths), len(coords))
+        self.assertEqual(len(mags), len(coords))
+        self.assertEqual(list(map(tuple, coords.tolist())),
+                    earthquake_clusters.get_eq_locations('eq_week.csv'))
+
+        print("Test of hypocenter_dbscan_array passed")
+
+    def hierarchy_test(self):
+        """ Tests ClusterHierarchy cuts and stable clusters """
+        print("\n**************\nTesting ClusterHierarchy.")
+
+        np = earthquake_clusters.np
+        locations = earthquake_clusters.get_eq_locations('eq_week.csv')
+        hierarchy = hierarchical_clusters.ClusterHierarchy(locations, 4, 4.0)
+        self.assertEqual(hierarchy.linkage().shape, (len(locations) - 1, 4))
+        self.assertEqual(hierarchy.linkage()[-1, 3], len(locations))
+        for epsilon in (0.25, 1.0, 2.0, 4.0):
+            expected = earthquake_clusters.dbscan_array(locations, epsilon, 4,
+                        standard=True)
+            self.assertEqual(hierarchy.cut(epsilon).tolist(), expected.tolist())
+        with self.assertRaises(ValueError):
+            hierarchy.cut(5.0)
+
+        # A tight swarm and a loose one are both found in one pass.
+        rng = np.random.default_rng(0)
+        coords = np.concatenate((rng.normal(0, 0.05, (100, 2)),
+                                 rng.normal(20, 1.0, (100, 2)),
+                                 rng.uniform(-40, 60, (20, 2))))
+        labels = hierarchical_clusters.ClusterHierarchy(coords, 5, 10.0).labels(30)
+        tight, loose = labels[:100], labels[100:200]
+        for swarm in (tight, loose):
+            self.assertGreaterEqual((swarm >= 0).sum(), 80)
+        self.assertFalse(set(tight[tight >= 0].tolist())
+                         & set(loose[loose >= 0].tolist()))
+
+        print("Test of ClusterHierarchy passed")
+
+    def approximate_test(self):
+        """ Tests approximate_dbscan stays within its error bounds """
+        print("\n**************\nTesting approximate_dbscan.")
+
+        ari = approximate_clusters.adjusted_rand_index
+        self.assertEqual(ari([0, 0, 1, 1], [5, 5, 7, 7]), 1.0)
+        self.assertAlmostEqual(ari([0, 0, 1, 1], [0, 1, 0, 1]), -0.5)
+
+        locations = earthquake_clusters.get_eq_locations('eq_week.csv')
+        labels = approximate_clusters.approximate_dbscan(locations, 2.0, 4, 0.25)
+        inner = earthquake_clusters.dbscan_array(locations, 1.5, 4, standard=True)
+        outer = earthquake_clusters.dbscan_array(locations, 2.5, 4, standard=True)
+        self.assertTrue(((inner >= 0) <= (labels >= 0)).all())
+        self.assertTrue(((labels >= 0) <= (outer >= 0)).all())
+
+        labels = approximate_clusters.approximate_dbscan(locations, 300.0, 4,
+                    metric='haversine')
+        self.assertEqual(len(labels), len(locations))
+        self.assertEqual(len(approximate_clusters.approximate_dbscan([], 1.0, 4)), 0)
+
+        report = approximate_clusters.quality_report(locations, 2.0, 4, (0.1,))
+        self.assertGreater(report[0]['adjusted_rand_index'], 0.8)
+
+        print("Test of approximate_dbscan passed")
+
+    def feed_ingest_test(self):
+        """ Tests FeedPoller against the local FeedServer """
+        print("\n**************\nTesting feed ingestion.")
+
+        times = earthquake_clusters.parse_times(['2018-11-08T22:35:24.300Z',
+                                                 b'1970-01-01T00:00:01.000Z'])
+        self.assertEqual(times.tolist(), [1541716524.3, 1.0])
+
+        with open('eq_week.csv') as f:
+            lines = f.readlines()
+        with tempfile.TemporaryDirectory() as directory:
+            def write(name, rows):
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.writelines(lines[:1] + rows)
+            write('eq_week.csv', lines[100:])
+            write('eq_day.csv', lines[100:300])
+
+            with feed_ingest.FeedServer(directory) as server:
+                clusterer = incremental_clusters.IncrementalClusterer(2.0, 4)
+                poller = feed_ingest.FeedPoller([server.url('eq_week.csv'),
+                            server.url('eq_day.geojson')], clusterer)
+                try:
+                    new = asyncio.run(poller.poll_once())
+                    self.assertEqual(len(new), len(lines) - 100)
+                    self.assertEqual(len(clusterer), len(new))
+                    self.assertEqual(len(set(event.id for event in new)), len(new))
+                    self.assertEqual(asyncio.run(poller.poll_once()), [])
+                    self.assertEqual(server.requests[304], 2)
+
+                    write('eq_week.csv', lines[1:])
+                    new = asyncio.run(poller.poll_once())
+                    self.assertEqual(sorted(event.id for event in new),
+                                sorted(line.split(',')[11] for line in lines[1:100]))
+                    self.assertEqual(len(clusterer), len(lines) - 1)
+                    self.assertEqual(len(poller.latencies), 3)
+
+                    poller.urls.append(server.url('missing.csv'))
+                    asyncio.run(poller.poll_once())
+                    self.assertIn(server.url('missing.csv'), poller.failures)
+                finally:
+                    poller.close()
+
+                # With a one day window only the last day of the week is
+                # kept, and the older events stay out when the feed sends
+                # them again.
+                clusterer = incremental_clusters.IncrementalClusterer(2.0, 4)
+                poller = feed_ingest.FeedPoller([server.url('eq_week.csv')],
+                            clusterer, window=86400.0)
+                try:
+                    times = [event.time for event in feed_ingest.parse_feed(
+                                ''.join(lines).encode('utf-8'))]
+                    recent = sum(t >= max(times) - 86400.0 for t in times)
+                    new = asyncio.run(poller.poll_once())
+                    self.assertEqual(len(new), recent)
+                    self.assertEqual(len(clusterer), recent)
+                    self.assertEqual(len(poller.seen), recent)
+                    self.assertEqual(len(poller.events), recent)
+                    write('eq_week.csv', lines[1:] + lines[1:2])
+                    self.assertEqual(asyncio.run(poller.poll_once()), [])
+                    self.assertEqual(len(poller.seen), recent)
+                finally:
+                    poller.close()
+
+        print("Test of feed ingestion passed")
+
+    def cluster_queries_test(self):
+        """ Tests ClusterResults queries against a scan of every point """
+        print("\n**************\nTesting cluster queries.")
+
+        np = earthquake_clusters.np
+        hull = cluster_queries.convex_hull([(0, 0), (2, 0), (1, 1), (2, 2), (0, 2)])
+        self.assertEqual(hull, [(0, 0), (2, 0), (2, 2), (0, 2)])
+
+        coords, depths, mags = earthquake_clusters.catalog_hypocenters('eq_week.csv')
+        for metric, epsilon in (('euclidean', 2.0), ('haversine', 200.0)):
+            labels = earthquake_clusters.dbscan_array(coords, epsilon, 4,
+                        metric=metric, standard=True)
+            core = earthquake_clusters.core_points(coords, epsilon, 4,
+                        metric=metric)
+            results = cluster_queries.ClusterResults(coords, labels, epsilon,
+                        mags, metric, core)
+            self.assertEqual(len(results), labels.max() + 1)
+            first = results[0]
+            self.assertEqual(first.count, (labels == 0).sum())
+            self.assertLessEqual(first.mag_min, first.mag_mean)
+            self.assertLessEqual(first.mag_mean, first.mag_max)
+
+            clustered = labels >= 0
+            core_rows = core & clustered
+            distance = earthquake_clusters.ROW_DISTANCES[metric]
+            rng = random.Random(1)
+            for _ in range(200):
+                point = (rng.uniform(-180, 180), rng.uniform(-90, 90))
+                distances = distance(coords[clustered],
+                                     np.tile(point, (clustered.sum(), 1)))
+                best = distances.argmin()
+                label, found = results.nearest(point)
+                self.assertAlmostEqual(found, distances[best])
+                core_distances = distance(coords[core_rows],
+                                          np.tile(point, (core_rows.sum(), 1)))
+                nearest_core = core_distances.argmin()
+                self.assertEqual(results.label_of(point),
+                                 labels[core_rows][nearest_core]
+                                 if core_distances[nearest_core] <= epsilon else -1)
+                radius = 3 * epsilon
+                self.assertEqual(results.within(point, radius), sorted(set(
+                    labels[clustered][distances <= radius].tolist())))
+                box = (point[0] - 10, point[1] - 10, point[0] + 10, point[1] + 10)
+                expected = []
+                for summary in results.summaries:
+                    bbox = summary.bbox
+                    if metric == 'haversine':
+                        # Longitudes meet if they do a whole turn apart;
+                        # boxes across the antimeridian have min_lon > max_lon.
+                        end = bbox[2] + 360 * (bbox[2] < bbox[0])
+                        lon_hit = any(bbox[0] + turn <= box[2] and end + turn >= box[0]
+                                      for turn in (-360, 0, 360))
+                    else:
+                        lon_hit = bbox[0] <= box[2] and bbox[2] >= box[0]
+                    if lon_hit and bbox[1] <= box[3] and bbox[3] >= box[1]:
+                        expected.append(summary.label)
+                self.assertEqual(results.intersecting(box), expected)
+
+        store = earthquake_clusters.LabelStore(coords)
+        store.labels[:] = labels
+        clusters = earthquake_clusters.get_clusters(store, labels.max() + 1)
+        results = cluster_queries.ClusterResults.from_clusters(clusters, 200.0,
+                    'haversine')
+        self.assertEqual([s.count for s in results.summaries],
+                         [len(cluster) for cluster in clusters])
+        # A border event does not pull a new event into its cluster.
+        points = [(0, 0), (0.1, 0), (0, 0.1), (0.1, 0.1), (1.05, 0)]
+        labels = earthquake_clusters.dbscan_array(points, 1.0, 4, standard=True)
+        self.assertEqual(labels.tolist(), [0] * 5)
+        results = cluster_queries.ClusterResults(points, labels, 1.0,
+                    core=earthquake_clusters.core_points(points, 1.0, 4))
+        self.assertEqual(results.nearest((1.9, 0), 1.0)[0], 0)
+        self.assertEqual(results.label_of((1.9, 0)), -1)
+        self.assertEqual(results.label_of((0.9, 0)), 0)
+        with self.assertRaises(ValueError):
+            cluster_queries.ClusterResults(points, labels, 1.0).label_of((0, 0))
+
+        # A Tonga cluster across the antimeridian gets a small box and hull.
+        tonga = [(179.95, -17.0), (-179.95, -17.05), (179.9, -16.95),
+                 (-179.9, -17.0)]
+        results = cluster_queries.ClusterResults(tonga, [0] * 4, 50.0,
+                    metric='haversine')
+        self.assertEqual(results[0].bbox, (179.9, -17.05, -179.9, -16.95))
+        hull = results[0].hull
+        self.assertLess(max(x for x, y in hull) - min(x for x, y in hull), 1)
+        self.assertEqual(results.intersecting((0, -20, 1, -10)), [])
+        self.assertEqual(results.intersecting((170, -20, 179, -10)), [])
+        self.assertEqual(results.intersecting((179, -20, 180, -10)), [0])
+        self.assertEqual(results.intersecting((-180, -20, -179, -10)), [0])
+        self.assertEqual(results.intersecting((170, -20, -170, -10)), [0])
+        self.assertEqual(results.intersecting((-185, -20, -179, -10)), [0])
+        self.assertEqual(results.intersecting((181, -20, 185, -10)), [])
+
+        self.assertEqual(cluster_queries.ClusterResults([], [], 1.0).nearest((0, 0)),
+                         (-1, math.inf))
+
+        print("Test of cluster queries passed")
+
+    def differential_test(self):
+        """ Tests every engine gives the reference clusters up to relabeling """
+        print("\n**************\nTesting engines against the reference.")
+
+        np = earthquake_clusters.np
+        # 0 1 2 are core, 3 is a border point touching both 2 and 4, 4 5 6
+        # are core, 7 is noise.
+        coords = np.array([[0, 0], [1, 0], [2, 0], [3, 0], [4, 0], [5, 0],
+                           [6, 0], [20, 0]], dtype=np.float64)
+        indptr, indices = earthquake_clusters.neighbor_graph(coords, 1.0)
+        core = np.array([1, 1, 1, 0, 1, 1, 1, 0], dtype=bool)
+        reference = [0, 0, 0, 0, 1, 1, 1, -1]
+        compare = differential_clusters.LabelComparison
+        self.assertTrue(compare(reference, reference, core, indptr, indices).identical)
+        relabeled = compare(reference, [1, 1, 1, 1, 0, 0, 0, -1], core, indptr, indices)
+        self.assertTrue(relabeled.identical)
+        moved = compare(reference, [1, 1, 1, 0, 0, 0, 0, -1], core, indptr, indices)
+        self.assertTrue(moved.equivalent)
+        self.assertEqual(moved.border.tolist(), [3])
+        self.assertFalse(moved.identical)
+        wrong = compare(reference, [0, 0, 0, 0, 0, 0, 0, 0], core, indptr, indices)
+        self.assertEqual(wrong.merged, [0])
+        self.assertEqual(wrong.noise_mismatch.tolist(), [7])
+        self.assertFalse(wrong.equivalent)
+        split = compare(reference, [0, 0, 2, 0, 1, 1, 1, -1], core, indptr, indices)
+        self.assertEqual(split.split, [0])
+        far = compare([0, 0, 0, -1, 1, 1, 1, -1], [0, 0, 0, -1, 1, 1, 1, -1],
+                      core, indptr, indices, candidate_core=core | (coords[:, 0] == 3))
+        self.assertEqual(far.core_mismatch.tolist(), [3])
+
+        coords, epsilon, min_pts, metric = differential_clusters.synthetic_catalog(4)
+        again = differential_clusters.synthetic_catalog(4)[0]
+        self.assertEqual(coords.tolist(), again.tolist())
+
+        # The serial engines must put every row where the plain Python
+        # dbscan does; the textbook labels do not.
+        expected = differential_clusters._pure_python(coords, epsilon, min_pts, metric)
+        self.assertTrue(differential_clusters.compare_serial(
+            differential_clusters._serial, coords, epsilon, min_pts, metric,
+            expected).identical)
+        standard = lambda *args: earthquake_clusters.dbscan_array(
+            *args[:3], metric=args[3], standard=True)
+        self.assertFalse(differential_clusters.compare_serial(
+            standard, coords, epsilon, min_pts, metric, expected).equivalent)
+
+        engines = set()
+        for case, engine, comparison in differential_clusters.run_differential(
+                    seeds=range(3), catalogs=('eq_day.csv',)):
+            self.assertTrue(comparison.equivalent, (case, engine, comparison))
+            engines.add(engine)
+        self.assertEqual(engines, {'dbscan', 'dbscan_array_serial', 'dbscan_parallel',
+                                   'hierarchy', 'incremental'})
+
+        print("Test of the differential harness passed")
+
+    def lazy_import_test(self):
+        """ Tests clustering never imports matplotlib or imageio """
+        print("\n**************\nTesting lazy plotting imports.")
+
+        script = "\n".join([
+            "import io, sys",
+            "import earthquake_clusters",
+            "coords = earthquake_clusters.catalog_locations('eq_day.csv')",
+            "earthquake_clusters.dbscan_array(coords, 2.0, 4)",
+            "print(sorted(m for m in ('matplotlib', 'imageio') if m in sys.modules))",
+            "earthquake_clusters.render_clusters([coords], io.BytesIO(), background=None)",
+            "print('matplotlib.pyplot' in sys.modules)"])
+        output = subprocess.run([sys.executable, '-c', script], check=True,
+                    capture_output=True, text=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+        self.assertEqual(output[0], '[]')
+        self.assertEqual(output[1], 'False')
+
+        print("Test of lazy plotting imports passed")
+
+    def render_clusters_test(self):
+        """ Tests render_clusters draws every cluster in one scatter call """
+        print("\n**************\nTesting render_clusters function.")
+
+        earthquake_clusters.world_map.cache_clear()
+        output = io.BytesIO()
+        with patch('matplotlib.axes.Axes.scatter') as scatter_mock:
+            earthquake_clusters.render_clusters(self.clusters_for_plot,
+                        output, noise=[(0, 0)])
+        self.assertEqual(scatter_mock.call_count, 1)
+        x, y = scatter_mock.call_args[0]
+        self.assertEqual(x.tolist(), [0, 1, 3, 5, 7, 9])
+        self.assertEqual(y.tolist(), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(len(scatter_mock.call_args[1]['c']), 6)
+        self.assertTrue(output.getvalue().startswith(b'\x89PNG'))
+
+        output = io.BytesIO()
+        earthquake_clusters.render_clusters(self.clusters_for_plot * 100,
+                    output, max_points=50)
+        self.assertTrue(output.getvalue().startswith(b'\x89PNG'))
+
+        print("Test of render_clusters passed")
+
+    def cli_test(self):
+        """ Tests the command line writes labels for every file """
+        print("\n**************\nTesting the command line.")
+
+        with tempfile.TemporaryDirectory() as output, \
+             patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            status = earthquake_clusters.main(['eq_d*.csv', 'eq_week.csv',
+                        '--output', output, '--no-plot', '--workers', '1'])
+            self.assertEqual(status, 0)
+            self.assertEqual(sorted(os.listdir(output)),
+                        ['eq_day.labels.npz', 'eq_week.labels.npz'])
+            with earthquake_clusters.np.load(os.path.join(output,
+                        'eq_week.labels.npz')) as saved:
+                expected = earthquake_clusters.dbscan_array(
+                            earthquake_clusters.get_eq_locations('eq_week.csv'),
+                            2.0, 4)
+                self.assertEqual(saved['label'].tolist(), expected.tolist())
+
+            earthquake_clusters.main(['eq_day.csv', '--output', output,
+                        '--no-plot', '--format', 'csv', '--epsilon', '1.5'])
+            with open(os.path.join(output, 'eq_day.labels.csv')) as f:
+                self.assertEqual(f.readline(), 'longitude,latitude,label\n')
+                self.assertEqual(len(f.readlines()), 209)
+        self.assertIn('2 files, 1365 rows', stdout.getvalue())
+
+        # Options that would be ignored together are rejected.
+        for options in (['--depth', '--metric', 'haversine'],
+                        ['--depth', '--metric', 'euclidean'],
+                        ['--window', '24', '--cache', 'cache'],
+                        ['--depth', '--cache', 'cache'],
+                        ['--mag-weight', '5'], ['--workers', '-1'],
+                        ['--workers', '0']):
+            with patch('sys.stderr', new_callable=io.StringIO), \
+                 self.assertRaises(SystemExit):
+                earthquake_clusters.main(['eq_day.csv', '--no-plot'] + options)
+
+        # A file that fails, whatever the exception, is reported, and the
+        # others are still clustered and summed up.
+        cluster_file = earthquake_clusters.cluster_file
+        def failing(filename, **options):
+            if filename == 'eq_week.csv':
+                raise RuntimeError("no luck")
+            return cluster_file(filename, **options)
+        with tempfile.TemporaryDirectory() as output, \
+             patch('earthquake_clusters.cluster_file', failing), \
+             patch('sys.stdout', new_callable=io.StringIO) as stdout, \
+             patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            status = earthquake_clusters.main(['eq_week.csv', 'eq_day.csv',
+                        '--output', output, '--no-plot', '--workers', '1'])
+            self.assertEqual(status, 1)
+            self.assertEqual(stderr.getvalue(),
+                        'eq_week.csv: RuntimeError: no luck\n')
+            self.assertIn('1 files, 209 rows', stdout.getvalue())
+
+        # Catalogs with the same name in different directories get their
+        # outputs named after their paths instead of overwriting each other.
+        with tempfile.TemporaryDirectory() as root, \
+             patch('sys.stdout', new_callable=io.StringIO):
+            for folder in ('a', 'b'):
+                os.makedirs(os.path.join(root, folder))
+                with open('eq_day.csv', 'rb') as src, open(os.path.join(
+                            root, folder, 'eq_day.csv'), 'wb') as dst:
+                    dst.write(src.read())
+            output = os.path.join(root, 'out')
+            status = earthquake_clusters.main([os.path.join(root, '*', '*.csv'),
+                        '--output', output, '--no-plot', '--workers', '2'])
+            self.assertEqual(status, 0)
+            self.assertEqual(sorted(os.listdir(output)),
+                        ['a-eq_day.labels.npz', 'b-eq_day.labels.npz'])
+        self.assertEqual(earthquake_clusters.output_names(
+                    ['x/eq_day.csv', 'eq_week.csv']), ['eq_day', 'eq_week'])
+        with self.assertRaises(ValueError):
+            earthquake_clusters.output_names(['a-b.csv', 'a/b.csv', 'c/b.csv'])
+        self.assertTrue(os.path.isabs(earthquake_clusters.WORLD_MAP))
+
+        print("Test of the command line passed")